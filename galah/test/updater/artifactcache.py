@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.artifactcache as artifactcache
+import galah.updater.core.errors as errors
+import galah.updater.core.signatures as signatures
+
+# stdlib
+import os
+import random
+import shutil
+import stat
+import tempfile
+import unittest
+
+def get_pseudo_random_bytes(nbytes):
+	return "".join([chr(random.getrandbits(8)) for i in xrange(nbytes)])
+
+class TestArtifactCache(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.cache_dir = os.path.join(self.temp_dir, "cache")
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def make_download(self, size):
+		"Creates a file and fake signature as get_file() would return them."
+
+		paths = []
+		for i in (size, 64):
+			os_handle, path = tempfile.mkstemp(dir = self.temp_dir)
+			with os.fdopen(os_handle, "wb") as f:
+				f.write(get_pseudo_random_bytes(i))
+			os.chmod(path, stat.S_IRUSR)
+			paths.append(path)
+		with open(paths[0], "rb") as f:
+			digest = signatures._hash_file_sha512(f).hexdigest()
+		return paths[0], paths[1], digest
+
+	def read(self, path):
+		with open(path, "rb") as f:
+			return f.read()
+
+	def test_store_and_checkout(self):
+		cache = artifactcache.ArtifactCache(self.cache_dir, 10000)
+		self.assertEquals(cache.checkout("http://a/file"), None)
+
+		file_path, sig_path, digest = self.make_download(1000)
+		cache.store("http://a/file", file_path, sig_path, digest, '"v1"')
+
+		# The checked out copies belong to the caller.
+		got_file, got_sig = cache.checkout("http://a/file")
+		self.assertEquals(self.read(got_file), self.read(file_path))
+		self.assertEquals(self.read(got_sig), self.read(sig_path))
+		os.remove(got_file)
+		os.remove(got_sig)
+		self.assertNotEquals(cache.checkout("http://a/file"), None)
+
+		# A different validator is a miss.
+		self.assertEquals(cache.checkout("http://a/file", '"v2"'), None)
+		self.assertNotEquals(cache.checkout("http://a/file", '"v1"'), None)
+
+		self.assertEquals(cache.stats["hits"], 3)
+		self.assertEquals(cache.stats["misses"], 2)
+		self.assertEquals(cache.hit_rate(), 0.6)
+
+		# The index survives across instances.
+		cache = artifactcache.ArtifactCache(self.cache_dir, 10000)
+		self.assertNotEquals(cache.checkout("http://a/file"), None)
+
+	def test_eviction(self):
+		cache = artifactcache.ArtifactCache(self.cache_dir, 2500)
+		for url in ("http://a/1", "http://a/2", "http://a/3"):
+			file_path, sig_path, digest = self.make_download(1000)
+			cache.store(url, file_path, sig_path, digest)
+			# Make sure last-used times differ.
+			cache.checkout("http://a/1")
+
+		# 2 was the least recently used.
+		self.assertEquals(cache.stats["evictions"], 1)
+		self.assertEquals(cache.lookup("http://a/2"), None)
+		self.assertNotEquals(cache.lookup("http://a/1"), None)
+		self.assertNotEquals(cache.lookup("http://a/3"), None)
+		self.assertEquals(len(os.listdir(os.path.join(self.cache_dir,
+			"objects"))), 4)
+
+	def test_integrity(self):
+		cache = artifactcache.ArtifactCache(self.cache_dir, 10000)
+		file_path, sig_path, digest = self.make_download(1000)
+		cache.store("http://a/file", file_path, sig_path, digest)
+		os.remove(file_path)
+
+		object_path = os.path.join(self.cache_dir, "objects", digest)
+		os.chmod(object_path, stat.S_IRUSR | stat.S_IWUSR)
+		with open(object_path, "r+b") as f:
+			f.write("corrupt")
+
+		self.assertEquals(cache.checkout("http://a/file"), None)
+		self.assertEquals(cache.stats["integrity_failures"], 1)
+		self.assertEquals(cache.lookup("http://a/file"), None)
+
+	def test_private(self):
+		# Anyone who can write to the cache could plant files in it.
+		for directory in (self.cache_dir,
+				os.path.join(self.cache_dir, "objects")):
+			artifactcache.ArtifactCache(self.cache_dir, 10000)
+			os.chmod(directory, 0770)
+			self.assertRaises(errors.CriticalError,
+				artifactcache.ArtifactCache, self.cache_dir, 10000)
+			os.chmod(directory, 0700)
+
+		shutil.rmtree(self.cache_dir)
+		os.symlink(self.temp_dir, self.cache_dir)
+		self.assertRaises(errors.CriticalError, artifactcache.ArtifactCache,
+			self.cache_dir, 10000)
+
+if __name__ == "__main__":
+	unittest.main()
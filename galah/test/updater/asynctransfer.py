@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.asynctransfer as asynctransfer
+import galah.updater.core.errors as errors
+import galah.updater.core.filetransfer as filetransfer
+import galah.updater.core.signatures as signatures
+
+# test helpers
+from webserver import get_pseudo_random_bytes
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import asynchat
+import asyncore
+import httplib
+import os
+import pkg_resources
+import random
+import shutil
+import socket
+import stat
+import StringIO
+import tempfile
+import threading
+import unittest
+
+class _StandInChannel(asynchat.async_chat):
+	def __init__(self, sock, server):
+		asynchat.async_chat.__init__(self, sock, map = server.socket_map)
+		self.server = server
+		self.set_terminator("\r\n\r\n")
+		self.buffer = []
+
+	def collect_incoming_data(self, data):
+		self.buffer.append(data)
+
+	def found_terminator(self):
+		path = "".join(self.buffer).split("\r\n")[0].split()[1]
+		body = self.server.files.get(path)
+		if body is None:
+			self.push("HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+		else:
+			length = self.server.lengths.get(path, len(body))
+			self.push("HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n" % (
+				length, ))
+			self.push(body)
+		self.close_when_done()
+
+class AsyncStandInServer(asyncore.dispatcher):
+	"""
+	A tiny event driven HTTP/1.0 server that serves files from memory on a
+	background thread.
+
+	:ivar files: A dictionary mapping paths to file contents.
+	:ivar lengths: A dictionary mapping paths to the `Content-Length` to
+			advertise when it should differ from the real length.
+
+	"""
+
+	def __init__(self, files):
+		self.socket_map = {}
+		asyncore.dispatcher.__init__(self, map = self.socket_map)
+		self.files = files
+		self.lengths = {}
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.set_reuse_addr()
+		self.bind(("127.0.0.1", 0))
+		self.listen(128)
+		self.address = "127.0.0.1:%d" % (self.socket.getsockname()[1], )
+		self._running = True
+		self._thread = threading.Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self):
+		while self._running:
+			asyncore.loop(timeout = 0.05, map = self.socket_map, count = 1)
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is not None:
+			_StandInChannel(pair[0], self)
+
+	def stop(self):
+		self._running = False
+		self._thread.join()
+		asyncore.close_all(self.socket_map)
+
+class TestTransferEngine(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		files = {}
+		signature = None
+		self.good = []
+		for i in xrange(int(os.environ.get("NFILES", 40))):
+			path = "/file%d" % (i, )
+			# Signing with a 16384 bit key is slow, so only do it once.
+			if signature is None:
+				body = get_pseudo_random_bytes(4096)
+				signature = signatures.sign_file(
+					StringIO.StringIO(body), self.key)
+			files[path] = body
+			files[path + ".sig"] = signature
+			self.good.append(path)
+		self.body = body
+
+		files["/no-sig"] = body
+		files["/bad-sig"] = body + "x"
+		files["/bad-sig.sig"] = signature
+		files["/truncated"] = body
+		files["/truncated.sig"] = signature
+		self.server = AsyncStandInServer(files)
+		self.server.lengths["/truncated"] = len(body) + 100
+
+		# Keep downloads somewhere we can check is left empty.
+		self.temp_dir = tempfile.mkdtemp()
+		self.old_tempdir, tempfile.tempdir = tempfile.tempdir, self.temp_dir
+
+	def tearDown(self):
+		self.server.stop()
+		tempfile.tempdir = self.old_tempdir
+		shutil.rmtree(self.temp_dir)
+
+	def make_request(self, path, max_size = 8192):
+		return filetransfer.FileRequest(self.server.address, path, self.key,
+			timeout = 5, max_size = max_size)
+
+	def test_run(self):
+		engine = asynctransfer.TransferEngine(max_concurrency = 16)
+		requests = [self.make_request(i) for i in self.good]
+		requests += [self.make_request(i) for i in
+			("/no-sig", "/bad-sig", "/missing")]
+		requests.append(self.make_request("/truncated", max_size = 10000))
+		requests.append(self.make_request(self.good[0], max_size = 100))
+
+		results = list(engine.run(requests))
+		self.assertEquals(len(results), len(requests))
+		failures = {}
+		for result in results:
+			if result.request.path in self.good and \
+					result.request.max_size > 100:
+				self.assertEquals(result.error, None)
+				st = os.lstat(result.file_path)
+				self.assertEquals(0400, stat.S_IMODE(st.st_mode))
+				with open(result.file_path, "rb") as f:
+					self.assertEquals(f.read(), self.body)
+				os.remove(result.file_path)
+				os.remove(result.sig_path)
+			else:
+				self.assertEquals(result.file_path, None)
+				failures[result.request.path] = type(result.error)
+		self.assertEquals(os.listdir(self.temp_dir), [])
+
+		self.assertEquals(failures, {
+			"/no-sig": errors.VerificationError,
+			"/bad-sig": errors.VerificationError,
+			"/missing": IOError,
+			"/truncated": httplib.IncompleteRead,
+			self.good[0]: IOError
+		})
+
+	def test_close_early(self):
+		engine = asynctransfer.TransferEngine(max_concurrency = 4)
+		results = engine.run([self.make_request(i) for i in self.good])
+		first = next(results)
+		results.close()
+
+		os.remove(first.file_path)
+		os.remove(first.sig_path)
+		self.assertEquals(os.listdir(self.temp_dir), [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -16,11 +16,12 @@ import os
 import unittest
 import errno
 import random
+import shutil
 import tempfile
 import stat
 
-# gicore
-import gicore.atomicfile
+# internal
+import galah.updater.core.atomicfile as atomicfile
 
 def create_temp_file():
     "Creates a temporary file, closes it, and returns the path to it."
@@ -43,7 +44,7 @@ class AtomicFileTest(unittest.TestCase):
 
     def test_write(self):
         expected = get_pseudo_random_bytes(256)
-        f = gicore.atomicfile.AtomicFile(self.temp_path)
+        f = atomicfile.AtomicFile(self.temp_path)
         f.write(expected)
         f.close()
 
@@ -52,7 +53,7 @@ class AtomicFileTest(unittest.TestCase):
 
     def test_discard(self):
         not_expected = get_pseudo_random_bytes(256)
-        f = gicore.atomicfile.AtomicFile(self.temp_path)
+        f = atomicfile.AtomicFile(self.temp_path)
         f.write(not_expected)
         f.discard()
 
@@ -63,29 +64,316 @@ class AtomicFileTest(unittest.TestCase):
         "Ensures that a file is closed after discard() is called."
 
         not_expected = get_pseudo_random_bytes(256)
-        f = gicore.atomicfile.AtomicFile(self.temp_path)
+        f = atomicfile.AtomicFile(self.temp_path)
         f.write(not_expected)
         f.discard()
         self.assertRaises(ValueError, f.write, get_pseudo_random_bytes(256))
 
     def test_close(self):
-        f = gicore.atomicfile.AtomicFile(self.temp_path)
+        f = atomicfile.AtomicFile(self.temp_path)
         f.write(get_pseudo_random_bytes(256))
         f.close()
         self.assertRaises(ValueError, f.write, get_pseudo_random_bytes(256))
 
     def test_with(self):
-        with gicore.atomicfile.AtomicFile(self.temp_path) as f:
+        with atomicfile.AtomicFile(self.temp_path) as f:
             f.write(get_pseudo_random_bytes(256))
         self.assertRaises(ValueError, f.write, get_pseudo_random_bytes(256))
 
     def test_permissions(self):
-        f = gicore.atomicfile.AtomicFile(self.temp_path)
+        f = atomicfile.AtomicFile(self.temp_path)
         f.write(get_pseudo_random_bytes(256))
         f.close()
 
         st_mode = stat.S_IMODE(os.lstat(self.temp_path).st_mode)
         self.assertEqual(st_mode, 0600)
 
+    def test_durability(self):
+        for durability in (atomicfile.DURABILITY_NONE,
+                atomicfile.DURABILITY_FILE):
+            expected = get_pseudo_random_bytes(256)
+            with atomicfile.AtomicFile(self.temp_path,
+                    durability = durability) as f:
+                f.write(expected)
+            with open(self.temp_path, "rb") as f:
+                self.assertEqual(f.read(), expected)
+
+        self.assertRaises(ValueError, atomicfile.AtomicFile, self.temp_path,
+            durability = "sometimes")
+        self.assertRaises(ValueError, atomicfile.AtomicFile, self.temp_path,
+            durability = atomicfile.DURABILITY_GROUP)
+
+    def test_expected_size(self):
+        block = atomicfile.WRITE_BLOCK_SIZE
+        data = get_pseudo_random_bytes(1000)
+
+        # Smaller than expected (with writes that span blocks), exactly as
+        # expected, and larger than expected.
+        for size, expected_size in ((3 * block + 500, 4 * block),
+                (block, block), (2000, 1000)):
+            f = atomicfile.AtomicFile(self.temp_path,
+                expected_size = expected_size)
+            written = []
+            while sum(len(i) for i in written) < size:
+                chunk = data[:size - sum(len(i) for i in written)]
+                f.write(memoryview(bytearray(chunk)))
+                written.append(chunk)
+            f.flush()
+            self.assertEqual(os.path.getsize(f.temp_path), size)
+            f.close()
+            with open(self.temp_path, "rb") as f:
+                self.assertEqual(f.read(), "".join(written))
+
+        # Coalesced writes are still discarded.
+        f = atomicfile.AtomicFile(self.temp_path, expected_size = 10)
+        f.write("discarded")
+        temp_path = f.temp_path
+        f.discard()
+        self.assertFalse(os.path.exists(temp_path))
+        with open(self.temp_path, "rb") as f:
+            self.assertEqual(f.read(), "".join(written))
+
+    def test_no_space(self):
+        posix_fallocate = atomicfile._posix_fallocate
+        def full(fd, offset, length):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        def unsupported(fd, offset, length):
+            raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, "file")
+            atomicfile._posix_fallocate = full
+            try:
+                self.assertRaises(OSError, atomicfile.AtomicFile, path,
+                    expected_size = 1024)
+            finally:
+                atomicfile._posix_fallocate = posix_fallocate
+            self.assertEqual(os.listdir(temp_dir), [])
+
+            # Filesystems that can't preallocate are fine.
+            atomicfile._posix_fallocate = unsupported
+            try:
+                with atomicfile.AtomicFile(path, expected_size = 1024) as f:
+                    f.write("data")
+            finally:
+                atomicfile._posix_fallocate = posix_fallocate
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), "data")
+        finally:
+            shutil.rmtree(temp_dir)
+
+class CommitGroupTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in ("a", "b"):
+            os.mkdir(os.path.join(self.temp_dir, i))
+            for j in xrange(3):
+                self.paths.append(os.path.join(self.temp_dir, i, str(j)))
+
+        # Count the directory syncs.
+        self.synced_dirs = []
+        self._fsync_dir = atomicfile._fsync_dir
+        def fsync_dir(path):
+            self.synced_dirs.append(path)
+            self._fsync_dir(path)
+        atomicfile._fsync_dir = fsync_dir
+
+    def tearDown(self):
+        atomicfile._fsync_dir = self._fsync_dir
+        shutil.rmtree(self.temp_dir)
+
+    def test_commit(self):
+        expected = {}
+        with atomicfile.CommitGroup() as group:
+            for path in self.paths:
+                expected[path] = get_pseudo_random_bytes(256)
+                with group.open(path) as f:
+                    f.write(expected[path])
+                self.assertRaises(ValueError, f.write, "x")
+
+            # Nothing is in place until the group is committed.
+            self.assertEqual(len(group), len(self.paths))
+            self.assertFalse(any(os.path.exists(i) for i in self.paths))
+
+        for path in self.paths:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), expected[path])
+        self.assertEqual(sorted(self.synced_dirs),
+            [os.path.join(self.temp_dir, i) for i in ("a", "b")])
+
+    def test_open_file(self):
+        group = atomicfile.CommitGroup()
+        f = atomicfile.AtomicFile(self.paths[0], group = group)
+        self.assertRaises(ValueError, group.commit)
+        f.close()
+        group.commit()
+        self.assertTrue(os.path.exists(self.paths[0]))
+
+    def test_discard(self):
+        try:
+            with atomicfile.CommitGroup() as group:
+                with group.open(self.paths[0]) as f:
+                    f.write("closed")
+                group.open(self.paths[1]).write("still open")
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+
+        # No trace is left of either file.
+        for i in ("a", "b"):
+            self.assertEqual(os.listdir(os.path.join(self.temp_dir, i)), [])
+
+    def test_failed_rename(self):
+        group = atomicfile.CommitGroup()
+        for path in self.paths:
+            with group.open(path) as f:
+                f.write("data")
+
+        rename = os.rename
+        renames = []
+        def failing_rename(src, dst):
+            renames.append(dst)
+            if len(renames) == 2:
+                raise OSError(errno.EIO, os.strerror(errno.EIO))
+            rename(src, dst)
+        os.rename = failing_rename
+        try:
+            self.assertRaises(OSError, group.commit)
+        finally:
+            os.rename = rename
+
+        # The first file made it into place, and nothing else is left.
+        self.assertEqual(sorted(os.listdir(os.path.join(self.temp_dir, "a"))),
+            [os.path.basename(renames[0])])
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, "b")), [])
+
+class Crash(Exception):
+    "Stands in for the process dying."
+
+class AtomicTransactionTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+        self.temp_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.temp_dir, "journal")
+        for i in ("config", "scripts"):
+            os.mkdir(os.path.join(self.temp_dir, i))
+
+        # Two files being replaced and one being added.
+        self.old = {}
+        for i in ("config/galah.yml", "scripts/run.sh"):
+            self.old[os.path.join(self.temp_dir, i)] = \
+                get_pseudo_random_bytes(256)
+        for path, contents in self.old.items():
+            with open(path, "wb") as f:
+                f.write(contents)
+        self.new = dict((i, get_pseudo_random_bytes(256)) for i in
+            self.old.keys() + [os.path.join(self.temp_dir, "scripts/new.sh")])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def stage(self):
+        transaction = atomicfile.AtomicTransaction(self.journal_path)
+        for path, contents in sorted(self.new.items()):
+            with transaction.open(path) as f:
+                f.write(contents)
+        return transaction
+
+    def assert_files(self, expected):
+        "Checks that the tree holds exactly `expected` and nothing else."
+
+        found = {}
+        for dir_path, _, file_names in os.walk(self.temp_dir):
+            for i in file_names:
+                with open(os.path.join(dir_path, i), "rb") as f:
+                    found[os.path.join(dir_path, i)] = f.read()
+        self.assertEqual(sorted(found), sorted(expected))
+        self.assertEqual(found, expected)
+
+    def test_commit(self):
+        self.stage().commit()
+        self.assert_files(self.new)
+        self.assertEqual(
+            atomicfile.AtomicTransaction.recover(self.journal_path), None)
+
+    def test_failed_commit(self):
+        transaction = self.stage()
+        rename = os.rename
+        renames = []
+        def failing_rename(src, dst):
+            renames.append(dst)
+            if len(renames) == 2:
+                raise OSError(errno.EIO, "Simulated failure")
+            rename(src, dst)
+        os.rename = failing_rename
+        try:
+            self.assertRaises(OSError, transaction.commit)
+        finally:
+            os.rename = rename
+        self.assert_files(self.old)
+
+    def test_crash_before_committed(self):
+        transaction = self.stage()
+        write_journal = transaction._write_journal
+        def crashing_write_journal(state, entries):
+            if state == atomicfile._COMMITTED:
+                raise Crash()
+            write_journal(state, entries)
+        transaction._write_journal = crashing_write_journal
+        self.assertRaises(Crash, transaction.commit)
+
+        # Every file was replaced, but the commit never completed.
+        self.assertRaises(RuntimeError, atomicfile.AtomicTransaction,
+            self.journal_path)
+        self.assertEqual(
+            atomicfile.AtomicTransaction.recover(self.journal_path),
+            "rolled-back")
+        self.assert_files(self.old)
+
+    def test_crash_after_committed(self):
+        transaction = self.stage()
+        roll_forward = atomicfile._roll_forward
+        def crash(entries):
+            raise Crash()
+        atomicfile._roll_forward = crash
+        try:
+            self.assertRaises(Crash, transaction.commit)
+        finally:
+            atomicfile._roll_forward = roll_forward
+
+        self.assertEqual(
+            atomicfile.AtomicTransaction.recover(self.journal_path),
+            "rolled-forward")
+        self.assert_files(self.new)
+
+    def test_crash_before_rename(self):
+        # The process dies once the originals have been backed up (so
+        # without getting to roll back either).
+        transaction = self.stage()
+        rename = os.rename
+        roll_back = atomicfile._roll_back
+        def crash(*args):
+            raise Crash()
+        def crashing_rename(src, dst):
+            if dst in self.new:
+                raise Crash()
+            rename(src, dst)
+        os.rename = crashing_rename
+        atomicfile._roll_back = crash
+        try:
+            self.assertRaises(Crash, transaction.commit)
+        finally:
+            os.rename = rename
+            atomicfile._roll_back = roll_back
+
+        # The staged files and backups are tidied up too.
+        self.assertEqual(
+            atomicfile.AtomicTransaction.recover(self.journal_path),
+            "rolled-back")
+        self.assert_files(self.old)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+"""
+A reproducible benchmark suite for the expensive parts of an update: signing
+and verifying files, receiving them from a (local) server, and committing
+them to disk with `AtomicFile`.
+
+Every benchmark is run over a sweep of parameters, taking the best of
+`REPEAT` runs, and the results are printed as a table. They can also be
+written out as JSON and compared against a previous run to catch
+regressions. The suite is configured through environment variables:
+
+* `KEY_SIZES`: Comma separated RSA key sizes in bits (default
+  `2048,4096,16384`). The 16384-bit key is the test key in `data`, others
+  are generated (deterministically, see `RANDOM_SEED`).
+* `FILE_SIZES`: Comma separated file sizes in bytes.
+* `CHUNK_SIZES`: Comma separated sizes of the first read when receiving a
+  file, and of the writes made to an `AtomicFile`.
+* `DURABILITIES`: Comma separated `AtomicFile` durability modes (default
+  `none,file,group`).
+* `FILE_COUNT`: How many small files `atomicfile_many` writes (default
+  1000).
+* `REPEAT`: How many times to run each benchmark (default 3).
+* `BENCHMARKS`: Comma separated names of the benchmarks to run (default
+  all of them: `sign_file`, `verify_file`, `verify_rsa`, `get_file_simple`,
+  `atomicfile`, `atomicfile_sized` and `atomicfile_many`).
+* `OUTPUT`: A path to write the results to as JSON.
+* `BASELINE`: The path of a previous run's `OUTPUT` to compare against.
+  The script exits with status 1 if any benchmark got slower by more than
+  `TOLERANCE` (a fraction, default 0.25).
+
+`verify_rsa` times `signatures.verify_file()` given a precomputed hash, so
+it measures just the RSA operation: compared with `verify_file` it shows how
+much of verifying an archive is spent hashing it and how much checking the
+signature. `atomicfile_sized` is `atomicfile` with the file's size given
+up front, so it is preallocated and its writes coalesced, which shows what
+that saves for small chunks. `atomicfile_many` writes `FILE_COUNT` 4 KiB
+files spread over ten directories in each durability mode, which shows what
+syncing costs an install and how much of it a `CommitGroup` saves.
+
+This replaces a one-off profile of verifying a 100 KB message, which had
+found the RSA operation with a 16384-bit key to be negligible.
+
+"""
+
+# internal
+import galah.updater.core.atomicfile as atomicfile
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.filetransfer as filetransfer
+import galah.updater.core.signatures as signatures
+
+# test helpers
+from webserver import (ForkingWebServer, KeepAliveHandler,
+	get_pseudo_random_bytes)
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import json
+import os
+import pkg_resources
+import platform
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+# Bumped whenever results stop being comparable with older ones.
+RESULTS_VERSION = 1
+
+LISTEN_ON = ("127.0.0.1", 8903)
+
+def get_list(name, default):
+	return [int(i) for i in os.environ.get(name, default).split(",")]
+
+def make_key(bits):
+	if bits == 16384:
+		return Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+	return Crypto.PublicKey.RSA.generate(bits,
+		randfunc = get_pseudo_random_bytes)
+
+# Generating pseudo random data in Python is slow, so one block of it is made
+# (from `RANDOM_SEED`) and repeated. See `get_data()`.
+_block = None
+
+def get_data(nbytes):
+	"Returns `nbytes` bytes of (reproducible) random but repetitive data."
+
+	global _block
+	if _block is None:
+		_block = get_pseudo_random_bytes(1024 * 1024)
+	return (_block * (nbytes // len(_block) + 1))[:nbytes]
+
+def make_file(directory, size):
+	"Writes a file of `size` (random but repetitive) bytes. Returns its path."
+
+	path = os.path.join(directory, "file-%d" % (size, ))
+	if not os.path.exists(path):
+		block = get_data(1024 * 1024)
+		with open(path, "wb") as f:
+			for i in xrange(size // len(block)):
+				f.write(block)
+			f.write(block[:size % len(block)])
+	return path
+
+def best_of(repeat, setup, run):
+	"""
+	Calls `setup()` and then times `run(setup())` `repeat` times.
+
+	:returns: The fastest time in seconds.
+
+	"""
+
+	best = None
+	for i in xrange(repeat):
+		arg = setup()
+		start = time.time()
+		run(arg)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def bench_sign_file(config, results):
+	for bits in config["key_sizes"]:
+		key = config["keys"][bits]
+		for size in config["file_sizes"]:
+			path = make_file(config["temp_dir"], size)
+			def run(f):
+				with f:
+					signatures.sign_file(f, key)
+			results.add("sign_file", {"key_size": bits, "file_size": size},
+				best_of(config["repeat"], lambda: open(path, "rb"), run),
+				size)
+
+def bench_verify_file(config, results):
+	for bits in config["key_sizes"]:
+		key = config["keys"][bits]
+		for size in config["file_sizes"]:
+			path = make_file(config["temp_dir"], size)
+			with open(path, "rb") as f:
+				signature = signatures.sign_file(f, key)
+			def run(f):
+				with f:
+					assert signatures.verify_file(f,
+						StringIO.StringIO(signature), key)
+			results.add("verify_file", {"key_size": bits, "file_size": size},
+				best_of(config["repeat"], lambda: open(path, "rb"), run),
+				size)
+
+def bench_verify_rsa(config, results):
+	message = get_pseudo_random_bytes(1024)
+	for bits in config["key_sizes"]:
+		key = config["keys"][bits]
+		signature = signatures.sign_file(StringIO.StringIO(message), key)
+		def run(file_hash):
+			assert signatures.verify_file(None,
+				StringIO.StringIO(signature), key, file_hash = file_hash)
+		results.add("verify_rsa", {"key_size": bits},
+			best_of(config["repeat"],
+				lambda: signatures.new_hash().new(message), run))
+
+def bench_get_file_simple(config, results):
+	serve_dir = os.path.join(config["temp_dir"], "served")
+	os.mkdir(serve_dir)
+	for size in config["file_sizes"]:
+		os.link(make_file(config["temp_dir"], size),
+			os.path.join(serve_dir, "file-%d" % (size, )))
+
+	httpd = ForkingWebServer(LISTEN_ON, serve_directory = serve_dir,
+		handler = KeepAliveHandler)
+	httpd.start()
+	pool = connectionpool.ConnectionPool()
+	try:
+		time.sleep(2)
+		for size in config["file_sizes"]:
+			for chunk_size in config["chunk_sizes"]:
+				def run(con):
+					try:
+						os.remove(filetransfer._get_file_simple(con,
+							"/file-%d" % (size, ), size,
+							signatures.new_hash(), chunk_size = chunk_size))
+					finally:
+						pool.release(con)
+				results.add("get_file_simple",
+					{"file_size": size, "chunk_size": chunk_size},
+					best_of(config["repeat"],
+						lambda: pool.acquire("%s:%d" % LISTEN_ON, 5), run),
+					size)
+	finally:
+		pool.clear()
+		httpd.stop()
+
+def open_atomic_file(path, durability, group = None, expected_size = None):
+	if durability == atomicfile.DURABILITY_GROUP:
+		return group.open(path, expected_size = expected_size)
+	return atomicfile.AtomicFile(path, durability = durability,
+		expected_size = expected_size)
+
+def _bench_atomicfile(config, results, name, sized):
+	path = os.path.join(config["temp_dir"], "committed")
+	for durability in config["durabilities"]:
+		for size in config["file_sizes"]:
+			for chunk_size in config["chunk_sizes"]:
+				chunk = get_data(chunk_size)
+				def run(group):
+					f = open_atomic_file(path, durability, group,
+						size if sized else None)
+					written = 0
+					while written < size:
+						f.write(chunk[:size - written])
+						written += chunk_size
+					f.close()
+					group.commit()
+				results.add(name, {"durability": durability,
+					"file_size": size, "chunk_size": chunk_size},
+					best_of(config["repeat"], atomicfile.CommitGroup, run),
+					size)
+
+def bench_atomicfile(config, results):
+	_bench_atomicfile(config, results, "atomicfile", False)
+
+def bench_atomicfile_sized(config, results):
+	_bench_atomicfile(config, results, "atomicfile_sized", True)
+
+def bench_atomicfile_many(config, results):
+	directories = [os.path.join(config["temp_dir"], "many-%d" % (i, ))
+		for i in xrange(10)]
+	for i in directories:
+		os.mkdir(i)
+	data = get_data(4096)
+	for durability in config["durabilities"]:
+		def run(group):
+			for i in xrange(config["file_count"]):
+				f = open_atomic_file(os.path.join(
+					directories[i % len(directories)], str(i)), durability,
+					group)
+				f.write(data)
+				f.close()
+			group.commit()
+		results.add("atomicfile_many", {"durability": durability,
+			"file_count": config["file_count"]},
+			best_of(config["repeat"], atomicfile.CommitGroup, run),
+			config["file_count"] * len(data))
+
+BENCHMARKS = [
+	("sign_file", bench_sign_file),
+	("verify_file", bench_verify_file),
+	("verify_rsa", bench_verify_rsa),
+	("get_file_simple", bench_get_file_simple),
+	("atomicfile", bench_atomicfile),
+	("atomicfile_sized", bench_atomicfile_sized),
+	("atomicfile_many", bench_atomicfile_many)
+]
+
+def _result_key(result):
+	return result["name"], tuple(sorted(result["params"].items()))
+
+class Results(object):
+	"Collects results, printing each one as it comes in."
+
+	def __init__(self, baseline = None, tolerance = 0.25):
+		self.results = []
+		self.regressions = []
+		self.tolerance = tolerance
+		self._baseline = {}
+		if baseline is not None:
+			if baseline.get("version") != RESULTS_VERSION:
+				raise ValueError("Baseline is from an incompatible version.")
+			self._baseline = dict((_result_key(i), i)
+				for i in baseline["results"])
+
+	def add(self, name, params, seconds, nbytes = None):
+		result = {"name": name, "params": params, "seconds": seconds}
+		if nbytes is not None and seconds > 0:
+			result["mib_per_s"] = nbytes / seconds / (1024 * 1024)
+		self.results.append(result)
+
+		line = "%-16s %-44s %10.4f s" % (name,
+			" ".join("%s=%s" % i for i in sorted(params.items())), seconds)
+		if "mib_per_s" in result:
+			line += " %10.1f MiB/s" % (result["mib_per_s"], )
+		base = self._baseline.get(_result_key(result))
+		if base is not None:
+			change = seconds / base["seconds"] - 1 if base["seconds"] else 0
+			line += " %+7.1f%%" % (change * 100, )
+			if change > self.tolerance:
+				line += " REGRESSION"
+				self.regressions.append(result)
+		print line
+		sys.stdout.flush()
+
+	def dump(self, f):
+		json.dump({
+			"version": RESULTS_VERSION,
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"created": time.time(),
+			"results": self.results
+		}, f, indent = 1, sort_keys = True)
+
+def main():
+	random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+	names = os.environ.get("BENCHMARKS")
+	names = names.split(",") if names else [i[0] for i in BENCHMARKS]
+	unknown = set(names) - set(i[0] for i in BENCHMARKS)
+	if unknown:
+		sys.exit("Unknown benchmarks: %s" % (", ".join(sorted(unknown)), ))
+
+	config = {
+		"key_sizes": get_list("KEY_SIZES", "2048,4096,16384"),
+		"file_sizes": get_list("FILE_SIZES", "102400,8388608,67108864"),
+		"chunk_sizes": get_list("CHUNK_SIZES", "16384,1048576"),
+		"durabilities": os.environ.get("DURABILITIES",
+			"none,file,group").split(","),
+		"file_count": int(os.environ.get("FILE_COUNT", 1000)),
+		"repeat": int(os.environ.get("REPEAT", 3)),
+		"temp_dir": tempfile.mkdtemp()
+	}
+	if set(names) & set(["sign_file", "verify_file", "verify_rsa"]):
+		config["keys"] = dict((i, make_key(i)) for i in config["key_sizes"])
+
+	baseline = None
+	if os.environ.get("BASELINE"):
+		with open(os.environ["BASELINE"], "rb") as f:
+			baseline = json.load(f)
+	results = Results(baseline, float(os.environ.get("TOLERANCE", 0.25)))
+
+	print "Best of %d runs" % (config["repeat"], )
+	try:
+		for name, bench in BENCHMARKS:
+			if name in names:
+				bench(config, results)
+	finally:
+		shutil.rmtree(config["temp_dir"])
+
+	if os.environ.get("OUTPUT"):
+		with atomicfile.AtomicFile(os.environ["OUTPUT"]) as f:
+			results.dump(f)
+
+	if results.regressions:
+		print "%d benchmark(s) regressed by more than %d%%." % (
+			len(results.regressions), results.tolerance * 100)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
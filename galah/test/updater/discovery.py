@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.discovery as discovery
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.errors as errors
+
+# test helpers
+from webserver import ForkingWebServer, RangeHandler, make_signed_file
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import os
+import pkg_resources
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+class TestListingCache(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.serve_dir = os.path.join(self.temp_dir, "serve")
+		self.cache_dir = os.path.join(self.temp_dir, "cache")
+		os.mkdir(self.serve_dir)
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		self.listing_path = make_signed_file(self.serve_dir,
+			"version-listing.json", 4096, self.key)
+
+		self.listen_on = ("127.0.0.1", 8891)
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.serve_dir, handler = RangeHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+	def tearDown(self):
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+
+	def get(self, cache):
+		return cache.get(
+			server = "%s:%d" % self.listen_on,
+			path = "/version-listing.json",
+			pub_key = self.key,
+			timeout = 5,
+			max_size = 8192,
+			pool = connectionpool.ConnectionPool()
+		)
+
+	def get_requests(self):
+		with open(os.path.join(self.serve_dir, "requests.log"), "rb") as f:
+			return [i for i in f.read().splitlines() if not i.endswith(".sig")]
+
+	def read_listing(self):
+		with open(self.listing_path, "rb") as f:
+			return f.read()
+
+	def check_revalidation(self, cache, revalidate_request):
+		self.assertEquals(self.get(cache), self.read_listing())
+		self.assertEquals(self.get(cache), self.read_listing())
+		self.assertEquals(cache.stats, {"fresh": 1, "downloaded": 1})
+		self.assertEquals(self.get_requests(),
+			["GET /version-listing.json", revalidate_request])
+
+		# A new listing is picked up, even by a fresh cache object.
+		time.sleep(1) # Last-Modified only has a resolution of a second
+		make_signed_file(self.serve_dir, "version-listing.json", 4096,
+			self.key)
+		cache = discovery.ListingCache(self.cache_dir, cache.revalidate)
+		self.assertEquals(self.get(cache), self.read_listing())
+		self.assertEquals(cache.stats, {"fresh": 0, "downloaded": 1})
+		self.assertEquals(self.get(cache), self.read_listing())
+		self.assertEquals(cache.stats, {"fresh": 1, "downloaded": 1})
+
+	def test_head(self):
+		self.check_revalidation(discovery.ListingCache(self.cache_dir),
+			"HEAD /version-listing.json")
+
+	def test_conditional(self):
+		self.check_revalidation(discovery.ListingCache(self.cache_dir,
+			discovery.REVALIDATE_CONDITIONAL), "GET /version-listing.json")
+
+	def test_bad_listing(self):
+		cache = discovery.ListingCache(self.cache_dir)
+		self.get(cache)
+
+		# A forged update must not replace the cached listing.
+		time.sleep(1)
+		with open(self.listing_path, "ab") as f:
+			f.write("forged")
+		self.assertRaises(errors.VerificationError, self.get, cache)
+		self.assertEquals(cache._load("%s:%d" % self.listen_on,
+			"/version-listing.json")["document"], self.read_listing()[:-6])
+
+if __name__ == "__main__":
+	unittest.main()
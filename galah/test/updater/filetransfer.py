@@ -4,81 +4,31 @@
 import galah.updater.core.signatures as signatures
 import galah.updater.core.filetransfer as filetransfer
 import galah.updater.core.errors as errors
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.artifactcache as artifactcache
+import galah.updater.core.atomicfile as atomicfile
+
+# test helpers
+from webserver import (ForkingWebServer, KeepAliveHandler, RangeHandler,
+	get_pseudo_random_bytes, make_signed_file)
 
 # pycrypto
 import Crypto.PublicKey.RSA
 
 # stdlib
-import multiprocessing
 import stat
 import httplib
 import tempfile
 import pkg_resources
 import os
-import signal
 import unittest
 import random
-import SimpleHTTPServer
-import SocketServer
 import socket
 import shutil
 import time
-
-class ForkingWebServer:
-	"""
-	Simple web server for testing purposes.
-
-	:ivar listen_on: A tuple `(address, port)`.
-	:ivar serve_directory: The directory to serve files from.
-
-	:warning: This is not for serious use and was only made for use by this
-			unit testing module. Usage outside of this context is a bad idea.
-
-	"""
-
-	def __init__(self, listen_on, serve_directory):
-		self.listen_on = listen_on
-		self.serve_directory = serve_directory
-		self._process = None
-
-	def _run_server(self):
-		os.chdir(self.serve_directory)
-
-		class ReusableTCPServer(SocketServer.TCPServer):
-			allow_reuse_address = True
-			__init__ = SocketServer.TCPServer.__init__
-		httpd = ReusableTCPServer(self.listen_on,
-			SimpleHTTPServer.SimpleHTTPRequestHandler)
-		try:
-			httpd.serve_forever()
-		except KeyboardInterrupt:
-			return
-		assert False
-
-	def start(self):
-		if self._process is not None:
-			raise RuntimeError("Process still running.")
-		self._process = multiprocessing.Process(
-			target = ForkingWebServer._run_server, args = (self, ))
-		self._process.daemon = True
-		self._process.start()
-
-	def stop(self):
-		if self._process is None:
-			raise RuntimeError("Process is already stopped/stopping.")
-		os.kill(self._process.pid, signal.SIGINT)
-		self._process.join()
-		assert not self._process.is_alive()
-		self._process = None
-
-	def __del__(self):
-		try:
-			self.stop()
-		except RuntimeError:
-			pass
-
-def get_pseudo_random_bytes(nbytes):
-	return "".join([chr(random.getrandbits(8)) for i in xrange(nbytes)])
+import io
+import zlib
+import errno
 
 class TestFileTransfer(unittest.TestCase):
 	def setUp(self):
@@ -163,12 +113,19 @@ class TestFileTransfer(unittest.TestCase):
 		con = httplib.HTTPConnection(self.listen_on[0], self.listen_on[1],
 			timeout = 5)
 		for i in self.test_files:
+			file_hash = signatures.new_hash()
 			retrieved_file = filetransfer._get_file_simple(
 				con = con,
 				path = "/" + i,
-				max_size = int(os.environ.get("FILE_SIZE", 2048)) + 256
+				max_size = int(os.environ.get("FILE_SIZE", 2048)) + 256,
+				file_hash = file_hash
 			)
 
+			# Check the hash was computed over the whole file
+			with open(os.path.join(self.temp_dir, i), "rb") as original:
+				self.assertEquals(file_hash.hexdigest(),
+					signatures._hash_file_sha512(original).hexdigest())
+
 			# Check permissions
 			stat_results = os.lstat(retrieved_file)
 			mode = stat_results.st_mode
@@ -218,5 +175,586 @@ class TestFileTransfer(unittest.TestCase):
 				max_size = int(os.environ.get("FILE_SIZE", 2048)) + 256
 			)
 
+	def test_get_file_signature_first(self):
+		file_size = int(os.environ.get("FILE_SIZE", 2048))
+		for i in self.test_files:
+			file_path, sig_path = filetransfer.get_file(
+				server = "%s:%d" % self.listen_on,
+				path = "/" + i,
+				pub_key = self.key,
+				timeout = 5,
+				max_size = file_size + 256,
+				signature_first = True
+			)
+			os.remove(file_path)
+			os.remove(sig_path)
+
+		# A truncated signature is rejected without checking the file.
+		truncated = os.path.join(self.temp_dir, "truncated-sig.txt")
+		with open(truncated, "wb") as f:
+			f.write(get_pseudo_random_bytes(file_size))
+		with open(os.path.join(self.temp_dir, self.test_files[0] + ".sig"),
+				"rb") as f:
+			sig = f.read()
+		with open(truncated + ".sig", "wb") as f:
+			f.write(sig[:-1])
+
+		# The files are too big to download, so if the signature weren't
+		# retrieved first we would see an IOError instead.
+		for i in self.no_sig_test_files + ["truncated-sig.txt"]:
+			self.assertRaises(errors.VerificationError,
+				filetransfer.get_file,
+				server = "%s:%d" % self.listen_on,
+				path = "/" + i,
+				pub_key = self.key,
+				timeout = 5,
+				max_size = file_size - 1,
+				signature_first = True
+			)
+
+	def test_get_file_cache(self):
+		cache = artifactcache.ArtifactCache(
+			os.path.join(self.temp_dir, "cache"), 1024 * 1024)
+		pool = connectionpool.ConnectionPool()
+		for attempt in xrange(2):
+			for i in self.test_files:
+				file_path, sig_path = filetransfer.get_file(
+					server = "%s:%d" % self.listen_on,
+					path = "/" + i,
+					pub_key = self.key,
+					timeout = 5,
+					max_size = int(os.environ.get("FILE_SIZE", 2048)) + 256,
+					pool = pool,
+					cache = cache
+				)
+				with open(os.path.join(self.temp_dir, i), "rb") as original:
+					with open(file_path, "rb") as received:
+						self.compare_files(original, received)
+				os.remove(file_path)
+				os.remove(sig_path)
+
+		# The second time around nothing should have touched the network.
+		self.assertEquals(cache.stats["hits"], len(self.test_files))
+		self.assertEquals(cache.stats["stores"], len(self.test_files))
+		self.assertEquals(pool.stats["hits"] + pool.stats["misses"],
+			len(self.test_files))
+
+	def test_get_file_destination(self):
+		install_dir = os.path.join(self.temp_dir, "install")
+		os.mkdir(install_dir)
+		destination = os.path.join(install_dir, "installed.txt")
+		with open(destination, "wb") as f:
+			f.write("old")
+		cache = artifactcache.ArtifactCache(
+			os.path.join(self.temp_dir, "cache"), 1024 * 1024)
+		def get_file(name):
+			return filetransfer.get_file(
+				server = "%s:%d" % self.listen_on,
+				path = "/" + name,
+				pub_key = self.key,
+				timeout = 5,
+				max_size = int(os.environ.get("FILE_SIZE", 2048)) + 256,
+				cache = cache,
+				destination = destination
+			)
+
+		# A file that fails verification never replaces the old one.
+		for i in self.no_sig_test_files + self.bad_sig_test_files:
+			self.assertRaises(errors.VerificationError, get_file, i)
+			self.assertEquals(os.listdir(install_dir), ["installed.txt"])
+			with open(destination, "rb") as f:
+				self.assertEquals(f.read(), "old")
+
+		# A full disk is noticed before the file is received.
+		posix_fallocate = atomicfile._posix_fallocate
+		def full(fd, offset, length):
+			raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+		atomicfile._posix_fallocate = full
+		try:
+			self.assertRaises(OSError, get_file, self.test_files[0])
+		finally:
+			atomicfile._posix_fallocate = posix_fallocate
+		self.assertEquals(os.listdir(install_dir), ["installed.txt"])
+
+		# The file is received next to its destination and committed with a
+		# single rename.
+		rename = os.rename
+		renames = []
+		def recording_rename(src, dst):
+			renames.append((src, dst))
+			rename(src, dst)
+		os.rename = recording_rename
+		try:
+			file_path, sig_path = get_file(self.test_files[0])
+		finally:
+			os.rename = rename
+		os.remove(sig_path)
+		self.assertEquals(file_path, destination)
+		renames = [i for i in renames if i[1] == destination]
+		self.assertEquals(len(renames), 1)
+		self.assertEquals(os.path.dirname(renames[0][0]), install_dir)
+		self.assertEquals(os.listdir(install_dir), ["installed.txt"])
+		with open(os.path.join(self.temp_dir, self.test_files[0]),
+				"rb") as original:
+			with open(destination, "rb") as received:
+				self.compare_files(original, received)
+
+		# Changing the installed file in place leaves the cache's copy alone,
+		# both for a file that was downloaded and one copied out of the
+		# cache.
+		url = "http://%s:%d/%s" % (self.listen_on + (self.test_files[0], ))
+		for i in xrange(2):
+			self.assertEquals(
+				stat.S_IMODE(os.lstat(destination).st_mode), 0600)
+			with open(destination, "r+b") as f:
+				f.write("x")
+			cached = cache.checkout(url)
+			self.assertNotEquals(cached, None)
+			filetransfer._remove_quietly(*[j for j in cached if j is not None])
+			self.assertEquals(cache.stats["integrity_failures"], 0)
+
+			os.remove(destination)
+			file_path, sig_path = get_file(self.test_files[0])
+			os.remove(sig_path)
+			self.assertEquals(cache.stats["hits"], 2 * (i + 1))
+			with open(os.path.join(self.temp_dir, self.test_files[0]),
+					"rb") as original:
+				with open(destination, "rb") as received:
+					self.compare_files(original, received)
+
+	def test_get_document(self):
+		file_size = int(os.environ.get("FILE_SIZE", 2048))
+		def get_document(path, **kwargs):
+			kwargs.setdefault("max_size", file_size + 256)
+			return filetransfer.get_document(
+				server = "%s:%d" % self.listen_on,
+				path = path,
+				pub_key = self.key,
+				timeout = 5,
+				**kwargs
+			)
+
+		# Small documents must never touch the disk.
+		mkstemp = tempfile.mkstemp
+		def no_mkstemp(*args, **kwargs):
+			self.fail("Document was written to disk.")
+		tempfile.mkstemp = no_mkstemp
+		try:
+			for i in self.test_files:
+				with open(os.path.join(self.temp_dir, i), "rb") as original:
+					self.assertEquals(get_document("/" + i), original.read())
+		finally:
+			tempfile.mkstemp = mkstemp
+
+		# Larger ones spill over into a temporary file.
+		for i in self.test_files:
+			with open(os.path.join(self.temp_dir, i), "rb") as original:
+				self.assertEquals(get_document("/" + i, memory_limit = 100),
+					original.read())
+
+		for i in self.no_sig_test_files + self.bad_sig_test_files:
+			self.assertRaises(errors.VerificationError, get_document, "/" + i)
+		self.assertRaises(IOError, get_document, "/" + self.test_files[0],
+			max_size = file_size - 1)
+
+		# The signature can be had too.
+		path = os.path.join(self.temp_dir, self.test_files[0])
+		document, signature = filetransfer.get_signed_document(
+			"%s:%d" % self.listen_on, "/" + self.test_files[0], self.key, 5,
+			file_size + 256)
+		self.assertEquals(document, open(path, "rb").read())
+		self.assertEquals(signature, open(path + ".sig", "rb").read())
+
+	def test_get_files(self):
+		def make_request(name):
+			return filetransfer.FileRequest(
+				server = "%s:%d" % self.listen_on,
+				path = "/" + name,
+				pub_key = self.key,
+				timeout = 5,
+				max_size = int(os.environ.get("FILE_SIZE", 2048)) + 256
+			)
+		good = self.test_files
+		bad = self.no_sig_test_files + self.bad_sig_test_files
+		requests = [make_request(i) for i in good + bad]
+
+		results = list(filetransfer.get_files(requests, max_workers = 3,
+			per_host_limit = 2))
+		self.assertEquals(len(results), len(requests))
+		for result in results:
+			name = result.request.path[1:]
+			if name in good:
+				self.assertEquals(result.error, None)
+				with open(os.path.join(self.temp_dir, name), "rb") as original:
+					with open(result.file_path, "rb") as received:
+						self.compare_files(original, received)
+				os.remove(result.file_path)
+				os.remove(result.sig_path)
+			else:
+				self.assertTrue(
+					isinstance(result.error, errors.VerificationError))
+				self.assertEquals(result.file_path, None)
+
+class TestReceive(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.body = get_pseudo_random_bytes(100000)
+
+	def check_receive(self, make_response):
+		for chunk_size in (1, 1000, filetransfer.MAX_CHUNK_SIZE * 2):
+			received = io.BytesIO()
+			file_hash = signatures.new_hash()
+			nbytes = filetransfer._receive(make_response(self.body), received,
+				len(self.body), file_hash, chunk_size)
+			self.assertEquals(nbytes, len(self.body))
+			self.assertEquals(received.getvalue(), self.body)
+			self.assertEquals(file_hash.hexdigest(), signatures._hash_file_sha512(
+				io.BytesIO(self.body)).hexdigest())
+
+			# Exceeding max_size by a single byte must be caught.
+			self.assertRaises(IOError, filetransfer._receive,
+				make_response(self.body), io.BytesIO(), len(self.body) - 1,
+				None, chunk_size)
+
+	def test_readinto(self):
+		self.check_receive(io.BytesIO)
+
+	def test_read(self):
+		class ReadOnlyResponse(object):
+			def __init__(self, data):
+				self.read = io.BytesIO(data).read
+		self.check_receive(ReadOnlyResponse)
+
+	def test_decode(self):
+		body = self.body * 10
+		gzip = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		raw_deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+		encoded = {
+			"gzip": gzip.compress(body) + gzip.flush(),
+			"deflate": zlib.compress(body),
+			"raw deflate": raw_deflate.compress(body) + raw_deflate.flush()
+		}
+		for name, data in encoded.items():
+			encoding = name.split()[-1]
+			for chunk_size in (1, 1000, filetransfer.MAX_CHUNK_SIZE):
+				received = io.BytesIO()
+				file_hash = signatures.new_hash()
+				nbytes = filetransfer._receive(io.BytesIO(data), received,
+					len(body), file_hash, chunk_size, len(data),
+					decoder = filetransfer._decoder(encoding))
+				self.assertEquals(nbytes, len(body))
+				self.assertEquals(received.getvalue(), body)
+				self.assertEquals(file_hash.hexdigest(),
+					signatures._hash_file_sha512(
+						io.BytesIO(body)).hexdigest())
+
+			# max_size applies to the decoded body.
+			self.assertRaises(IOError, filetransfer._receive,
+				io.BytesIO(data), io.BytesIO(), len(body) - 1,
+				decoder = filetransfer._decoder(encoding))
+
+		self.assertRaises(IOError, filetransfer._decoder, "br")
+		self.assertRaises(IOError, filetransfer._receive,
+			io.BytesIO(self.body), io.BytesIO(), len(self.body),
+			decoder = filetransfer._decoder("gzip"))
+
+	def test_zip_bomb(self):
+		# 100 MiB of zeros compresses to about 100 KiB.
+		compressor = zlib.compressobj(9)
+		bomb = "".join(compressor.compress("\0" * (1024 * 1024))
+			for i in xrange(100)) + compressor.flush()
+
+		received = io.BytesIO()
+		self.assertRaises(IOError, filetransfer._receive, io.BytesIO(bomb),
+			received, 1024 * 1024, decoder = filetransfer._decoder("deflate"))
+		self.assertTrue(received.tell() <= 1024 * 1024)
+
+	def test_content_length(self):
+		class Response(object):
+			def __init__(self, content_length):
+				self.content_length = content_length
+			def getheader(self, name):
+				assert name == "content-length"
+				return self.content_length
+
+		self.assertEquals(filetransfer._content_length(Response(None)), None)
+		self.assertEquals(filetransfer._content_length(Response("0")), 0)
+		self.assertEquals(filetransfer._content_length(Response(" 42 ")), 42)
+		for bad in ("", "abc", "-1", "1.5", "1, 1"):
+			self.assertRaises(httplib.HTTPException,
+				filetransfer._content_length, Response(bad))
+
+class TestConnectionPool(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		self.test_files = []
+		for i in xrange(int(os.environ.get("NFILES", 2))):
+			filename = "test%s.txt" % (i, )
+			self.test_files.append(filename)
+			make_signed_file(self.temp_dir, filename, 2048, self.key)
+
+		self.listen_on = ("127.0.0.1", 8889)
+		self.server = "%s:%d" % self.listen_on
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.temp_dir, handler = KeepAliveHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+		self.pool = connectionpool.ConnectionPool()
+
+	def tearDown(self):
+		self.pool.clear()
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+		self.temp_dir = None
+
+	def get_all(self):
+		for i in self.test_files:
+			file_path, sig_path = filetransfer.get_file(
+				server = self.server,
+				path = "/" + i,
+				pub_key = self.key,
+				timeout = 5,
+				max_size = 2048 + 256,
+				pool = self.pool
+			)
+			os.remove(file_path)
+			os.remove(sig_path)
+
+	def test_reuse(self):
+		self.get_all()
+		self.get_all()
+
+		# Only the very first acquire() should have needed a new connection,
+		# and every request but the first should have reused its socket.
+		self.assertEquals(self.pool.stats["created"], 1)
+		self.assertEquals(self.pool.stats["hits"], len(self.test_files) * 2 - 1)
+		self.assertEquals(self.pool.stats["reused"],
+			len(self.test_files) * 4 - 1)
+		self.assertEquals(self.pool.stats["reconnects"], 0)
+
+	def test_dropped_connection(self):
+		self.get_all()
+
+		# Restarting the server drops every kept-alive connection.
+		self.httpd.stop()
+		self.httpd.start()
+		time.sleep(2)
+
+		self.get_all()
+		self.assertEquals(self.pool.stats["reconnects"], 1)
+
+	def test_idle_limits(self):
+		self.pool.max_idle = 1
+		cons = [self.pool.acquire(self.server, 5) for i in xrange(3)]
+		for con in cons:
+			connectionpool.send_request(con, "HEAD",
+				"/" + self.test_files[0]).read()
+		for con in cons:
+			self.pool.release(con)
+		self.assertEquals(len(self.pool._idle[self.server]), 1)
+
+		self.pool.idle_timeout = 0
+		time.sleep(0.1)
+		self.pool.acquire(self.server, 5)
+		self.assertEquals(self.pool.stats["expired"], 1)
+		self.assertEquals(self.pool.stats["created"], 4)
+
+class TestResume(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.staging_dir = os.path.join(tempfile.mkdtemp(), "staging")
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		self.file_size = 100000
+		self.file_path = make_signed_file(self.temp_dir, "archive.tar.gz",
+			self.file_size, self.key)
+
+		self.listen_on = ("127.0.0.1", 8890)
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.temp_dir, handler = RangeHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+	def tearDown(self):
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+		shutil.rmtree(os.path.dirname(self.staging_dir))
+
+	def cut_after(self, nbytes):
+		with open(self.file_path + ".cut", "wb") as f:
+			f.write(str(nbytes))
+
+	def get_file(self, **kwargs):
+		return filetransfer.get_file(
+			server = "%s:%d" % self.listen_on,
+			path = "/archive.tar.gz",
+			pub_key = self.key,
+			timeout = 5,
+			max_size = self.file_size,
+			pool = connectionpool.ConnectionPool(),
+			staging_dir = self.staging_dir,
+			**kwargs
+		)
+
+	def check_result(self, file_path, sig_path):
+		with open(self.file_path, "rb") as original:
+			with open(file_path, "rb") as received:
+				self.assertEquals(original.read(), received.read())
+		self.assertEquals(0400, stat.S_IMODE(os.lstat(file_path).st_mode))
+		os.remove(file_path)
+		os.remove(sig_path)
+
+	def get_ranges(self):
+		try:
+			with open(os.path.join(self.temp_dir, "ranges.log"), "rb") as f:
+				return f.read().split()
+		except IOError:
+			return []
+
+	def test_resume(self):
+		self.cut_after(30000)
+		self.assertRaises(httplib.IncompleteRead, self.get_file, resume = True)
+
+		# The partial download is kept, privately.
+		self.assertEquals(0700,
+			stat.S_IMODE(os.lstat(self.staging_dir).st_mode))
+		sizes = [os.path.getsize(os.path.join(self.staging_dir, i))
+			for i in os.listdir(self.staging_dir) if i.endswith(".part")]
+		self.assertEquals(sizes, [30000])
+
+		self.check_result(*self.get_file(resume = True))
+		self.assertEquals(self.get_ranges(), ["bytes=30000-"])
+		self.assertEquals(os.listdir(self.staging_dir), [])
+
+	def test_retries(self):
+		self.cut_after(30000)
+		self.check_result(*self.get_file(resume = True, retries = 1))
+		self.assertEquals(self.get_ranges(), ["bytes=30000-"])
+
+		# Without resuming a retry starts from scratch.
+		self.cut_after(30000)
+		self.check_result(*self.get_file(retries = 1))
+		self.assertEquals(self.get_ranges(), ["bytes=30000-"])
+
+	def test_changed_file(self):
+		self.cut_after(30000)
+		self.assertRaises(httplib.IncompleteRead, self.get_file, resume = True)
+
+		# The new version must be downloaded in full and still verify.
+		make_signed_file(self.temp_dir, "archive.tar.gz", self.file_size,
+			self.key)
+		self.check_result(*self.get_file(resume = True))
+
+	def test_interrupted_without_resume(self):
+		self.cut_after(30000)
+		self.assertRaises(httplib.IncompleteRead, self.get_file)
+		self.assertFalse(os.path.exists(self.staging_dir))
+
+class TestCompression(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		# Signed as is, the server compresses it on the fly.
+		self.listing = "".join('{"name": "galah-%d", "version": "1.0.%d"}\n'
+			% (i, random.randint(0, 100)) for i in xrange(2000))
+		self.listing_path = os.path.join(self.temp_dir, "listing.json")
+		with open(self.listing_path, "wb") as f:
+			f.write(self.listing)
+		with open(self.listing_path, "rb") as f:
+			sig = signatures.sign_file(f, self.key)
+		with open(self.listing_path + ".sig", "wb") as f:
+			f.write(sig)
+
+		self.listen_on = ("127.0.0.1", 8895)
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.temp_dir, handler = RangeHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+	def tearDown(self):
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+
+	def get_file(self, path = "/listing.json", **kwargs):
+		kwargs.setdefault("max_size", len(self.listing))
+		return filetransfer.get_file(
+			server = "%s:%d" % self.listen_on,
+			path = path,
+			pub_key = self.key,
+			timeout = 5,
+			pool = connectionpool.ConnectionPool(),
+			**kwargs
+		)
+
+	def get_encodings(self):
+		try:
+			with open(os.path.join(self.temp_dir, "encodings.log"), "rb") as f:
+				return f.read().splitlines()
+		except IOError:
+			return []
+
+	def check_result(self, file_path, sig_path):
+		with open(file_path, "rb") as f:
+			self.assertEquals(f.read(), self.listing)
+		os.remove(file_path)
+		os.remove(sig_path)
+
+	def test_compressed(self):
+		headers = {}
+		self.check_result(*self.get_file(response_headers = headers,
+			compressed = True))
+		self.assertEquals(headers["content-encoding"], "gzip")
+		self.assertTrue(int(headers["content-length"]) < len(self.listing))
+		self.assertEquals(self.get_encodings(), ["/listing.json gzip"])
+
+	def test_uncompressed(self):
+		headers = {}
+		self.check_result(*self.get_file(response_headers = headers))
+		self.assertFalse("content-encoding" in headers)
+		self.check_result(*self.get_file(resume = True,
+			staging_dir = os.path.join(self.temp_dir, "staging")))
+		self.assertEquals(self.get_encodings(), [])
+
+	def test_max_size(self):
+		self.assertRaises(IOError, self.get_file,
+			max_size = len(self.listing) - 1)
+
+	def test_get_files_not_modified(self):
+		headers = {}
+		self.check_result(*self.get_file(response_headers = headers))
+		request = filetransfer.FileRequest(
+			server = "%s:%d" % self.listen_on,
+			path = "/listing.json",
+			pub_key = self.key,
+			timeout = 5,
+			max_size = len(self.listing),
+			request_headers = {"If-None-Match": headers["etag"]}
+		)
+		results = list(filetransfer.get_files([request]))
+		self.assertEquals(len(results), 1)
+		self.assertEquals(results[0].error, None)
+		self.assertTrue(results[0].not_modified)
+		self.assertEquals(results[0].file_path, None)
+
+	def test_unconditional_not_modified(self):
+		# Asking for compression doesn't make a request conditional, so a
+		# 304 is an error rather than "not modified".
+		open(os.path.join(self.temp_dir, "listing.json.not-modified"),
+			"wb").close()
+		self.assertRaises(IOError, self.get_file, compressed = True)
+
 if __name__ == "__main__":
     unittest.main()
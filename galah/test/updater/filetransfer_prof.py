@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+This is a small benchmarking script used to compare the throughput of the
+receive loop in `filetransfer` against the fixed 1 KiB loop it replaced.
+
+The response body is served from memory so that only the cost of the loop
+itself (allocations, writes and hashing) is measured, not the network.
+
+"""
+
+# internal
+import galah.updater.core.signatures as signatures
+import galah.updater.core.filetransfer as filetransfer
+
+# stdlib
+import io
+import os
+import random
+import tempfile
+import time
+
+def get_pseudo_random_bytes(nbytes):
+	return "".join([chr(random.getrandbits(8)) for i in xrange(nbytes)])
+
+class ReadOnlyResponse(object):
+	"A response body that only supports read(), like httplib's on Python 2."
+
+	def __init__(self, data):
+		self._body = io.BytesIO(data)
+		self.read = self._body.read
+
+def legacy_receive(response, f, max_size, file_hash):
+	"The receive loop as it was before `filetransfer._receive` existed."
+
+	bytes_read = 0
+	while True:
+		chunk = response.read(1024)
+		if len(chunk) == 0:
+			break
+		f.write(chunk)
+		file_hash.update(chunk)
+		bytes_read += len(chunk)
+		if bytes_read > max_size:
+			raise IOError("File exceeds max download size.")
+
+def run(name, receive, make_response, body, repeat):
+	best = None
+	for i in xrange(repeat):
+		with tempfile.TemporaryFile() as f:
+			start = time.time()
+			receive(make_response(body), f, len(body), signatures.new_hash())
+			elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	print "%-30s %8.3f s %10.1f MiB/s" % (
+		name, best, len(body) / best / (1024 * 1024))
+
+random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+body_size = int(os.environ.get("BODY_SIZE", 64 * 1024 * 1024))
+repeat = int(os.environ.get("REPEAT", 3))
+
+# Generating tens of megabytes one byte at a time is slow, so repeat a block.
+block = get_pseudo_random_bytes(1024 * 1024)
+body = (block * (body_size // len(block) + 1))[:body_size]
+print "Using body with %d bytes, best of %d" % (body_size, repeat)
+
+run("legacy 1 KiB read()", legacy_receive, ReadOnlyResponse, body, repeat)
+run("_receive read()", filetransfer._receive, ReadOnlyResponse, body, repeat)
+run("_receive readinto()", filetransfer._receive, io.BytesIO, body, repeat)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+This is a small benchmarking script used to compare the ways
+`signatures._hash_file_sha512` can hash a file: memory mapping it, streaming
+it in large blocks, and the 1 KiB read loop it used to use.
+
+The file is written to a temporary directory first and read once before
+timing starts, so that (given enough memory) it is served from the page cache
+and only the cost of hashing is measured, not the disk.
+
+"""
+
+# internal
+import galah.updater.core.signatures as signatures
+
+# stdlib
+import os
+import StringIO
+import tempfile
+import time
+
+def legacy_hash(the_file):
+	"The hashing loop as it was before large blocks and mmap were used."
+
+	file_hash = signatures.new_hash()
+	while True:
+		chunk = the_file.read(1024)
+		if len(chunk) == 0:
+			break
+		file_hash.update(chunk)
+	return file_hash
+
+def run(name, hash_file, open_file, repeat, nbytes):
+	best = None
+	for i in xrange(repeat):
+		f = open_file()
+		try:
+			start = time.time()
+			hash_file(f)
+			elapsed = time.time() - start
+		finally:
+			f.close()
+		best = elapsed if best is None else min(best, elapsed)
+	print "%-30s %8.3f s %10.1f MiB/s" % (
+		name, best, nbytes / best / (1024 * 1024))
+
+file_size = int(os.environ.get("FILE_SIZE", 256 * 1024 * 1024))
+repeat = int(os.environ.get("REPEAT", 3))
+
+os_handle, path = tempfile.mkstemp()
+try:
+	with os.fdopen(os_handle, "wb") as f:
+		block = os.urandom(1024 * 1024)
+		for i in xrange(file_size // len(block)):
+			f.write(block)
+		f.write(block[:file_size % len(block)])
+	with open(path, "rb") as f:
+		signatures._hash_file_sha512(f)
+
+	with open(path, "rb") as f:
+		data = f.read()
+	print "Using file with %d bytes, best of %d" % (file_size, repeat)
+
+	open_file = lambda: open(path, "rb")
+	run("legacy 1 KiB read()", legacy_hash, open_file, repeat, file_size)
+	run("stream", signatures._hash_file_sha512, open_file, repeat, file_size)
+	run("mmap", lambda f: signatures._hash_file_sha512(f,
+		use_mmap = True), open_file, repeat, file_size)
+	run("stream (StringIO)", signatures._hash_file_sha512,
+		lambda: StringIO.StringIO(data), repeat, file_size)
+finally:
+	os.remove(path)
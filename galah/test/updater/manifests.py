@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.artifactcache as artifactcache
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.errors as errors
+import galah.updater.core.filetransfer as filetransfer
+import galah.updater.core.manifests as manifests
+import galah.updater.core.signatures as signatures
+
+# test helpers
+from webserver import (ForkingWebServer, RangeHandler, get_pseudo_random_bytes,
+	make_signed_file)
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+DIGEST = "ab" * 64
+
+class TestManifest(unittest.TestCase):
+	def test_round_trip(self):
+		manifest = manifests.Manifest()
+		manifest.add("a/b.tar.gz", DIGEST.upper(), 10)
+		parsed = manifests.Manifest.parse(manifest.dumps(),
+			base = "/releases/1.0")
+		self.assertEquals(parsed.files, {
+			"a/b.tar.gz": {"sha512": DIGEST, "size": 10}
+		})
+
+		self.assertEquals(parsed.lookup("/releases/1.0/a/b.tar.gz"),
+			parsed.files["a/b.tar.gz"])
+		self.assertEquals(parsed.lookup("/releases/1.0/./a/b.tar.gz"),
+			parsed.files["a/b.tar.gz"])
+		self.assertEquals(parsed.lookup("/releases/1.0/a/c.tar.gz"), None)
+		self.assertEquals(parsed.lookup("/releases/1.1/a/b.tar.gz"), None)
+		self.assertEquals(parsed.lookup("/releases/1.0/x/../../1.0/a/b.tar.gz"),
+			parsed.files["a/b.tar.gz"])
+		self.assertEquals(manifests.Manifest(parsed.files).lookup(
+			"/releases/1.0/a/b.tar.gz"), None)
+
+	def test_bad_manifests(self):
+		def make(files, version = manifests.MANIFEST_VERSION):
+			return json.dumps({"version": version, "files": files})
+		good_entry = {"sha512": DIGEST, "size": 1}
+
+		for data in ("not json", "[]", make({}, version = 2),
+				make({"../escape": good_entry}),
+				make({"/absolute": good_entry}),
+				make({"a//b": good_entry}),
+				make({u"caf\xe9.tar.gz": good_entry}),
+				make({"a": {"sha512": "ab", "size": 1}}),
+				make({"a": {"sha512": DIGEST, "size": -1}}),
+				make({"a": {"sha512": DIGEST, "size": "1"}}),
+				make({"a": {"sha512": DIGEST}})):
+			self.assertRaises(manifests.ManifestError,
+				manifests.Manifest.parse, data)
+
+class TestGetManifest(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.key = Crypto.PublicKey.RSA.generate(
+			bits = int(os.environ.get("KEYSIZE", 2048)),
+			randfunc = get_pseudo_random_bytes)
+
+		# A release with a file at its top level and one in a subdirectory.
+		self.release_dir = os.path.join(self.temp_dir, "releases", "1.0")
+		os.makedirs(os.path.join(self.release_dir, "archives"))
+		self.contents = {}
+		for name, size in (("notes.txt", 1000),
+				("archives/galah.tar.gz", 100000)):
+			path = os.path.join(self.release_dir, name)
+			with open(path, "wb") as f:
+				f.write(get_pseudo_random_bytes(size))
+			self.contents[name] = open(path, "rb").read()
+		signatures.sign_manifest(self.release_dir, self.key)
+
+		# Added after the manifest was made, so only signed on its own.
+		make_signed_file(self.release_dir, "late.tar.gz", 1000, self.key)
+
+		self.listen_on = ("127.0.0.1", 8901)
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.temp_dir, handler = RangeHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+		self.server = "%s:%d" % self.listen_on
+		self.pool = connectionpool.ConnectionPool()
+
+	def tearDown(self):
+		self.pool.clear()
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+
+	def requests(self):
+		with open(os.path.join(self.temp_dir, "requests.log"), "rb") as f:
+			return f.read().splitlines()
+
+	def get_manifest(self):
+		return filetransfer.get_manifest(self.server,
+			"/releases/1.0/manifest.json", self.key, 5, 100000,
+			pool = self.pool)
+
+	def get_file(self, path, **kwargs):
+		return filetransfer.get_file(self.server, path, self.key, 5, 200000,
+			pool = self.pool, **kwargs)
+
+	def test_make_manifest(self):
+		manifest = self.get_manifest()
+		self.assertEquals(sorted(manifest.files), sorted(self.contents))
+		for name, contents in self.contents.items():
+			entry = manifest.files[name]
+			self.assertEquals(entry["size"], len(contents))
+			self.assertEquals(entry["sha512"],
+				signatures.new_hash().new(contents).hexdigest())
+
+	def test_get_files(self):
+		manifest = self.get_manifest()
+		for name, contents in self.contents.items():
+			file_path, sig_path = self.get_file("/releases/1.0/" + name,
+				manifest = manifest)
+			self.assertEquals(sig_path, None)
+			with open(file_path, "rb") as f:
+				self.assertEquals(f.read(), contents)
+			os.remove(file_path)
+
+		# The only signature retrieved was the manifest's.
+		self.assertEquals([i for i in self.requests() if i.endswith(".sig")],
+			["GET /releases/1.0/manifest.json.sig"])
+
+		# Files the manifest does not list fall back to their own signature.
+		file_path, sig_path = self.get_file("/releases/1.0/late.tar.gz",
+			manifest = manifest)
+		self.assertNotEquals(sig_path, None)
+		os.remove(file_path)
+		os.remove(sig_path)
+
+	def test_tampered_file(self):
+		manifest = self.get_manifest()
+		path = os.path.join(self.release_dir, "notes.txt")
+
+		# Same size, different contents.
+		with open(path, "r+b") as f:
+			f.write("x")
+		self.assertRaises(errors.VerificationError, self.get_file,
+			"/releases/1.0/notes.txt", manifest = manifest)
+
+		# Longer than the manifest says, which is refused like any other
+		# file larger than max_size.
+		with open(path, "wb") as f:
+			f.write(self.contents["notes.txt"] + "x")
+		self.assertRaises(IOError, self.get_file,
+			"/releases/1.0/notes.txt", manifest = manifest)
+
+	def test_tampered_manifest(self):
+		path = os.path.join(self.release_dir, manifests.MANIFEST_NAME)
+		with open(path, "rb") as f:
+			data = f.read()
+		with open(path, "wb") as f:
+			f.write(data.replace('"size": 1000', '"size": 1001'))
+		self.assertRaises(errors.VerificationError, self.get_manifest)
+
+	def test_cache(self):
+		cache = artifactcache.ArtifactCache(
+			os.path.join(self.temp_dir, "cache"), 1000000)
+		manifest = self.get_manifest()
+		for i in xrange(2):
+			file_path, sig_path = self.get_file("/releases/1.0/notes.txt",
+				manifest = manifest, cache = cache)
+			self.assertEquals(sig_path, None)
+			with open(file_path, "rb") as f:
+				self.assertEquals(f.read(), self.contents["notes.txt"])
+			os.remove(file_path)
+		self.assertEquals(cache.stats["hits"], 1)
+		self.assertEquals(cache.lookup(
+			"http://%s/releases/1.0/notes.txt" % (self.server, ))["signed"],
+			False)
+
+if __name__ == "__main__":
+	unittest.main()
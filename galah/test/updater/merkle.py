@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.errors as errors
+import galah.updater.core.filetransfer as filetransfer
+import galah.updater.core.merkle as merkle
+import galah.updater.core.signatures as signatures
+
+# test helpers
+from webserver import (ForkingWebServer, RangeHandler, get_pseudo_random_bytes,
+	make_signed_file)
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import hashlib
+import os
+import random
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+CHUNK_SIZE = merkle.MIN_CHUNK_SIZE
+
+class TestMerkleTree(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+
+	def build(self, data):
+		return merkle.MerkleTree.build(StringIO.StringIO(data), CHUNK_SIZE)
+
+	def test_build(self):
+		for size in (0, 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE,
+				5 * CHUNK_SIZE - 1):
+			data = get_pseudo_random_bytes(size)
+			tree = self.build(data)
+			self.assertEquals(tree.size, size)
+			self.assertEquals(len(tree.leaves),
+				merkle.MerkleTree.chunk_count(CHUNK_SIZE, size))
+
+			parsed = merkle.MerkleTree.parse(tree.dumps())
+			self.assertEquals(parsed.leaves, tree.leaves)
+			self.assertEquals(parsed.head(), tree.head())
+
+		# Three leaves: the first two are paired up and the third carried.
+		tree = self.build(get_pseudo_random_bytes(3 * CHUNK_SIZE))
+		leaves = [i.decode("hex") for i in tree.leaves]
+		left = hashlib.sha512("\x01" + leaves[0] + leaves[1]).digest()
+		self.assertEquals(tree.root(),
+			hashlib.sha512("\x01" + left + leaves[2]).hexdigest())
+
+	def test_bad_sidecars(self):
+		tree = self.build(get_pseudo_random_bytes(2 * CHUNK_SIZE))
+		good = tree.dumps()
+		for data in ("not json", "[]",
+				good.replace('"version": 1', '"version": 2'),
+				good.replace('"chunk_size": 4096', '"chunk_size": 16'),
+				good.replace(tree.leaves[0], "ab"),
+				merkle.MerkleTree(CHUNK_SIZE, tree.size,
+					tree.leaves[:1]).dumps()):
+			self.assertRaises(merkle.MerkleError, merkle.MerkleTree.parse,
+				data)
+
+	def test_verifier(self):
+		data = get_pseudo_random_bytes(4 * CHUNK_SIZE + 100)
+		tree = self.build(data)
+
+		progress = []
+		file_hash = hashlib.sha512()
+		verifier = merkle.ChunkVerifier(tree, file_hash, progress.append)
+		for i in xrange(0, len(data), 1000):
+			verifier.update(data[i:i + 1000])
+		verifier.finish()
+		self.assertEquals(progress, [CHUNK_SIZE * i for i in xrange(1, 5)] +
+			[len(data)])
+		self.assertEquals(verifier.hexdigest(),
+			hashlib.sha512(data).hexdigest())
+
+		# The third chunk is bad, which is noticed once it is complete.
+		bad = data[:2 * CHUNK_SIZE + 10] + "x" + data[2 * CHUNK_SIZE + 11:]
+		verifier = merkle.ChunkVerifier(tree, hashlib.sha512())
+		verifier.update(bad[:3 * CHUNK_SIZE - 1])
+		self.assertRaises(merkle.ChunkMismatch, verifier.update,
+			bad[3 * CHUNK_SIZE - 1:])
+		self.assertEquals(verifier.verified_size, 2 * CHUNK_SIZE)
+
+		verifier = merkle.ChunkVerifier(tree, hashlib.sha512())
+		verifier.update(data[:-1])
+		self.assertRaises(merkle.ChunkMismatch, verifier.finish)
+		self.assertRaises(merkle.ChunkMismatch, verifier.update, "xx")
+
+class TestGetFile(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.key = Crypto.PublicKey.RSA.generate(
+			bits = int(os.environ.get("KEYSIZE", 2048)),
+			randfunc = get_pseudo_random_bytes)
+
+		self.file_size = 20 * CHUNK_SIZE + 123
+		self.file_path = make_signed_file(self.temp_dir, "archive.tar.gz",
+			self.file_size, self.key)
+		with open(self.file_path, "rb") as f:
+			self.contents = f.read()
+			f.seek(0)
+			sidecar, signature = signatures.sign_merkle_tree(f, self.key,
+				CHUNK_SIZE)
+		with open(self.file_path + ".merkle", "wb") as f:
+			f.write(sidecar)
+		with open(self.file_path + ".merkle.sig", "wb") as f:
+			f.write(signature)
+
+		self.listen_on = ("127.0.0.1", 8902)
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.temp_dir, handler = RangeHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+		self.pool = connectionpool.ConnectionPool()
+
+	def tearDown(self):
+		self.pool.clear()
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+
+	def get_file(self, **kwargs):
+		return filetransfer.get_file("%s:%d" % self.listen_on,
+			"/archive.tar.gz", self.key, 5, 10 * self.file_size,
+			pool = self.pool, use_merkle = True, **kwargs)
+
+	def requests(self):
+		with open(os.path.join(self.temp_dir, "requests.log"), "rb") as f:
+			return f.read().splitlines()
+
+	def test_get_file(self):
+		control = filetransfer.TransferControl()
+		file_path, sig_path = self.get_file(control = control)
+		self.assertEquals(sig_path, None)
+		with open(file_path, "rb") as f:
+			self.assertEquals(f.read(), self.contents)
+		os.remove(file_path)
+		self.assertEquals(control.verified_size, self.file_size)
+
+		# The connection went back to the pool, so cancelling the finished
+		# transfer mustn't touch it.
+		self.assertEquals(control._con, None)
+
+		# The file's own signature was never needed.
+		self.assertEquals(self.requests(), [
+			"GET /archive.tar.gz.merkle",
+			"GET /archive.tar.gz.merkle.sig",
+			"GET /archive.tar.gz"
+		])
+
+	def test_bad_chunk(self):
+		with open(self.file_path, "r+b") as f:
+			f.seek(5 * CHUNK_SIZE + 1)
+			f.write("x")
+
+		control = filetransfer.TransferControl()
+		self.assertRaises(errors.VerificationError, self.get_file,
+			control = control)
+		self.assertEquals(control.verified_size, 5 * CHUNK_SIZE)
+
+	def test_truncated_file(self):
+		with open(self.file_path, "wb") as f:
+			f.write(self.contents[:-1])
+		self.assertRaises(errors.VerificationError, self.get_file)
+
+	def test_forged_sidecar(self):
+		# A sidecar describing a different file doesn't match the signed
+		# head.
+		with open(self.file_path + ".merkle", "wb") as f:
+			f.write(merkle.MerkleTree.build(
+				StringIO.StringIO(get_pseudo_random_bytes(self.file_size)),
+				CHUNK_SIZE).dumps())
+		self.assertRaises(errors.VerificationError, self.get_file)
+		self.assertFalse("GET /archive.tar.gz" in self.requests())
+
+	def test_missing_sidecar(self):
+		os.remove(self.file_path + ".merkle")
+		self.assertRaises(errors.VerificationError, self.get_file)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.errors as errors
+import galah.updater.core.filetransfer as filetransfer
+import galah.updater.core.metrics as metrics
+
+# test helpers
+from webserver import ForkingWebServer, KeepAliveHandler, make_signed_file
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import io
+import json
+import os
+import pkg_resources
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+class TestHistogram(unittest.TestCase):
+	def test_histogram(self):
+		histogram = metrics.Histogram()
+		self.assertEquals(histogram.percentile(50), None)
+
+		for i in xrange(1, 101):
+			histogram.add(i)
+		self.assertEquals(histogram.count, 100)
+		self.assertEquals((histogram.min, histogram.max), (1, 100))
+		self.assertEquals(histogram.mean(), 50.5)
+
+		# Estimates are within a factor of two of the real percentile.
+		for percentile in (1, 50, 95, 99, 100):
+			estimate = histogram.percentile(percentile)
+			self.assertTrue(percentile <= estimate <= percentile * 2,
+				(percentile, estimate))
+		self.assertEquals(histogram.percentile(100), 100)
+
+		histogram.add(0)
+		self.assertEquals(histogram.percentile(0), 0)
+
+class TestGetFile(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		self.file_size = 50000
+		make_signed_file(self.temp_dir, "file.tar.gz", self.file_size,
+			self.key)
+		with open(os.path.join(self.temp_dir, "unsigned.tar.gz"), "wb") as f:
+			f.write("x" * 100)
+		with open(os.path.join(self.temp_dir, "unsigned.tar.gz.sig"),
+				"wb") as f:
+			f.write("x" * filetransfer.signatures.signature_size(self.key))
+
+		self.listen_on = ("127.0.0.1", 8896)
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.temp_dir, handler = KeepAliveHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+	def tearDown(self):
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+
+	def test_records(self):
+		records = []
+		exported = io.BytesIO()
+		histograms = metrics.HistogramSink()
+		recorder = metrics.Metrics(metrics.CallbackSink(records.append),
+			metrics.JSONLinesSink(exported), histograms)
+		pool = connectionpool.ConnectionPool()
+
+		def get_file(path):
+			return filetransfer.get_file("%s:%d" % self.listen_on, path,
+				self.key, 5, self.file_size, pool = pool,
+				metrics_sink = recorder)
+
+		for i in xrange(2):
+			for path in get_file("/file.tar.gz"):
+				os.remove(path)
+		self.assertRaises(errors.VerificationError, get_file,
+			"/unsigned.tar.gz")
+
+		self.assertEquals([i.outcome for i in records],
+			["ok", "ok", "error"])
+		first, second, failed = records
+		for record in (first, second):
+			self.assertEquals(record.bytes, self.file_size)
+			self.assertEquals(record.retries, 0)
+			for i in ("ttfb", "transfer", "hash", "verify", "total"):
+				self.assertTrue(getattr(record, i) >= 0, i)
+			self.assertTrue(record.hash < record.total)
+
+		# Only the first transfer had to connect.
+		self.assertTrue(first.dns >= 0 and first.connect >= 0)
+		self.assertEquals((second.dns, second.connect), (None, None))
+		self.assertTrue("VerificationError" in failed.error)
+
+		lines = [json.loads(i) for i in exported.getvalue().splitlines()]
+		self.assertEquals([i["url"] for i in lines],
+			[i.url for i in records])
+		self.assertEquals(lines[0]["bytes"], self.file_size)
+
+		summary = histograms.summary()
+		self.assertEquals(summary["bytes"]["count"], 3)
+		self.assertEquals(summary["verify"]["count"], 3)
+		self.assertEquals(histograms.outcomes, {"ok": 2, "error": 1})
+
+	def test_broken_sink(self):
+		class BrokenSink(object):
+			def record(self, transfer_record):
+				raise RuntimeError("broken")
+
+		file_path, sig_path = filetransfer.get_file(
+			"%s:%d" % self.listen_on, "/file.tar.gz", self.key, 5,
+			self.file_size, pool = connectionpool.ConnectionPool(),
+			metrics_sink = metrics.Metrics(BrokenSink()))
+		os.remove(file_path)
+		os.remove(sig_path)
+
+if __name__ == "__main__":
+	unittest.main()
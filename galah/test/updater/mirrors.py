@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.mirrors as mirrors
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.errors as errors
+import galah.updater.core.filetransfer as filetransfer
+
+# test helpers
+from webserver import ForkingWebServer, RangeHandler, make_signed_file
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import os
+import pkg_resources
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+class TestMirrorStats(unittest.TestCase):
+	def test_order(self):
+		stats = mirrors.MirrorStats()
+		urls = ["http://slow/a", "http://flaky/a", "http://new/a",
+			"http://fast/a", "http://dead/a"]
+		stats.record_success("slow", ttfb = 1.0, nbytes = 1000,
+			duration = 2.0)
+		stats.record_success("fast", ttfb = 0.1, nbytes = 1000,
+			duration = 0.2)
+		stats.record_success("flaky", ttfb = 0.1, nbytes = 1000,
+			duration = 0.2)
+		stats.record_failure("flaky")
+		stats.record_failure("dead")
+
+		self.assertEquals(stats.failure_rate("flaky"), 0.5)
+		self.assertEquals(stats.latency("slow"), 1.0)
+		self.assertEquals(stats.throughput("fast"), 10000)
+		# The new mirror is ranked with the median of the others (flaky), so
+		# it is tried before the slow one but not before the fast one.
+		self.assertEquals(stats.score("new"), stats.score("flaky"))
+		self.assertEquals(stats.order(urls), ["http://fast/a",
+			"http://flaky/a", "http://new/a", "http://slow/a", "http://dead/a"])
+
+		# With nothing known yet the listed order is kept.
+		self.assertEquals(mirrors.MirrorStats().order(urls), urls)
+
+	def test_percentile(self):
+		stats = mirrors.MirrorStats(min_samples = 10)
+		for i in xrange(1, 10):
+			stats.record_success("a", ttfb = i, nbytes = 0, duration = i)
+		self.assertEquals(stats.ttfb_percentile(50), None)
+		stats.record_success("b", ttfb = 10, nbytes = 0, duration = 10)
+		self.assertEquals(stats.ttfb_percentile(50), 5)
+		self.assertEquals(stats.ttfb_percentile(90), 9)
+		self.assertEquals(stats.ttfb_percentile(100), 10)
+
+class TestMirrors(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		# Two mirrors with identical content, the first of them slow.
+		self.servers = []
+		self.httpds = []
+		for i, port in enumerate((8892, 8893)):
+			serve_dir = os.path.join(self.temp_dir, str(i))
+			os.mkdir(serve_dir)
+			self.httpds.append(ForkingWebServer(("127.0.0.1", port),
+				serve_directory = serve_dir, handler = RangeHandler))
+			self.servers.append("127.0.0.1:%d" % (port, ))
+		random.seed(1)
+		self.file_path = make_signed_file(os.path.join(self.temp_dir, "0"),
+			"archive.tar.gz", 50000, self.key)
+		random.seed(1)
+		make_signed_file(os.path.join(self.temp_dir, "1"), "archive.tar.gz",
+			50000, self.key)
+		with open(self.file_path + ".delay", "wb") as f:
+			f.write("3")
+
+		for i in self.httpds:
+			i.start()
+		time.sleep(2)
+
+	def tearDown(self):
+		for i in self.httpds:
+			i.stop()
+		shutil.rmtree(self.temp_dir)
+
+	def get_file(self, urls, **kwargs):
+		file_path, sig_path = mirrors.get_file(urls, self.key, timeout = 5,
+			max_size = 50000, pool = connectionpool.ConnectionPool(),
+			**kwargs)
+		with open(self.file_path, "rb") as original:
+			with open(file_path, "rb") as received:
+				self.assertEquals(original.read(), received.read())
+		os.remove(file_path)
+		os.remove(sig_path)
+
+	def test_not_modified(self):
+		stats = mirrors.MirrorStats()
+		urls = ["http://%s/archive.tar.gz" % (self.servers[1], )]
+		headers = {}
+		self.get_file(urls, stats = stats, response_headers = headers)
+
+		self.assertEquals(mirrors.get_file(urls, self.key, timeout = 5,
+			max_size = 50000, stats = stats,
+			request_headers = {"If-None-Match": headers["etag"]}), None)
+		self.assertEquals(stats.failure_rate(self.servers[1]), 0.0)
+
+		# Each mirror's transfer has its own control.
+		self.assertRaises(ValueError, mirrors.get_file, urls, self.key,
+			timeout = 5, max_size = 50000, stats = stats,
+			control = filetransfer.TransferControl())
+
+	def test_failover(self):
+		stats = mirrors.MirrorStats()
+		urls = ["http://127.0.0.1:8894/archive.tar.gz",
+			"http://%s/archive.tar.gz" % (self.servers[1], )]
+		self.get_file(urls, stats = stats)
+		self.assertEquals(stats.failure_rate("127.0.0.1:8894"), 1.0)
+		self.assertEquals(stats.failure_rate(self.servers[1]), 0.0)
+		self.assertNotEquals(stats.latency(self.servers[1]), None)
+
+		# Now that the dead mirror is known it is not tried first.
+		self.assertEquals(stats.order(urls), list(reversed(urls)))
+
+		# A mirror serving a forged file is just another failure.
+		with open(os.path.join(self.temp_dir, "1", "archive.tar.gz"),
+				"ab") as f:
+			f.write("forged")
+		self.assertRaises(errors.VerificationError, mirrors.get_file, urls,
+			self.key, timeout = 5, max_size = 60000, stats = stats)
+
+	def test_hedge(self):
+		stats = mirrors.MirrorStats()
+		for i in xrange(stats.min_samples):
+			stats.record_success("elsewhere", ttfb = 0.1, nbytes = 0,
+				duration = 0.1)
+
+		urls = ["http://%s/archive.tar.gz" % (i, ) for i in self.servers]
+		start = time.time()
+		self.get_file(urls, stats = stats, hedge_percentile = 90)
+		self.assertTrue(time.time() - start < 2.5)
+
+		# The slow mirror was cancelled rather than counted as a failure.
+		self.assertEquals(stats.failure_rate(self.servers[0]), 0.0)
+		self.assertNotEquals(stats.latency(self.servers[1]), None)
+
+		# Both transfers would be put in place at the same destination.
+		self.assertRaises(ValueError, mirrors.get_file, urls, self.key,
+			timeout = 5, max_size = 50000, stats = stats,
+			hedge_percentile = 90,
+			destination = os.path.join(self.temp_dir, "installed"))
+
+if __name__ == "__main__":
+	unittest.main()
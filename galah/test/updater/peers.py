@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.artifactcache as artifactcache
+import galah.updater.core.connectionpool as connectionpool
+import galah.updater.core.peers as peers
+import galah.updater.core.signatures as signatures
+
+# test helpers
+from webserver import (ForkingWebServer, RangeHandler, get_pseudo_random_bytes,
+	make_signed_file)
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import multiprocessing
+import os
+import pkg_resources
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+NODE_PORTS = (8898, 8899, 8900)
+
+def run_node(port, cache_dir, key, url, max_size, finished, results):
+	"Runs a single node in its own process and gets one file through it."
+
+	node = peers.Node(("127.0.0.1", port),
+		["127.0.0.1:%d" % (i, ) for i in NODE_PORTS],
+		artifactcache.ArtifactCache(cache_dir, 10 * max_size), key,
+		timeout = 5, upstreams = [url.split("/")[2]],
+		pool = connectionpool.ConnectionPool())
+	node.start()
+	try:
+		# Wait for every node to be up.
+		while len(node.live_peers()) < len(NODE_PORTS) - 1:
+			time.sleep(0.1)
+
+		file_path, sig_path = node.get_file(url, max_size)
+		with open(file_path, "rb") as f:
+			results.put((port, f.read()))
+		os.remove(file_path)
+		os.remove(sig_path)
+	except Exception as e:
+		results.put((port, e))
+	finally:
+		# Keep serving until everyone has their file.
+		finished.wait()
+		node.stop()
+
+class TestPeers(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.serve_dir = os.path.join(self.temp_dir, "upstream")
+		os.mkdir(self.serve_dir)
+		self.key = Crypto.PublicKey.RSA.importKey(
+			pkg_resources.resource_string("data", "test_rsa.pem"))
+
+		self.file_size = 100000
+		file_path = make_signed_file(self.serve_dir, "archive.tar.gz",
+			self.file_size, self.key)
+		with open(file_path, "rb") as f:
+			self.contents = f.read()
+
+		self.listen_on = ("127.0.0.1", 8897)
+		self.url = "http://%s:%d/archive.tar.gz" % self.listen_on
+		self.httpd = ForkingWebServer(self.listen_on,
+			serve_directory = self.serve_dir, handler = RangeHandler)
+		self.httpd.start()
+		time.sleep(2)
+
+	def tearDown(self):
+		self.httpd.stop()
+		self.httpd = None
+		shutil.rmtree(self.temp_dir)
+
+	def upstream_gets(self):
+		with open(os.path.join(self.serve_dir, "requests.log"), "rb") as f:
+			return [i for i in f.read().splitlines()
+				if i == "GET /archive.tar.gz"]
+
+	def make_node(self, port, **kwargs):
+		cache = artifactcache.ArtifactCache(
+			os.path.join(self.temp_dir, "cache-%d" % (port, )),
+			10 * self.file_size)
+		return peers.Node(("127.0.0.1", port),
+			["127.0.0.1:%d" % (i, ) for i in NODE_PORTS], cache, self.key,
+			timeout = 5, upstreams = ["%s:%d" % self.listen_on],
+			pool = connectionpool.ConnectionPool(), **kwargs)
+
+	def test_fan_out(self):
+		finished = multiprocessing.Event()
+		results = multiprocessing.Queue()
+		processes = [multiprocessing.Process(target = run_node,
+			args = (port, os.path.join(self.temp_dir, "cache-%d" % (port, )),
+				self.key, self.url, self.file_size, finished, results))
+			for port in NODE_PORTS]
+		for i in processes:
+			i.daemon = True
+			i.start()
+		try:
+			received = dict(results.get(timeout = 60) for i in processes)
+		finally:
+			finished.set()
+			for i in processes:
+				i.join()
+
+		self.assertEquals(sorted(received), list(NODE_PORTS))
+		for port, contents in received.items():
+			self.assertEquals(contents, self.contents, (port, contents))
+
+		# Only the leader went upstream.
+		self.assertEquals(len(self.upstream_gets()), 1)
+
+	def test_untrusted_peer(self):
+		leader = self.make_node(NODE_PORTS[0])
+		follower = self.make_node(NODE_PORTS[1])
+
+		# The leader holds a tampered copy of the file (with the genuine
+		# signature).
+		bad_path = os.path.join(self.temp_dir, "bad")
+		with open(bad_path, "wb") as f:
+			f.write(get_pseudo_random_bytes(self.file_size))
+		with open(bad_path, "rb") as f:
+			digest = signatures._hash_file_sha512(f).hexdigest()
+		leader.cache.store(self.url, bad_path,
+			os.path.join(self.serve_dir, "archive.tar.gz.sig"), digest)
+
+		leader.start()
+		follower.start()
+		try:
+			self.assertEquals(follower.leader(), leader.address)
+			file_path, sig_path = follower.get_file(self.url, self.file_size)
+		finally:
+			leader.stop()
+			follower.stop()
+
+		with open(file_path, "rb") as f:
+			self.assertEquals(f.read(), self.contents)
+		os.remove(file_path)
+		os.remove(sig_path)
+
+		# The bad copy was rejected and the file fetched from upstream.
+		self.assertEquals(len(self.upstream_gets()), 1)
+
+	def test_leader_election(self):
+		follower = self.make_node(NODE_PORTS[2])
+		self.assertEquals(follower.leader(), follower.address)
+
+		leader = self.make_node(NODE_PORTS[1])
+		leader.start()
+		try:
+			self.assertEquals(follower.live_peers(), [leader.address])
+			self.assertEquals(follower.leader(), leader.address)
+		finally:
+			leader.stop()
+
+if __name__ == "__main__":
+	unittest.main()
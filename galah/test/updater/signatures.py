@@ -10,7 +10,11 @@ import Crypto.PublicKey.RSA
 import unittest
 import random
 import os
+import hashlib
+import io
+import shutil
 import StringIO
+import tempfile
 
 def get_pseudo_random_bytes(nbytes):
 	return "".join([chr(random.getrandbits(8)) for i in xrange(nbytes)])
@@ -58,5 +62,173 @@ class TestSignatures(unittest.TestCase):
 			self.assertFalse(signatures.verify_file(
 				message_file, bad_sig_file, k))
 
+	def test_precomputed_hash(self):
+		message = get_pseudo_random_bytes(
+			int(os.environ.get("MESSAGE_SIZE", 2000)))
+		k = self.keys[0]
+		sig = signatures.sign_file(StringIO.StringIO(message), k)
+
+		# Feed the hash in uneven pieces as a download would.
+		file_hash = signatures.new_hash()
+		for i in xrange(0, len(message), 333):
+			file_hash.update(message[i:i + 333])
+		self.assertTrue(signatures.verify_file(None, StringIO.StringIO(sig), k,
+			file_hash = file_hash))
+
+		bad_hash = signatures.new_hash()
+		bad_hash.update(message[:-1])
+		self.assertFalse(signatures.verify_file(None, StringIO.StringIO(sig),
+			k, file_hash = bad_hash))
+
+class TestHashing(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def test_hash_paths(self):
+		# Sizes either side of a block boundary, and an empty file.
+		for size in (0, 1, signatures.HASH_BLOCK_SIZE,
+				signatures.HASH_BLOCK_SIZE * 2 + 1):
+			data = get_pseudo_random_bytes(size)
+			expected = hashlib.sha512(data).hexdigest()
+			path = os.path.join(self.temp_dir, "file")
+			with open(path, "wb") as f:
+				f.write(data)
+
+			for use_mmap in (True, False):
+				with open(path, "rb") as f:
+					self.assertEquals(signatures._hash_file_sha512(f,
+						use_mmap).hexdigest(), expected)
+					self.assertEquals(f.tell(), size)
+
+				# Hashing starts from the current position.
+				with open(path, "rb") as f:
+					f.read(1)
+					self.assertEquals(signatures._hash_file_sha512(f,
+						use_mmap).hexdigest(),
+						hashlib.sha512(data[1:]).hexdigest())
+
+			for file_like in (StringIO.StringIO, io.BytesIO):
+				self.assertEquals(signatures._hash_file_sha512(
+					file_like(data)).hexdigest(), expected)
+
+		# Pipes can't be mapped.
+		read_fd, write_fd = os.pipe()
+		os.write(write_fd, "abc")
+		os.close(write_fd)
+		with os.fdopen(read_fd, "rb") as f:
+			self.assertEquals(signatures._hash_file_sha512(f,
+				use_mmap = True).hexdigest(),
+				hashlib.sha512("abc").hexdigest())
+
+class TestVerifyMany(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.key = Crypto.PublicKey.RSA.generate(
+			bits = int(os.environ.get("KEYSIZE", 2048)),
+			randfunc = get_pseudo_random_bytes)
+
+		self.pairs = []
+		for i in xrange(int(os.environ.get("NFILES", 8))):
+			file_path = os.path.join(self.temp_dir, "file%d" % (i, ))
+			with open(file_path, "wb") as f:
+				f.write(get_pseudo_random_bytes(
+					int(os.environ.get("MESSAGE_SIZE", 2000))))
+			with open(file_path, "rb") as f:
+				sig = signatures.sign_file(f, self.key)
+			with open(file_path + ".sig", "wb") as f:
+				f.write(sig)
+			self.pairs.append((file_path, file_path + ".sig"))
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def test_verify_many(self):
+		# Tamper with one file and lose another's signature.
+		with open(self.pairs[1][0], "ab") as f:
+			f.write("x")
+		os.remove(self.pairs[2][1])
+
+		results = list(signatures.verify_many(self.pairs, self.key,
+			workers = 2))
+		self.assertEquals(sorted(i.file_path for i in results),
+			sorted(i[0] for i in self.pairs))
+		by_path = dict((i.file_path, i) for i in results)
+		for i, (file_path, _) in enumerate(self.pairs):
+			self.assertEquals(by_path[file_path].verified, i not in (1, 2))
+		self.assertTrue(by_path[self.pairs[2][0]].error is not None)
+		self.assertTrue(all(i.size > 0 and i.hash_time >= 0 for i in results))
+
+		report = signatures.format_report(results)
+		self.assertEquals(len(report.splitlines()), len(self.pairs) + 2)
+
+	def test_fail_fast(self):
+		os.remove(self.pairs[0][1])
+		results = list(signatures.verify_many(self.pairs, self.key,
+			workers = 1, fail_fast = True))
+		self.assertFalse(results[-1].verified)
+		self.assertTrue(all(i.verified for i in results[:-1]))
+		self.assertTrue(len(results) < len(self.pairs))
+
+class TestSignTree(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.root = os.path.join(self.temp_dir, "release")
+		self.index_path = os.path.join(self.temp_dir, "index.json")
+		self.key, self.other_key = [Crypto.PublicKey.RSA.generate(
+			bits = int(os.environ.get("KEYSIZE", 2048)),
+			randfunc = get_pseudo_random_bytes) for i in xrange(2)]
+
+		os.makedirs(os.path.join(self.root, "migrations"))
+		self.paths = [os.path.join(self.root, i) for i in
+			("installer.sh", "release.json", "migrations/0001.py")]
+		for i in self.paths:
+			with open(i, "wb") as f:
+				f.write(get_pseudo_random_bytes(1000))
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def sign(self, key = None, **kwargs):
+		results = signatures.sign_tree(self.root, key or self.key,
+			index_path = self.index_path, workers = 2, **kwargs)
+		self.assertTrue(all(i.error is None for i in results))
+		return sorted(i.file_path for i in results if i.signed)
+
+	def test_sign_tree(self):
+		self.assertEquals(self.sign(), sorted(self.paths))
+		for i in self.paths:
+			with open(i, "rb") as f:
+				with open(i + ".sig", "rb") as sig_file:
+					self.assertTrue(signatures.verify_file(f, sig_file,
+						self.key))
+
+		# Nothing changed, so nothing is signed again.
+		self.assertEquals(self.sign(), [])
+
+		# Only what changed (or lost its signature) is.
+		with open(self.paths[1], "ab") as f:
+			f.write("x")
+		os.remove(self.paths[2] + ".sig")
+		self.assertEquals(self.sign(), sorted(self.paths[1:]))
+		self.assertEquals(self.sign(), [])
+
+		# A different key makes the index useless.
+		self.assertEquals(self.sign(key = self.other_key), sorted(self.paths))
+
+	def test_partial(self):
+		self.sign()
+		with open(self.paths[0], "ab") as f:
+			f.write("x")
+		self.assertEquals(self.sign(paths = self.paths[1:]), [])
+
+		# The files that were left out are still in the index.
+		self.assertEquals(self.sign(), [self.paths[0]])
+
 if __name__ == '__main__':
     unittest.main()
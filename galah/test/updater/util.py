@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.errors as errors
+import galah.updater.core.util as util
+
+# stdlib
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+class TestUtil(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def test_private_dir(self):
+		path = os.path.join(self.temp_dir, "private")
+		self.assertEquals(util.private_dir(path), path)
+		self.assertEquals(stat.S_IMODE(os.lstat(path).st_mode), 0700)
+		self.assertEquals(util.private_dir(path), path)
+
+		os.chmod(path, 0750)
+		self.assertRaises(errors.CriticalError, util.private_dir, path)
+
+		link = os.path.join(self.temp_dir, "link")
+		os.symlink(self.temp_dir, link)
+		self.assertRaises(errors.CriticalError, util.private_dir, link)
+
+		# A missing parent isn't created.
+		self.assertRaises(OSError, util.private_dir,
+			os.path.join(self.temp_dir, "missing", "private"))
+
+	def test_split_url(self):
+		self.assertEquals(util.split_url("http://example.com"),
+			("example.com", "/"))
+		self.assertEquals(util.split_url("http://example.com:8080/a/b?c=d"),
+			("example.com:8080", "/a/b?c=d"))
+		for url in ("https://example.com/a", "ftp://example.com/a", "/a",
+				"http:///a"):
+			self.assertRaises(ValueError, util.split_url, url)
+
+if __name__ == "__main__":
+	unittest.main()
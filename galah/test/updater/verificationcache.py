@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# internal
+import galah.updater.core.signatures as signatures
+import galah.updater.core.verificationcache as verificationcache
+
+# pycrypto
+import Crypto.PublicKey.RSA
+
+# stdlib
+import os
+import random
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+def get_pseudo_random_bytes(nbytes):
+	return "".join([chr(random.getrandbits(8)) for i in xrange(nbytes)])
+
+class TestVerificationCache(unittest.TestCase):
+	def setUp(self):
+		random.seed(int(os.environ.get("RANDOM_SEED", 1)))
+		self.temp_dir = tempfile.mkdtemp()
+		self.cache_path = os.path.join(self.temp_dir, "verified.json")
+		self.key, self.other_key = [Crypto.PublicKey.RSA.generate(
+			bits = int(os.environ.get("KEYSIZE", 2048)),
+			randfunc = get_pseudo_random_bytes) for i in xrange(2)]
+
+		self.file_path = os.path.join(self.temp_dir, "archive.tar.gz")
+		self.write_file(get_pseudo_random_bytes(10000))
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def write_file(self, data):
+		with open(self.file_path, "wb") as f:
+			f.write(data)
+		with open(self.file_path, "rb") as f:
+			self.signature = signatures.sign_file(f, self.key)
+
+	def verify(self, cache, key = None, signature = None):
+		with open(self.file_path, "rb") as f:
+			return signatures.verify_file(f,
+				StringIO.StringIO(signature or self.signature),
+				key or self.key, cache = cache)
+
+	def assert_not_hashed(self, cache):
+		"Checks that a verification is answered by the cache alone."
+
+		hash_file = signatures._hash_file_sha512
+		def fail(the_file):
+			self.fail("File was hashed.")
+		signatures._hash_file_sha512 = fail
+		try:
+			self.assertTrue(self.verify(cache))
+		finally:
+			signatures._hash_file_sha512 = hash_file
+
+	def test_hit(self):
+		cache = verificationcache.VerificationCache(self.cache_path,
+			racy_window = 0)
+		self.assertTrue(self.verify(cache))
+		self.assert_not_hashed(cache)
+		self.assertEquals(cache.stats, {"hits": 1, "misses": 1, "stores": 1})
+		self.assertEquals(cache.hit_rate(), 0.5)
+
+		# It is still there after a restart.
+		self.assert_not_hashed(
+			verificationcache.VerificationCache(self.cache_path))
+
+		# Other keys and signatures don't match the entry.
+		self.assertFalse(self.verify(cache, key = self.other_key))
+		with open(self.file_path, "rb") as f:
+			other_signature = signatures.sign_file(f, self.key)
+		self.assertTrue(self.verify(cache, signature = other_signature))
+		self.assertEquals(cache.stats["misses"], 3)
+
+	def test_invalidation(self):
+		cache = verificationcache.VerificationCache(self.cache_path,
+			racy_window = 0)
+		self.assertTrue(self.verify(cache))
+
+		# Tampering with the file, even without changing its size or
+		# modification time, must be noticed.
+		st = os.stat(self.file_path)
+		with open(self.file_path, "r+b") as f:
+			f.write("x")
+		os.utime(self.file_path, (st.st_atime, st.st_mtime))
+		self.assertFalse(self.verify(cache))
+		self.assertEquals(cache.stats["hits"], 0)
+
+	def test_racy(self):
+		cache = verificationcache.VerificationCache(self.cache_path,
+			racy_window = 1)
+		self.assertTrue(self.verify(cache))
+		self.assertEquals(cache.stats["stores"], 0)
+
+		time.sleep(1.1)
+		self.assertTrue(self.verify(cache))
+		self.assert_not_hashed(cache)
+
+	def test_untrusted_cache_file(self):
+		cache = verificationcache.VerificationCache(self.cache_path,
+			racy_window = 0)
+		self.assertTrue(self.verify(cache))
+
+		os.chmod(self.cache_path, 0666)
+		cache = verificationcache.VerificationCache(self.cache_path)
+		self.assertTrue(self.verify(cache))
+		self.assertEquals(cache.stats["hits"], 0)
+
+	def test_precomputed_hash(self):
+		cache = verificationcache.VerificationCache(self.cache_path,
+			racy_window = 0)
+		for i in xrange(2):
+			with open(self.file_path, "rb") as f:
+				file_hash = signatures._hash_file_sha512(f)
+			self.assertTrue(signatures.verify_file(None,
+				StringIO.StringIO(self.signature), self.key,
+				file_hash = file_hash, cache = cache))
+		self.assertEquals(cache.stats["hits"], 1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,195 @@
+"""
+Helpers shared by the unit tests that need to talk to a web server.
+
+"""
+
+# internal
+import galah.updater.core.signatures as signatures
+
+# stdlib
+import multiprocessing
+import os
+import signal
+import random
+import SimpleHTTPServer
+import SocketServer
+import io
+import hashlib
+import email.utils
+import time
+import zlib
+
+class ForkingWebServer:
+	"""
+	Simple web server for testing purposes.
+
+	:ivar listen_on: A tuple `(address, port)`.
+	:ivar serve_directory: The directory to serve files from.
+	:ivar handler: The request handler class to use.
+
+	:warning: This is not for serious use and was only made for use by this
+			unit testing module. Usage outside of this context is a bad idea.
+
+	"""
+
+	def __init__(self, listen_on, serve_directory,
+			handler = SimpleHTTPServer.SimpleHTTPRequestHandler):
+		self.listen_on = listen_on
+		self.serve_directory = serve_directory
+		self.handler = handler
+		self._process = None
+
+	def _run_server(self):
+		os.chdir(self.serve_directory)
+
+		# Threaded so that kept-alive connections do not block each other.
+		class ReusableTCPServer(SocketServer.ThreadingMixIn,
+				SocketServer.TCPServer):
+			allow_reuse_address = True
+			daemon_threads = True
+			__init__ = SocketServer.TCPServer.__init__
+		httpd = ReusableTCPServer(self.listen_on, self.handler)
+		try:
+			httpd.serve_forever()
+		except KeyboardInterrupt:
+			return
+		assert False
+
+	def start(self):
+		if self._process is not None:
+			raise RuntimeError("Process still running.")
+		self._process = multiprocessing.Process(
+			target = ForkingWebServer._run_server, args = (self, ))
+		self._process.daemon = True
+		self._process.start()
+
+	def stop(self):
+		if self._process is None:
+			raise RuntimeError("Process is already stopped/stopping.")
+		os.kill(self._process.pid, signal.SIGINT)
+		self._process.join()
+		assert not self._process.is_alive()
+		self._process = None
+
+	def __del__(self):
+		try:
+			self.stop()
+		except RuntimeError:
+			pass
+
+class KeepAliveHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+	"Serves files over persistent HTTP/1.1 connections."
+
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *args):
+		pass
+
+class RangeHandler(KeepAliveHandler):
+	"""
+	Serves files with strong ETags and Last-Modified dates, and honours
+	`Range`, `If-Range`, `If-None-Match` and `If-Modified-Since`.
+
+	If a file named `NAME.cut` exists next to a requested file, the next full
+	response for that file is cut off after the number of bytes it contains
+	(while still advertising the full `Content-Length`) and the marker is
+	removed. Similarly, if `NAME.delay` exists the response is delayed by the
+	number of seconds it contains, and if `NAME.not-modified` exists the next
+	response is `304 Not Modified` whatever was asked for. Every `Range`
+	header received is appended to `ranges.log` and every request (method
+	and path) to `requests.log`.
+
+	Complete `.json` files are compressed with `gzip` or `deflate` if the
+	client accepts it, and the encoding used is appended to `encodings.log`.
+
+	"""
+
+	def send_head(self):
+		with open("requests.log", "ab") as f:
+			f.write("%s %s\n" % (self.command, self.path))
+
+		path = self.translate_path(self.path)
+		if os.path.exists(path + ".delay"):
+			with open(path + ".delay", "rb") as f:
+				time.sleep(float(f.read()))
+		if not os.path.isfile(path):
+			return KeepAliveHandler.send_head(self)
+		with open(path, "rb") as f:
+			data = f.read()
+			mtime = os.fstat(f.fileno()).st_mtime
+		etag = '"%s"' % (hashlib.sha1(data).hexdigest(), )
+		last_modified = email.utils.formatdate(mtime, usegmt = True)
+
+		if_none_match = self.headers.getheader("if-none-match")
+		if_modified_since = self.headers.getheader("if-modified-since")
+		not_modified = os.path.exists(path + ".not-modified")
+		if not_modified:
+			os.remove(path + ".not-modified")
+		if (not_modified or if_none_match == etag or (if_none_match is None and
+				if_modified_since == last_modified)):
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return None
+
+		start = 0
+		range_header = self.headers.getheader("range")
+		if range_header is not None:
+			with open("ranges.log", "ab") as f:
+				f.write(range_header + "\n")
+			if self.headers.getheader("if-range", etag) == etag:
+				start = int(range_header.split("=")[1].split("-")[0])
+
+		encoding = None
+		accept_encoding = self.headers.getheader("accept-encoding", "")
+		if not start and path.endswith(".json"):
+			if "gzip" in accept_encoding:
+				encoding = "gzip"
+				compressor = zlib.compressobj(9, zlib.DEFLATED,
+					16 + zlib.MAX_WBITS)
+				body = compressor.compress(data) + compressor.flush()
+			elif "deflate" in accept_encoding:
+				encoding = "deflate"
+				body = zlib.compress(data, 9)
+			if encoding is not None:
+				with open("encodings.log", "ab") as f:
+					f.write("%s %s\n" % (self.path, encoding))
+		if encoding is None:
+			body = data[start:]
+
+		if start:
+			self.send_response(206)
+			self.send_header("Content-Range",
+				"bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+		else:
+			self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(len(body)))
+		if encoding is not None:
+			self.send_header("Content-Encoding", encoding)
+		self.send_header("ETag", etag)
+		self.send_header("Last-Modified", last_modified)
+		self.end_headers()
+
+		if not start and os.path.exists(path + ".cut"):
+			with open(path + ".cut", "rb") as f:
+				body = body[:int(f.read())]
+			os.remove(path + ".cut")
+			self.close_connection = 1
+		return io.BytesIO(body)
+
+def get_pseudo_random_bytes(nbytes):
+	return "".join([chr(random.getrandbits(8)) for i in xrange(nbytes)])
+
+def make_signed_file(directory, filename, size, key):
+	"Creates a file of random data and its signature. Returns its path."
+
+	filepath = os.path.join(directory, filename)
+	with open(filepath, "wb") as f:
+		f.write(get_pseudo_random_bytes(size))
+	with open(filepath, "rb") as f:
+		sig = signatures.sign_file(f, key)
+	with open(filepath + ".sig", "wb") as f:
+		f.write(sig)
+	return filepath
@@ -0,0 +1,343 @@
+"""
+A local, content-addressed cache of files that have already been downloaded
+and verified.
+
+Releases never change once they are published, so there is no reason to
+download (and verify) the same installer or archive twice. Every file that
+`filetransfer.get_file()` verifies can be stored here along with its
+signature, and later requests for the same URL are served straight from disk.
+
+Files are stored under their SHA-512 digest, so two URLs that serve identical
+files share a single copy. An index maps each URL to the digest and validator
+(`ETag` or `Last-Modified`) it was downloaded with, and records when it was
+last used so that the least recently used files can be evicted once the cache
+grows past its size limit.
+
+.. note::
+
+	Every file is rehashed and checked against its digest before it is handed
+	out (unless `verify_integrity` is turned off), so a file corrupted on disk
+	is treated as a miss rather than trusted.
+
+"""
+
+import logging
+log = logging.getLogger("gi.artifactcache")
+
+# gicore
+import atomicfile
+import signatures
+import util
+
+# stdlib
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+
+class ArtifactCache(object):
+	"""
+	A size-bounded cache of verified files, keyed by URL.
+
+	The cache may be shared by several threads or processes.
+
+	:ivar directory: The directory the cache lives in. It is created if it
+			does not exist. As files in the cache are handed out without
+			checking their signatures again, it must be private to the
+			current user (see `util.private_dir()`), otherwise
+			`errors.CriticalError` is raised.
+	:ivar max_size: The maximum number of bytes of files (including
+			signatures) to keep.
+	:ivar verify_integrity: Whether to rehash files before handing them out.
+	:ivar stats: A dictionary of counters: `hits`, `misses`, `stores`,
+			`evictions` and `integrity_failures`.
+
+	"""
+
+	STAT_NAMES = ("hits", "misses", "stores", "evictions",
+		"integrity_failures")
+
+	def __init__(self, directory, max_size, verify_integrity = True):
+		self.directory = directory
+		self.max_size = max_size
+		self.verify_integrity = verify_integrity
+		self.stats = dict((i, 0) for i in ArtifactCache.STAT_NAMES)
+
+		self._objects_dir = os.path.join(directory, "objects")
+		self._checkout_dir = os.path.join(directory, "checkout")
+		self._index_path = os.path.join(directory, "index.json")
+		self._lock_path = os.path.join(directory, "lock")
+		self._thread_lock = threading.Lock()
+
+		for i in (directory, self._objects_dir, self._checkout_dir):
+			try:
+				os.makedirs(i, 0700)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+			util.private_dir(i)
+
+	def hit_rate(self):
+		"""
+		:returns: The fraction of lookups that were hits, or `0.0` if there
+				have been none.
+
+		"""
+
+		total = self.stats["hits"] + self.stats["misses"]
+		return self.stats["hits"] / float(total) if total else 0.0
+
+	@contextlib.contextmanager
+	def _lock(self):
+		"Holds both the in-process and the cross-process lock on the cache."
+
+		with self._thread_lock:
+			with open(self._lock_path, "ab") as lock_file:
+				# Closing the file releases the lock.
+				fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+				yield
+
+	def _load_index(self):
+		try:
+			with open(self._index_path, "rb") as f:
+				return json.load(f)
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		except ValueError:
+			log.warning("Artifact cache index is corrupt, starting afresh.")
+		return {}
+
+	def _save_index(self, index):
+		# Saved on every hit, and a lost index only costs some misses, so it
+		# isn't worth syncing.
+		with atomicfile.AtomicFile(self._index_path,
+				durability = atomicfile.DURABILITY_NONE) as f:
+			json.dump(index, f)
+
+	def _object_path(self, digest):
+		return os.path.join(self._objects_dir, digest)
+
+	def _remove_entry(self, index, url):
+		"""
+		Removes a URL from the index, and its files if no other URL uses them.
+
+		:returns: The number of bytes freed.
+
+		"""
+
+		entry = index.pop(url)
+		if any(i["sha512"] == entry["sha512"] for i in index.values()):
+			return 0
+
+		freed = 0
+		object_path = self._object_path(entry["sha512"])
+		for i in (object_path, object_path + ".sig"):
+			try:
+				freed += os.path.getsize(i)
+				os.remove(i)
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+		return freed
+
+	def _check_integrity(self, entry):
+		object_path = self._object_path(entry["sha512"])
+		try:
+			with open(object_path, "rb") as f:
+				digest = signatures._hash_file_sha512(f).hexdigest()
+			return (digest == entry["sha512"] and
+				(not entry.get("signed", True) or
+					os.path.exists(object_path + ".sig")))
+		except IOError:
+			return False
+
+	def _checkout_copy(self, source, link = True):
+		"""
+		Makes a new path for a file in the cache that the caller may delete
+		without affecting the cache. This is a hard link if at all possible,
+		unless `link` is `False`.
+
+		"""
+
+		while True:
+			dest = os.path.join(self._checkout_dir,
+				os.urandom(16).encode("hex"))
+			if not link:
+				break
+			try:
+				os.link(source, dest)
+				return dest
+			except OSError as e:
+				if e.errno == errno.EEXIST:
+					continue
+				if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+					raise
+				break
+
+		# Linking isn't possible (or wanted) so fall back to copying.
+		fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+		with os.fdopen(fd, "wb") as out:
+			with open(source, "rb") as f:
+				shutil.copyfileobj(f, out)
+		os.chmod(dest, stat.S_IRUSR)
+		return dest
+
+	def checkout(self, url, validator = None):
+		"""
+		Looks for a file in the cache.
+
+		:param url: The URL the file was originally downloaded from.
+		:param validator: If not `None`, the entry is only used if it was
+				downloaded with this exact validator.
+
+		:returns: `None` on a miss, otherwise a tuple `(file, signature)` of
+				paths just like `filetransfer.get_file()` returns. The
+				caller owns these paths and should delete them when done.
+
+		"""
+
+		with self._lock():
+			index = self._load_index()
+			entry = index.get(url)
+			if entry is not None and validator is not None and \
+					entry.get("validator") != validator:
+				entry = None
+			if entry is not None and self.verify_integrity and \
+					not self._check_integrity(entry):
+				log.warning("Cached copy of %s is corrupt, discarding.", url)
+				self.stats["integrity_failures"] += 1
+				self._remove_entry(index, url)
+				self._save_index(index)
+				entry = None
+			if entry is None:
+				self.stats["misses"] += 1
+				return None
+
+			entry["last_used"] = time.time()
+			self._save_index(index)
+
+			object_path = self._object_path(entry["sha512"])
+			file_path = self._checkout_copy(object_path)
+			try:
+				sig_path = None
+				if entry.get("signed", True):
+					sig_path = self._checkout_copy(object_path + ".sig")
+			except:
+				os.remove(file_path)
+				raise
+			self.stats["hits"] += 1
+			return file_path, sig_path
+
+	def lookup(self, url):
+		"""
+		:returns: The index entry for a URL (a dictionary with the keys
+				`sha512`, `size`, `validator`, `signed` and `last_used`), or
+				`None`. The cache is not otherwise touched.
+
+		"""
+
+		with self._lock():
+			return self._load_index().get(url)
+
+	def object_paths(self, url):
+		"""
+		Finds where a URL's file and signature are kept in the cache, without
+		checking them out. They must only be read, and may be evicted at any
+		time (though a file that is already open remains readable).
+
+		:returns: A tuple `(file, signature)` of paths, or `None` if the URL
+				is not in the cache. The signature is `None` if the file was
+				stored without one.
+
+		"""
+
+		entry = self.lookup(url)
+		if entry is None:
+			return None
+		object_path = self._object_path(entry["sha512"])
+		if not entry.get("signed", True):
+			return object_path, None
+		return object_path, object_path + ".sig"
+
+	def store(self, url, file_path, sig_path, digest, validator = None,
+			link = True):
+		"""
+		Adds a verified file to the cache, evicting least recently used files
+		if necessary.
+
+		The caller's files are left where they are (they are hard linked or
+		copied into the cache).
+
+		:param url: The URL the file was downloaded from.
+		:param file_path: The path to the verified file.
+		:param sig_path: The path to its signature, or `None` if it was
+				verified some other way (ex: against a signed manifest).
+		:param digest: The file's SHA-512 digest as a hex string.
+		:param validator: The `ETag` or `Last-Modified` the server sent with
+				the file, if any.
+		:param link: If `False`, the files are always copied. Linking them is
+				only safe if the caller's files will never be changed in
+				place, as a change would corrupt the cache's copy too.
+
+		"""
+
+		size = os.path.getsize(file_path)
+		if sig_path is not None:
+			size += os.path.getsize(sig_path)
+		if size > self.max_size:
+			return
+
+		with self._lock():
+			index = self._load_index()
+			if url in index:
+				self._remove_entry(index, url)
+
+			object_path = self._object_path(digest)
+			for source, dest in ((file_path, object_path),
+					(sig_path, object_path + ".sig")):
+				if source is None or os.path.exists(dest):
+					continue
+				temp_path = self._checkout_copy(source, link)
+				os.rename(temp_path, dest)
+
+			index[url] = {
+				"sha512": digest,
+				"size": size,
+				"validator": validator,
+				"signed": sig_path is not None,
+				"last_used": time.time()
+			}
+			self.stats["stores"] += 1
+			self._evict(index, keep = url)
+			self._save_index(index)
+
+	def _evict(self, index, keep):
+		total = sum(i["size"] for i in
+			dict((j["sha512"], j) for j in index.values()).values())
+		by_age = sorted(index.keys(), key = lambda k: index[k]["last_used"])
+		for url in by_age:
+			if total <= self.max_size:
+				break
+			if url == keep:
+				continue
+			total -= self._remove_entry(index, url)
+			self.stats["evictions"] += 1
+
+	def clear_checkouts(self):
+		"""
+		Deletes any checked out files that callers have left lying around.
+
+		"""
+
+		with self._lock():
+			for i in os.listdir(self._checkout_dir):
+				try:
+					os.remove(os.path.join(self._checkout_dir, i))
+				except OSError:
+					log.exception("Could not delete %s.", i)
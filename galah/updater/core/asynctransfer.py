@@ -0,0 +1,385 @@
+"""
+An event driven transfer engine for retrieving large numbers of files at once.
+
+`filetransfer.get_files()` needs a thread per concurrent transfer, which is
+fine for a single machine's upgrade but not for a controller that checks on
+hundreds of packages and mirrors at once. `TransferEngine` instead drives
+every transfer from a single `asyncore` event loop. The only work done off
+the loop is the hashing and RSA verification of completed files, which is
+handed to a small pool of worker threads so that the loop never blocks on
+it.
+
+The contract is the same as `filetransfer.get_file()`'s: files are stored in
+temporary files readable only by the current user (mode 0400), `max_size` is
+enforced while receiving, every file is verified against its signature and
+the trusted public key, and nothing is left behind on failure.
+
+.. note::
+
+	Host names are resolved with a (blocking) call to `socket.getaddrinfo()`
+	when each transfer starts. Use IP addresses if that is a concern.
+
+"""
+
+import logging
+log = logging.getLogger("gi.asynctransfer")
+
+# gicore
+import errors
+import filetransfer
+import signatures
+
+# stdlib
+import asyncore
+import errno
+import fcntl
+import httplib
+import mimetools
+import multiprocessing.pool
+import os
+import Queue
+import socket
+import stat
+import StringIO
+import sys
+import tempfile
+import time
+
+# Reading more than this many bytes while looking for the end of the headers
+# is considered an error.
+MAX_HEADER_SIZE = 64 * 1024
+
+def _split_server(server):
+	"Splits `host:port` (the port being optional) into `(host, port)`."
+
+	host, _, port = server.rpartition(":")
+	if not host or not port.isdigit():
+		return server, httplib.HTTP_PORT
+	return host.strip("[]"), int(port)
+
+class _HTTPGet(asyncore.dispatcher):
+	"""
+	Retrieves a single file over HTTP/1.0 into a secure temporary file.
+
+	:ivar file_path: Where the file is being written to. Deleted if the
+			transfer fails.
+	:ivar error: The exception the transfer failed with, if it has.
+
+	"""
+
+	def __init__(self, socket_map, server, path, max_size, timeout, on_done):
+		asyncore.dispatcher.__init__(self, map = socket_map)
+		self._server = server
+		self._max_size = max_size
+		self._timeout = timeout
+		self._on_done = on_done
+		self._done = False
+		self._header_buffer = ""
+		self._content_length = None
+		self._received = None # None until the headers have been parsed
+		self._deadline = time.time() + timeout
+		self._request = "GET %s HTTP/1.0\r\nHost: %s\r\n\r\n" % (path, server)
+
+		self.error = None
+		self.file_path = None
+		self._file = None
+
+	def start(self):
+		"Opens the temporary file and starts connecting to the server."
+
+		try:
+			os_handle, self.file_path = tempfile.mkstemp()
+			self._file = os.fdopen(os_handle, "wb")
+			host, port = _split_server(self._server)
+			family, socktype, proto, _, address = socket.getaddrinfo(
+				host, port, 0, socket.SOCK_STREAM)[0]
+			self.create_socket(family, socktype)
+			self.connect(address)
+		except Exception as e:
+			self._fail(e)
+
+	def check_timeout(self, now):
+		if not self._done and now > self._deadline:
+			self._fail(socket.timeout("timed out"))
+
+	def writable(self):
+		# We need to be told when the connection is established.
+		return not self.connected or bool(self._request)
+
+	def handle_connect(self):
+		pass
+
+	def handle_write(self):
+		sent = self.send(self._request)
+		self._request = self._request[sent:]
+		self._deadline = time.time() + self._timeout
+
+	def handle_read(self):
+		data = self.recv(filetransfer.MAX_CHUNK_SIZE)
+		if self._done or not data:
+			return
+		self._deadline = time.time() + self._timeout
+
+		if self._received is None:
+			self._header_buffer += data
+			end = self._header_buffer.find("\r\n\r\n")
+			if end == -1:
+				if len(self._header_buffer) > MAX_HEADER_SIZE:
+					raise httplib.LineTooLong("headers")
+				return
+			data = self._header_buffer[end + 4:]
+			self._parse_headers(self._header_buffer[:end + 2])
+			self._header_buffer = None
+
+		self._received += len(data)
+		if self._received > self._max_size:
+			raise IOError("File exceeds max download size.")
+		self._file.write(data)
+
+	def _parse_headers(self, raw):
+		status_line, _, raw_headers = raw.partition("\r\n")
+		try:
+			version, status = status_line.split(None, 2)[:2]
+			status = int(status)
+		except ValueError:
+			raise httplib.BadStatusLine(status_line)
+		if status != httplib.OK:
+			raise IOError("Server returned %d error code." % (status, ))
+
+		headers = mimetools.Message(StringIO.StringIO(raw_headers))
+		content_length = headers.getheader("content-length")
+		if content_length is not None:
+			self._content_length = int(content_length)
+			if self._content_length > self._max_size:
+				raise IOError("File exceeds max download size.")
+		self._received = 0
+
+	def handle_close(self):
+		if self._done:
+			return
+		if self._received is None:
+			self._fail(httplib.BadStatusLine(""))
+		elif self._content_length is not None and \
+				self._received != self._content_length:
+			self._fail(httplib.IncompleteRead("",
+				self._content_length - self._received))
+		else:
+			self._finish()
+
+	def handle_error(self):
+		self._fail(sys.exc_info()[1])
+
+	def _finish(self):
+		self._done = True
+		self.close()
+		self._file.close()
+		os.chmod(self.file_path, stat.S_IRUSR)
+		self._on_done(self)
+
+	def _fail(self, error):
+		if self._done:
+			return
+		self._done = True
+		self.error = error
+		if self.socket is not None:
+			self.close()
+		if self._file is not None:
+			self._file.close()
+		if self.file_path is not None:
+			filetransfer._remove_quietly(self.file_path)
+		self._on_done(self)
+
+	def abort(self):
+		"Stops the transfer and deletes anything received so far."
+
+		self._fail(IOError("Transfer cancelled."))
+
+class _Waker(asyncore.file_dispatcher):
+	"Lets worker threads wake up the event loop by writing to a pipe."
+
+	def __init__(self, socket_map):
+		read_fd, self._write_fd = os.pipe()
+		fcntl.fcntl(self._write_fd, fcntl.F_SETFL,
+			fcntl.fcntl(self._write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		asyncore.file_dispatcher.__init__(self, read_fd, map = socket_map)
+		os.close(read_fd) # file_dispatcher made its own copy
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		self.recv(4096)
+
+	def wake(self):
+		try:
+			os.write(self._write_fd, "x")
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EPIPE, errno.EBADF):
+				raise
+
+	def close(self):
+		asyncore.file_dispatcher.close(self)
+		os.close(self._write_fd)
+
+def _verify(file_path, sig_path, pub_key):
+	"""
+	Runs on a worker thread. Hashes a file and checks its signature.
+
+	:returns: `True` if the file verified, `False` otherwise (including if
+			it could not be read).
+
+	"""
+
+	try:
+		with open(file_path, "rb") as f:
+			with open(sig_path, "rb") as sig_file:
+				return signatures.verify_file(f, sig_file, pub_key)
+	except Exception:
+		log.exception("Could not verify %s.", file_path)
+		return False
+
+class _Job(object):
+	"""
+	Tracks the two transfers (file and signature) made for a single
+	`filetransfer.FileRequest`.
+
+	"""
+
+	def __init__(self, request):
+		self.request = request
+		self.transfers = []
+		self.remaining = 2
+
+	def url(self):
+		return "%s/%s" % (self.request.server, self.request.path)
+
+	def paths(self):
+		return [i.file_path for i in self.transfers if i.file_path is not None]
+
+	def discard(self):
+		for i in self.transfers:
+			i.abort()
+		filetransfer._remove_quietly(*self.paths())
+
+class TransferEngine(object):
+	"""
+	Retrieves and verifies many files concurrently from one event loop.
+
+	:ivar max_concurrency: The maximum number of files being transferred at
+			once (each one also needs a connection for its signature).
+	:ivar executor_workers: The number of threads hashing and verifying
+			completed files.
+
+	"""
+
+	def __init__(self, max_concurrency = 64, executor_workers = 2):
+		if max_concurrency < 1 or executor_workers < 1:
+			raise ValueError(
+				"max_concurrency and executor_workers must be positive.")
+		self.max_concurrency = max_concurrency
+		self.executor_workers = executor_workers
+
+	def run(self, requests):
+		"""
+		Retrieves and verifies files.
+
+		:param requests: An iterable of `filetransfer.FileRequest` objects.
+				They may not carry any extra `options`.
+
+		:returns: An iterator over `filetransfer.FileResult` objects, in the
+				order they complete, just like `filetransfer.get_files()`.
+				If the iterator is closed early, every transfer still in
+				progress is aborted and its files deleted.
+
+		"""
+
+		pending = list(requests)
+		for request in pending:
+			if request.options:
+				raise ValueError("TransferEngine does not support %s." % (
+					", ".join(sorted(request.options)), ))
+
+		socket_map = {}
+		waker = _Waker(socket_map)
+		verified = Queue.Queue()
+		executor = multiprocessing.pool.ThreadPool(self.executor_workers)
+		active = set()
+		verifying = set()
+		ready = []
+
+		def on_done(job, transfer):
+			job.remaining -= 1
+			if transfer.error is not None and job in active:
+				# No point carrying on with the other half.
+				active.discard(job)
+				job.discard()
+				error = transfer.error
+				if transfer is job.transfers[1]:
+					# A missing signature means the file can't be verified.
+					error = errors.VerificationError(job.url())
+				ready.append(filetransfer.FileResult(job.request,
+					error = error))
+			elif job.remaining == 0 and job in active:
+				active.discard(job)
+				verifying.add(job)
+				file_path, sig_path = job.paths()
+				def callback(result, job = job):
+					verified.put((job, result))
+					waker.wake()
+				executor.apply_async(_verify,
+					(file_path, sig_path, job.request.pub_key),
+					callback = callback)
+
+		def start(request):
+			job = _Job(request)
+			active.add(job)
+			sig_size = signatures.signature_size(request.pub_key)
+			for path, max_size in ((request.path, request.max_size),
+					(request.path + ".sig", sig_size)):
+				job.transfers.append(_HTTPGet(socket_map, request.server,
+					path, max_size, request.timeout,
+					lambda transfer, job = job: on_done(job, transfer)))
+			for transfer in job.transfers:
+				if job not in active:
+					break # the first transfer failed immediately
+				transfer.start()
+
+		try:
+			while pending or active or verifying or ready:
+				while pending and len(active) < self.max_concurrency:
+					start(pending.pop(0))
+
+				while ready:
+					yield ready.pop(0)
+
+				if active or verifying:
+					asyncore.loop(timeout = 0.1, map = socket_map, count = 1)
+					now = time.time()
+					for job in list(active):
+						for transfer in job.transfers:
+							transfer.check_timeout(now)
+
+				while not verified.empty():
+					job, result = verified.get()
+					verifying.discard(job)
+					if result:
+						file_path, sig_path = job.paths()
+						ready.append(filetransfer.FileResult(job.request,
+							file_path, sig_path))
+					else:
+						filetransfer._remove_quietly(*job.paths())
+						ready.append(filetransfer.FileResult(job.request,
+							error = errors.VerificationError(job.url())))
+		finally:
+			for job in list(active):
+				job.discard()
+			executor.close()
+			executor.join()
+			while not verified.empty():
+				job, result = verified.get()
+				filetransfer._remove_quietly(*job.paths())
+			for result in ready:
+				if result.error is None:
+					filetransfer._remove_quietly(result.file_path,
+						result.sig_path)
+			waker.close()
@@ -16,13 +16,129 @@ This module helps support atomic filesystem operations.
     the *AtomicFile Licensing Considerations* document for more
     information.
 
+Durability
+----------
+
+Renaming a file into place makes the change atomic, but not durable: after
+a crash or power loss the rename may have reached the disk while the data it
+refers to has not, leaving an empty or partial file where the old one used
+to be. Each `AtomicFile` therefore has one of the following durability
+modes.
+
+* `DURABILITY_NONE`: Nothing is synced. Suitable for caches and other files
+  that can be recreated, and the fastest.
+* `DURABILITY_FILE`: The data is synced (with `fdatasync`) before the file
+  is renamed into place, and the directory is synced after, so once
+  `close()` returns the new file will survive a crash. This is the default
+  (see `default_durability`) and costs two syncs per file.
+* `DURABILITY_GROUP`: The file belongs to a `CommitGroup`, which syncs the
+  data of all of its files in one batch, renames them all, and then syncs
+  each directory involved once. Writing thousands of files this way costs
+  little more than writing a handful.
+
+A `CommitGroup` makes each of its files durable, but a crash part way
+through renaming them can still leave some replaced and others not. An
+`AtomicTransaction` goes further and replaces all of its files or none of
+them, by keeping a journal that `AtomicTransaction.recover()` uses to finish
+or undo an interrupted commit.
+
+Preallocation
+-------------
+
+An `AtomicFile` that is told how large it will be (its `expected_size`, or
+later through `preallocate()`) reserves that much space up front with
+`posix_fallocate`, so a full disk is noticed before anything is written
+rather than part way through, and the filesystem can lay the file out in
+one piece. Its writes are then coalesced into blocks of `WRITE_BLOCK_SIZE`
+bytes, each starting at a multiple of that size, instead of being passed on
+one small chunk at a time. On platforms without `posix_fallocate` the space
+is simply not reserved.
+
 """
 
 # stdlib
+import ctypes
 import errno
+import json
+import multiprocessing.pool
 import os
 import tempfile
 
+DURABILITY_NONE = "none"
+DURABILITY_FILE = "file"
+DURABILITY_GROUP = "group"
+
+# The durability of an AtomicFile that isn't given one explicitly.
+default_durability = DURABILITY_FILE
+
+# Not every platform has fdatasync (OS X doesn't), but they all have fsync.
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# Writes to a preallocated AtomicFile are coalesced into blocks of this size.
+WRITE_BLOCK_SIZE = 1024 * 1024
+
+def _load_posix_fallocate():
+    """
+    :returns: A function like Python 3's `os.posix_fallocate()`, or `None`
+            if the C library doesn't have one.
+
+    """
+
+    try:
+        libc = ctypes.CDLL(None)
+        func = getattr(libc, "posix_fallocate64", None) or \
+            libc.posix_fallocate
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    func.restype = ctypes.c_int
+
+    def posix_fallocate(fd, offset, length):
+        # Unlike most of libc, the error is returned rather than set in errno.
+        error = func(fd, offset, length)
+        if error:
+            raise OSError(error, os.strerror(error))
+    return posix_fallocate
+
+_posix_fallocate = getattr(os, "posix_fallocate", None) or \
+    _load_posix_fallocate()
+
+def preallocate(fd, size):
+    """
+    Reserves disk space for the first `size` bytes of a file. If the file was
+    shorter it is extended (with zeros) to `size` bytes.
+
+    :param fd: A file descriptor open for writing.
+
+    :raises OSError: If there isn't enough space (`ENOSPC`). Platforms and
+            filesystems that can't preallocate are silently ignored.
+
+    """
+
+    if _posix_fallocate is None or size <= 0:
+        return
+    try:
+        _posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+
+def _fsync_dir(path):
+    """
+    Syncs a directory, so that renames and new entries in it are durable.
+    Filesystems that can't sync directories are silently ignored.
+
+    """
+
+    fd = os.open(path or os.curdir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EBADF):
+            raise
+    finally:
+        os.close(fd)
+
 def _check_filesystems(path_a, path_b):
     """
     Determines if two files are on the same filesystem.
@@ -43,7 +159,7 @@ def _check_filesystems(path_a, path_b):
     try:
         dev_b = os.lstat(path_b).st_dev
     except OSError:
-        deb_b = os.lstat(os.path.dirname(path_b)).st_dev
+        dev_b = os.lstat(os.path.dirname(path_b)).st_dev
     return dev_a == dev_b
 
 def _make_temp(path):
@@ -90,23 +206,73 @@ class AtomicFile(object):
     If the object is destroyed without being closed, all your writes are
     discarded.
 
+    :ivar durability: One of the `DURABILITY_*` constants (see the module's
+            documentation).
+    :ivar group: The `CommitGroup` the file belongs to if `durability` is
+            `DURABILITY_GROUP`, otherwise `None`. Closing such a file only
+            hands it to the group, and it is not moved over the original
+            until the group is committed.
+    :ivar temp_path: The path of the temporary file being written to. It is
+            on the same filesystem as the file it will replace.
+    :ivar closed: Whether the file has been closed or discarded.
+
+    If `expected_size` is given, that much space is preallocated and writes
+    are coalesced (see the module's documentation). The file may still end
+    up larger or smaller than expected.
+
     """
 
     supported_modes = ["wb"]
 
-    def __init__(self, path, mode = "wb"):
+    def __init__(self, path, mode = "wb", durability = None, group = None,
+            expected_size = None):
         if mode not in AtomicFile.supported_modes:
             raise NotImplemented(
                 "mode must be one of %s" % (str(supported_modes), )
             )
 
+        if group is not None:
+            if durability not in (None, DURABILITY_GROUP):
+                raise ValueError("durability must be DURABILITY_GROUP for a "
+                    "file in a group.")
+            durability = DURABILITY_GROUP
+        else:
+            if durability is None:
+                durability = default_durability
+            if durability == DURABILITY_GROUP:
+                raise ValueError("DURABILITY_GROUP requires a group.")
+            if durability not in (DURABILITY_NONE, DURABILITY_FILE):
+                raise ValueError("Unknown durability %r." % (durability, ))
+        self.durability = durability
+        self.group = group
+
         self._path = path  # permanent path
         self._temp_file, self._temp_path = _make_temp(path)
+        self._allocated = 0
+        self._written = 0
+        self._buffer = None # only used once preallocated
 
         # delegated methods
         self.write = self._temp_file.write
         self.fileno = self._temp_file.fileno
 
+        if expected_size is not None:
+            try:
+                self.preallocate(expected_size)
+            except:
+                self.discard()
+                raise
+        if group is not None:
+            group._open.append(self)
+
+    @property
+    def temp_path(self):
+        return self._temp_path
+
+    @property
+    def closed(self):
+        return self._temp_file.closed
+
     def __enter__(self):
         return self
 
@@ -118,15 +284,74 @@ class AtomicFile(object):
     def read(self):
         raise NotImplemented()
 
+    def preallocate(self, size):
+        """
+        Reserves space for the file to grow to `size` bytes, and starts
+        coalescing writes.
+
+        :raises OSError: If there isn't enough space.
+
+        """
+
+        self._temp_file.flush()
+        preallocate(self._temp_file.fileno(), size)
+        self._allocated = max(self._allocated, size)
+        if self._buffer is None:
+            self._written = self._temp_file.tell()
+            self._buffer = bytearray()
+            self.write = self._write_coalesced
+
+    def _write_coalesced(self, data):
+        self._written += len(data)
+        self._buffer += data
+        if len(self._buffer) >= WRITE_BLOCK_SIZE:
+            # Whatever has been written so far is a whole number of blocks.
+            nbytes = len(self._buffer) - len(self._buffer) % WRITE_BLOCK_SIZE
+            self._temp_file.write(self._buffer[:nbytes])
+            del self._buffer[:nbytes]
+
+    def flush(self):
+        """
+        Flushes everything written so far to the temporary file, giving back
+        any preallocated space beyond it.
+
+        """
+
+        if self._buffer:
+            self._temp_file.write(self._buffer)
+            del self._buffer[:]
+        self._temp_file.flush()
+        if self._allocated > self._written:
+            os.ftruncate(self._temp_file.fileno(), self._written)
+            self._allocated = self._written
+
     def close(self):
-        if not self._temp_file.closed:
+        if self._temp_file.closed:
+            return
+        self.flush()
+        if self.group is not None:
+            # The group syncs the data later through its own descriptor.
+            fd = os.dup(self._temp_file.fileno())
             self._temp_file.close()
-            # Because they are in the same directory, this should never happen.
-            # If it does occur, the write may not be atomic.
-            assert _check_filesystems(self._temp_path, self._path)
-            os.rename(self._temp_path, self._path)
+            self.group._add(self, fd)
+            return
+
+        if self.durability == DURABILITY_FILE:
+            _fdatasync(self._temp_file.fileno())
+        self._temp_file.close()
+        self._rename()
+        if self.durability == DURABILITY_FILE:
+            _fsync_dir(os.path.dirname(self._path))
+
+    def _rename(self):
+        # Because they are in the same directory, this should never happen.
+        # If it does occur, the write may not be atomic.
+        assert _check_filesystems(self._temp_path, self._path)
+        os.rename(self._temp_path, self._path)
 
     def discard(self):
+        if self.group is not None:
+            self.group._forget(self)
         if self._temp_file.closed:
             raise ValueError("File already closed.")
 
@@ -141,3 +366,308 @@ class AtomicFile(object):
         temp_file = getattr(self, "_temp_file", None)
         if temp_file is not None and not temp_file.closed:
             self.discard()
+
+class CommitGroup(object):
+    """
+    Commits many `AtomicFile` objects together, durably, with as few syncs
+    as possible.
+
+    Files are created with `open()` (or by passing `group` to `AtomicFile`)
+    and written and closed as usual, but none of them replace their
+    originals until `commit()` is called. It then syncs the data of every
+    file (several at once, so that the disk can work on them together),
+    renames them all into place and syncs each directory involved just
+    once.
+
+    Used as a context manager, the group is committed when the block
+    finishes, or discarded if it raises an exception.
+
+    :ivar workers: How many files' data to sync at once.
+
+    """
+
+    def __init__(self, workers = 8):
+        self.workers = workers
+        self._open = []
+        self._pending = [] # (file, descriptor) tuples
+
+    def open(self, path, expected_size = None):
+        ":returns: A new `AtomicFile` for `path` in this group."
+
+        return AtomicFile(path, group = self, expected_size = expected_size)
+
+    def _add(self, atomic_file, fd):
+        "Called by `AtomicFile.close()`."
+
+        if atomic_file in self._open:
+            self._open.remove(atomic_file)
+        self._pending.append((atomic_file, fd))
+
+    def _forget(self, atomic_file):
+        "Called by `AtomicFile.discard()` on a file that is still open."
+
+        if atomic_file in self._open:
+            self._open.remove(atomic_file)
+
+    def __len__(self):
+        ":returns: The number of closed files waiting to be committed."
+
+        return len(self._pending)
+
+    def _sync_pending(self):
+        """
+        Syncs the data of every closed file and takes them out of the group.
+
+        :raises ValueError: If any file in the group has not been closed.
+
+        :returns: The list of closed `AtomicFile` objects, ready to be renamed
+                into place.
+
+        """
+
+        if self._open:
+            raise ValueError("%d file(s) in the group are still open." %
+                (len(self._open), ))
+        pending, self._pending = self._pending, []
+        fds = [fd for _, fd in pending]
+        try:
+            if self.workers > 1 and len(fds) > 1:
+                pool = multiprocessing.pool.ThreadPool(
+                    min(self.workers, len(fds)))
+                try:
+                    pool.map(_fdatasync, fds)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for fd in fds:
+                    _fdatasync(fd)
+        except:
+            self._pending = pending
+            raise
+        for fd in fds:
+            os.close(fd)
+        return [atomic_file for atomic_file, _ in pending]
+
+    def commit(self):
+        """
+        Durably moves every closed file over its original.
+
+        :raises ValueError: If any file in the group has not been closed.
+
+        If a file can't be moved into place, the files that haven't been
+        moved yet are deleted before the exception is raised.
+
+        """
+
+        staged = self._sync_pending()
+        directories = set()
+        renamed = 0
+        try:
+            for atomic_file in staged:
+                atomic_file._rename()
+                renamed += 1
+                directories.add(os.path.dirname(atomic_file._path))
+        except:
+            for atomic_file in staged[renamed:]:
+                _remove_quietly(atomic_file._temp_path)
+            raise
+        for i in sorted(directories):
+            _fsync_dir(i)
+
+    def discard(self):
+        "Discards every file in the group, whether closed or not."
+
+        for i in list(self._open):
+            i.discard()
+        for atomic_file, fd in self._pending:
+            os.close(fd)
+            try:
+                os.remove(atomic_file._temp_path)
+            except OSError:
+                pass
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type:
+            self.discard()
+            return
+        self.commit()
+
+# The states an AtomicTransaction's journal can be in.
+_PREPARED = "prepared"
+_COMMITTED = "committed"
+
+def _backup_path(path):
+    ":returns: An unused path to keep the original of `path` at."
+
+    dir_path, filename = os.path.split(path)
+    while True:
+        backup = os.path.join(dir_path, ".%s-%s.orig" % (filename,
+            os.urandom(6).encode("hex")))
+        if not os.path.lexists(backup):
+            return backup
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class AtomicTransaction(CommitGroup):
+    """
+    Replaces many files at once, such that either all of them are replaced
+    or (after a crash, once `recover()` has run) none of them are.
+
+    Files are staged just as for a `CommitGroup`. `commit()` then
+
+    #. syncs the data of every staged file,
+    #. durably writes a journal listing every file to be replaced,
+    #. hard links each existing original to a backup path next to it,
+    #. renames every staged file over its original,
+    #. marks the journal committed, and finally
+    #. deletes the backups and the journal.
+
+    Nothing is ever copied, so a commit costs a few syncs plus a link and a
+    rename per file. If the process dies part way through, `recover()`
+    (which should be called before the files are next used, ex: when the
+    installer starts) restores every original if the journal had not been
+    marked committed yet, and otherwise finishes the commit.
+
+    :ivar journal_path: Where the journal is kept. It should be on local
+            storage that is not cleaned up on boot, and only one transaction
+            may use it at a time.
+
+    """
+
+    def __init__(self, journal_path, workers = 8):
+        if os.path.lexists(journal_path):
+            raise RuntimeError("Journal %s exists, run recover() first." %
+                (journal_path, ))
+        CommitGroup.__init__(self, workers)
+        self.journal_path = journal_path
+
+    def _write_journal(self, state, entries):
+        with AtomicFile(self.journal_path,
+                durability = DURABILITY_FILE) as f:
+            json.dump({"state": state, "files": entries}, f)
+
+    def commit(self):
+        """
+        Replaces every original with its staged file.
+
+        :raises ValueError: If any file in the transaction has not been
+                closed, or the same path was staged twice.
+
+        If anything goes wrong, every original is put back before the
+        exception is raised.
+
+        """
+
+        targets = [os.path.abspath(i._path) for i, _ in self._pending]
+        if len(set(targets)) != len(targets):
+            raise ValueError("A file was staged more than once.")
+        staged = self._sync_pending()
+        if not staged:
+            return
+
+        entries = []
+        for atomic_file in staged:
+            target = os.path.abspath(atomic_file._path)
+            entries.append({
+                "target": target,
+                "staged": os.path.abspath(atomic_file._temp_path),
+                "backup": _backup_path(target)
+                    if os.path.lexists(target) else None
+            })
+        directories = sorted(set(os.path.dirname(i["target"])
+            for i in entries))
+
+        try:
+            self._write_journal(_PREPARED, entries)
+            for entry in entries:
+                if entry["backup"] is not None:
+                    os.link(entry["target"], entry["backup"])
+            for i in directories:
+                _fsync_dir(i)
+            for entry in entries:
+                os.rename(entry["staged"], entry["target"])
+            for i in directories:
+                _fsync_dir(i)
+        except:
+            _roll_back(entries)
+            _remove_quietly(self.journal_path)
+            raise
+
+        self._write_journal(_COMMITTED, entries)
+        _roll_forward(entries)
+        _remove_quietly(self.journal_path)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.journal_path)))
+
+    @staticmethod
+    def recover(journal_path):
+        """
+        Finishes or undoes a commit that was interrupted.
+
+        :param journal_path: The journal the transaction used.
+
+        :returns: `None` if there was nothing to recover, `"rolled-back"` if
+                the originals were restored, or `"rolled-forward"` if the
+                commit was completed.
+
+        """
+
+        try:
+            with open(journal_path, "rb") as f:
+                journal = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            # The journal is written atomically, so this can only be a
+            # journal that never made it to disk, before anything else was
+            # touched.
+            _remove_quietly(journal_path)
+            return "rolled-back"
+
+        if journal["state"] == _COMMITTED:
+            _roll_forward(journal["files"])
+            result = "rolled-forward"
+        else:
+            _roll_back(journal["files"])
+            result = "rolled-back"
+        _remove_quietly(journal_path)
+        _fsync_dir(os.path.dirname(os.path.abspath(journal_path)))
+        return result
+
+def _roll_back(entries):
+    "Puts back every original (or removes files that had none)."
+
+    for entry in entries:
+        if entry["backup"] is not None:
+            if os.path.lexists(entry["backup"]):
+                os.rename(entry["backup"], entry["target"])
+                # Renaming does nothing if the staged file was never
+                # renamed over the original, as the backup is then a link
+                # to the same file.
+                _remove_quietly(entry["backup"])
+        elif not os.path.lexists(entry["staged"]):
+            # The file is new and was renamed into place already.
+            _remove_quietly(entry["target"])
+        _remove_quietly(entry["staged"])
+    for i in sorted(set(os.path.dirname(i["target"]) for i in entries)):
+        _fsync_dir(i)
+
+def _roll_forward(entries):
+    "Renames any file not yet in place and removes the backups."
+
+    for entry in entries:
+        if os.path.lexists(entry["staged"]):
+            os.rename(entry["staged"], entry["target"])
+        if entry["backup"] is not None:
+            _remove_quietly(entry["backup"])
@@ -0,0 +1,236 @@
+"""
+A pool of persistent HTTP/1.1 connections.
+
+Fetching a single package can mean pulling down a long chain of version-info
+files, installers, migrations and archives from the same server. Rather than
+paying for a TCP handshake on every file, connections are kept open after a
+response has been fully read and handed back out to the next request for the
+same server.
+
+.. note::
+
+	A pooled connection may be closed by the server at any time while it sits
+	idle. Callers should use `send_request()` which will transparently retry
+	once on a fresh socket if a kept-alive connection turns out to be dead.
+
+"""
+
+import logging
+log = logging.getLogger("gi.connectionpool")
+
+# stdlib
+import httplib
+import socket
+import threading
+import time
+
+class PooledConnection(httplib.HTTPConnection):
+	"""
+	An `httplib.HTTPConnection` that remembers which pool it belongs to.
+
+	:ivar pool: The `ConnectionPool` that created this connection.
+	:ivar server: The server this connection is to, exactly as it was given to
+			the pool (ex: `localhost:8080`).
+	:ivar dns_time: The number of seconds it took to resolve the server's
+			name the last time the connection was established, or `None`.
+	:ivar connect_time: The number of seconds it took to establish the TCP
+			connection the last time it was established, or `None`.
+
+	"""
+
+	def __init__(self, pool, server, timeout):
+		httplib.HTTPConnection.__init__(self, host = server, timeout = timeout)
+		self.pool = pool
+		self.server = server
+		self.dns_time = None
+		self.connect_time = None
+
+	def connect(self):
+		# Does the same as httplib's implementation, but resolves the name
+		# separately so that the two steps can be timed.
+		start = time.time()
+		addresses = socket.getaddrinfo(self.host, self.port, 0,
+			socket.SOCK_STREAM)
+		self.dns_time = time.time() - start
+
+		error = socket.error("getaddrinfo returns an empty list")
+		for family, socktype, proto, _, address in addresses:
+			start = time.time()
+			try:
+				self.sock = socket.create_connection(address[:2],
+					self.timeout, self.source_address)
+			except socket.error as e:
+				error = e
+				continue
+			self.connect_time = time.time() - start
+			if self._tunnel_host:
+				self._tunnel()
+			return
+		raise error
+
+class ConnectionPool(object):
+	"""
+	A thread-safe pool of idle HTTP connections, keyed by server.
+
+	:ivar max_idle: The maximum number of idle connections kept for any one
+			server. Connections released beyond this are closed.
+	:ivar idle_timeout: The number of seconds a connection may sit idle in the
+			pool before it is closed rather than reused.
+	:ivar stats: A dictionary of counters. `hits` and `misses` count calls to
+			`acquire()` that did and did not find an idle connection,
+			`created` counts new connections, `reused` counts requests sent
+			on an already-open socket, `reconnects` counts dropped connections
+			that were recovered, and `expired` counts idle connections closed
+			because of `idle_timeout`.
+
+	"""
+
+	STAT_NAMES = ("hits", "misses", "created", "reused", "reconnects",
+		"expired")
+
+	def __init__(self, max_idle = 4, idle_timeout = 15):
+		self.max_idle = max_idle
+		self.idle_timeout = idle_timeout
+		self.stats = dict((i, 0) for i in ConnectionPool.STAT_NAMES)
+
+		# Maps servers to lists of (connection, time released) tuples, most
+		# recently released last.
+		self._idle = {}
+		self._lock = threading.Lock()
+
+	def record(self, stat, amount = 1):
+		"Increments one of the counters in `stats`."
+
+		with self._lock:
+			self.stats[stat] += amount
+
+	def hit_rate(self):
+		"""
+		:returns: The fraction of calls to `acquire()` that were satisfied by
+				an idle connection, or `0.0` if there have been no calls.
+
+		"""
+
+		with self._lock:
+			total = self.stats["hits"] + self.stats["misses"]
+			return self.stats["hits"] / float(total) if total else 0.0
+
+	def acquire(self, server, timeout):
+		"""
+		Gets a connection to a server, reusing an idle one if possible.
+
+		:param server: The hostname or IP address of the server. Can contain a
+				port number (ex: `localhost:8080`).
+		:param timeout: The number of seconds to wait for each blocking network
+				operation on the connection.
+
+		:returns: A `PooledConnection` that is not awaiting a response.
+
+		"""
+
+		expired = []
+		con = None
+		with self._lock:
+			idle = self._idle.get(server, [])
+			now = time.time()
+			while idle:
+				candidate, released_at = idle.pop()
+				if now - released_at > self.idle_timeout:
+					expired.append(candidate)
+				else:
+					con = candidate
+					break
+			self.stats["expired"] += len(expired)
+			if con is None:
+				self.stats["misses"] += 1
+				self.stats["created"] += 1
+			else:
+				self.stats["hits"] += 1
+
+		# Closing sockets may block, so do it outside of the lock.
+		for i in expired:
+			i.close()
+
+		if con is None:
+			con = PooledConnection(self, server, timeout)
+		else:
+			con.timeout = timeout
+			if con.sock is not None:
+				con.sock.settimeout(timeout)
+		return con
+
+	def release(self, con):
+		"""
+		Returns a connection to the pool.
+
+		Connections that the server has closed (or that were closed because a
+		response was not completely read) are simply dropped.
+
+		:param con: A connection previously returned by `acquire()`.
+
+		"""
+
+		if con.sock is None:
+			return
+
+		with self._lock:
+			idle = self._idle.setdefault(con.server, [])
+			if len(idle) < self.max_idle:
+				idle.append((con, time.time()))
+				return
+		con.close()
+
+	def clear(self):
+		"Closes every idle connection in the pool."
+
+		with self._lock:
+			idle, self._idle = self._idle, {}
+		for connections in idle.values():
+			for con, _ in connections:
+				con.close()
+
+def send_request(con, method, path, headers = None):
+	"""
+	Sends a request and waits for the response's headers.
+
+	If `con` has already been used for a previous request and the server has
+	since dropped it, the request is retried exactly once on a fresh socket.
+	Only requests that are safe to repeat (such as `GET` and `HEAD`) should be
+	sent with this function.
+
+	:param con: An HTTP connection that is not awaiting a response.
+	:param method: The HTTP method (ex: `GET`).
+	:param path: The path to request. Should begin with a slash.
+	:param headers: A dictionary of extra headers to send.
+
+	:returns: An `httplib.HTTPResponse`.
+
+	"""
+
+	if headers is None:
+		headers = {}
+
+	pool = getattr(con, "pool", None)
+	reused = con.sock is not None
+	if reused and pool is not None:
+		pool.record("reused")
+	try:
+		con.request(method, path, headers = headers)
+		response = con.getresponse()
+	except socket.timeout:
+		con.close()
+		raise
+	except (httplib.BadStatusLine, httplib.ImproperConnectionState,
+			socket.error):
+		con.close()
+		if not reused:
+			raise
+
+		log.debug("Kept-alive connection to %s dropped, reconnecting.",
+			getattr(con, "server", con.host))
+		if pool is not None:
+			pool.record("reconnects")
+		con.request(method, path, headers = headers)
+		response = con.getresponse()
+
+	return response
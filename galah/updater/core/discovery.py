@@ -0,0 +1,191 @@
+"""
+Discovery of the packages and versions available on the update server.
+
+The version listing (see *Requirements* for its format) is checked far more
+often than it changes, so once it has been downloaded and verified it is kept
+on disk along with its signature and the HTTP headers it came with. Later
+checks only ask the server whether it has changed, either with a `HEAD`
+request whose `Last-Modified` and `Content-Length` headers are compared
+against the cached ones, or with a conditional `GET` that the server answers
+with `304 Not Modified`. The listing is only downloaded (and verified) again
+when it actually changed.
+
+"""
+
+import logging
+log = logging.getLogger("gi.discovery")
+
+# gicore
+import atomicfile
+import connectionpool
+import filetransfer
+import util
+
+# stdlib
+import base64
+import errno
+import hashlib
+import httplib
+import json
+import os
+import socket
+
+# The ways a cached listing can be revalidated with the server.
+REVALIDATE_HEAD = "head"
+REVALIDATE_CONDITIONAL = "conditional"
+
+# The headers worth remembering about a listing.
+_KEPT_HEADERS = ("etag", "last-modified", "content-length",
+	"content-encoding")
+
+class ListingCache(object):
+	"""
+	Retrieves signed documents (such as `version-listing.json`), keeping a
+	verified copy of each on disk and only downloading it again once it has
+	changed on the server.
+
+	:ivar directory: The directory cached documents are kept in. It is
+			created if it does not exist and must only be accessible by the
+			current user.
+	:ivar revalidate: How to ask the server whether a document has changed,
+			either `REVALIDATE_HEAD` (as described in *Requirements*) or
+			`REVALIDATE_CONDITIONAL`.
+	:ivar stats: A dictionary of counters: `fresh` counts documents that were
+			revalidated and served from disk, `downloaded` counts documents
+			that had to be downloaded and verified.
+
+	"""
+
+	def __init__(self, directory, revalidate = REVALIDATE_HEAD):
+		if revalidate not in (REVALIDATE_HEAD, REVALIDATE_CONDITIONAL):
+			raise ValueError("Unknown revalidation method %r." % (revalidate, ))
+
+		self.directory = directory
+		self.revalidate = revalidate
+		self.stats = {"fresh": 0, "downloaded": 0}
+		util.private_dir(directory)
+
+	def _entry_path(self, server, path):
+		key = hashlib.sha1("%s%s" % (server, path)).hexdigest()
+		return os.path.join(self.directory, key + ".json")
+
+	def _load(self, server, path):
+		"""
+		:returns: The cached entry for a document as a dictionary with the
+				keys `headers`, `document` and `signature`, or `None`.
+
+		"""
+
+		try:
+			with open(self._entry_path(server, path), "rb") as f:
+				entry = json.load(f)
+			return {
+				"headers": entry["headers"],
+				"document": base64.b64decode(entry["document"]),
+				"signature": base64.b64decode(entry["signature"])
+			}
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		except (ValueError, KeyError, TypeError):
+			log.warning("Cached copy of '%s' is corrupt, ignoring it.", path)
+		return None
+
+	def _save(self, server, path, headers, document, signature):
+		"""
+		Caches a document in a single atomic write. It isn't synced to disk,
+		as losing it in a crash only costs a download.
+
+		"""
+
+		kept = dict((k, v) for k, v in headers.items() if k in _KEPT_HEADERS)
+		with atomicfile.AtomicFile(self._entry_path(server, path),
+				durability = atomicfile.DURABILITY_NONE) as f:
+			json.dump({
+				"headers": kept,
+				"document": base64.b64encode(document),
+				"signature": base64.b64encode(signature)
+			}, f)
+
+	def _head_matches(self, con, path, cached_headers):
+		"""
+		Sends a `HEAD` request and compares the response's headers with the
+		cached ones.
+
+		:returns: `True` if `Last-Modified`, `Content-Length` and
+				`Content-Encoding` (and `ETag`, if both have one) all match
+				exactly.
+
+		"""
+
+		# The cached Content-Length is that of the (possibly compressed)
+		# response to the GET, so ask for the same encoding.
+		response = connectionpool.send_request(con, "HEAD", path,
+			{"Accept-Encoding": filetransfer.ACCEPT_ENCODING})
+		response.read()
+		if response.status != httplib.OK:
+			return False
+
+		headers = dict(response.getheaders())
+		for i in ("last-modified", "content-length"):
+			if i not in cached_headers or headers.get(i) != cached_headers[i]:
+				return False
+		if headers.get("content-encoding") != \
+				cached_headers.get("content-encoding"):
+			return False
+		if "etag" in headers and "etag" in cached_headers:
+			return headers["etag"] == cached_headers["etag"]
+		return True
+
+	def get(self, server, path, pub_key, timeout, max_size, pool = None):
+		"""
+		Retrieves a signed document, from the cache if it has not changed.
+
+		The arguments have the same meaning as for `filetransfer.get_file()`.
+
+		:raises errors.VerificationError: When a new version of the document
+				could not be verified.
+
+		:returns: The verified contents of the document as a string.
+
+		"""
+
+		if pool is None:
+			pool = filetransfer.default_pool
+
+		cached = self._load(server, path)
+		request_headers = None
+		if cached is not None:
+			cached_headers = cached["headers"]
+			if self.revalidate == REVALIDATE_HEAD:
+				con = pool.acquire(server, timeout)
+				try:
+					fresh = self._head_matches(con, path, cached_headers)
+				except (socket.error, httplib.HTTPException):
+					con.close()
+					raise
+				finally:
+					pool.release(con)
+				if fresh:
+					self.stats["fresh"] += 1
+					return cached["document"]
+			else:
+				request_headers = {}
+				if "etag" in cached_headers:
+					request_headers["If-None-Match"] = cached_headers["etag"]
+				if "last-modified" in cached_headers:
+					request_headers["If-Modified-Since"] = \
+						cached_headers["last-modified"]
+
+		headers = {}
+		result = filetransfer.get_signed_document(server, path, pub_key,
+			timeout, max_size, pool = pool,
+			request_headers = request_headers, response_headers = headers)
+		if result is None:
+			self.stats["fresh"] += 1
+			return cached["document"]
+
+		document, signature = result
+		self.stats["downloaded"] += 1
+		self._save(server, path, headers, document, signature)
+		return document
@@ -33,8 +33,8 @@ class CriticalError(Exception):
 		Exception.__init__(self, *args, **kwargs)
 
 	def __repr__(self):
-		return "CriticalError(%s)" % (message, )
+		return "CriticalError(%s)" % (self.message, )
 
 	def __str__(self):
-		msg = "A critical error has occurred: %s" % (message, )
+		msg = "A critical error has occurred: %s" % (self.message, )
 		return msg
@@ -2,8 +2,14 @@ import logging
 log = logging.getLogger("gi.discovery")
 
 # gicore
+import atomicfile
+import connectionpool
 import errors
+import manifests
+import merkle
+import metrics
 import signatures
+import util
 
 # stdlib
 import urlparse
@@ -12,8 +18,357 @@ import tempfile
 import os
 import pkg_resources
 import stat
+import Queue
+import multiprocessing.pool
+import socket
+import errno
+import hashlib
+import json
+import threading
+import time
+import zlib
+import io
+import posixpath
+import shutil
 
-def _get_file_simple(con, path, max_size):
+class TransferControl(object):
+	"""
+	Lets another thread watch over, and cancel, a transfer made by
+	`get_file()`.
+
+	:ivar first_byte: A `threading.Event` that is set once the server has
+			started responding with the file.
+	:ivar first_byte_at: The time (as returned by `time.time()`) at which
+			`first_byte` was set, or `None`.
+	:ivar cancelled: A `threading.Event` that is set by `cancel()`.
+	:ivar verified_size: When the file is being verified against a Merkle
+			tree (see `get_file()`'s `use_merkle` parameter), how many bytes
+			from the start of it have been verified so far. Those bytes can
+			be trusted before the transfer is complete.
+
+	"""
+
+	def __init__(self):
+		self.first_byte = threading.Event()
+		self.first_byte_at = None
+		self.cancelled = threading.Event()
+		self.verified_size = 0
+		self._con = None
+		self._lock = threading.Lock()
+
+	def _attach(self, con):
+		"""
+		Called by `get_file()` with the connection the transfer is using, and
+		with `None` before the connection goes back to its pool (after which
+		another transfer may be using it).
+
+		"""
+
+		with self._lock:
+			self._con = con
+
+	def _responded(self):
+		self.first_byte_at = time.time()
+		self.first_byte.set()
+
+	def _verified(self, verified_size):
+		self.verified_size = verified_size
+
+	def check(self):
+		"""
+		:raises IOError: If the transfer has been cancelled.
+
+		"""
+
+		if self.cancelled.is_set():
+			raise IOError("Transfer cancelled.")
+
+	def cancel(self):
+		"""
+		Cancels the transfer. Any blocking read it is in the middle of is
+		interrupted by shutting down its socket, and `get_file()` will raise
+		an `IOError` shortly after.
+
+		"""
+
+		self.cancelled.set()
+		with self._lock:
+			sock = self._con.sock if self._con is not None else None
+		if sock is not None:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+# The number of bytes requested by the first read of a response body. Each
+# read that is completely filled doubles this, up to MAX_CHUNK_SIZE.
+DEFAULT_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# The value of the Accept-Encoding header sent when compression is allowed.
+ACCEPT_ENCODING = "gzip, deflate"
+
+def _max_encoded_size(max_size):
+	"""
+	:returns: How large an encoded body may be when the decoded body may be
+			up to `max_size` bytes. Compressing data that doesn't compress
+			well makes it slightly larger, so a little slack is allowed.
+
+	"""
+
+	return max_size + max_size // 100 + 1024
+
+def _decoder(content_encoding):
+	"""
+	Creates an object to decode a response body with.
+
+	:param content_encoding: The response's `Content-Encoding` header, or
+			`None` if it did not have one.
+
+	:raises IOError: If the encoding is not one we asked for.
+
+	:returns: A `zlib` decompression object, or `None` if the body is not
+			encoded.
+
+	"""
+
+	encoding = (content_encoding or "identity").strip().lower()
+	if encoding == "identity":
+		return None
+	if encoding in ("gzip", "x-gzip"):
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+	if encoding == "deflate":
+		# Should be zlib wrapped, but some servers send a raw deflate stream.
+		return _DeflateDecoder()
+	raise IOError("Unsupported Content-Encoding %r." % (content_encoding, ))
+
+class _DeflateDecoder(object):
+	"""
+	Decodes `deflate` content, which is meant to have a zlib header but is
+	sometimes sent without one. Which it is is decided by the first bytes.
+
+	"""
+
+	def __init__(self):
+		self._decoder = None
+		self._buffer = ""
+		self.unconsumed_tail = ""
+
+	def decompress(self, data, max_length):
+		if self._decoder is None:
+			self._buffer += data
+			if len(self._buffer) < 2:
+				return ""
+			data, self._buffer = self._buffer, ""
+			try:
+				zlib.decompressobj().decompress(data[:2])
+				self._decoder = zlib.decompressobj()
+			except zlib.error:
+				self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+		result = self._decoder.decompress(data, max_length)
+		self.unconsumed_tail = self._decoder.unconsumed_tail
+		return result
+
+	def flush(self):
+		if self._decoder is None:
+			if self._buffer:
+				raise zlib.error("Truncated deflate stream.")
+			return ""
+		return self._decoder.flush()
+
+def _decode(decoder, data):
+	"""
+	Decompresses a chunk of a response body a piece at a time, so that a
+	small chunk that expands to something huge (a zip bomb) never needs more
+	than `MAX_CHUNK_SIZE` bytes of memory.
+
+	"""
+
+	while data:
+		piece = decoder.decompress(data, MAX_CHUNK_SIZE)
+		data = decoder.unconsumed_tail
+		yield piece
+
+def _receive(response, f, max_size, file_hash = None,
+		chunk_size = DEFAULT_CHUNK_SIZE, expected_size = None,
+		control = None, decoder = None):
+	"""
+	Reads the body of a response into a file.
+
+	If the response supports `readinto()`, data is received into a single
+	preallocated buffer that is reused for every chunk, otherwise `read()` is
+	used. Either way the chunk size adapts to how quickly data is arriving:
+	it grows while reads come back full and is never larger than is needed to
+	detect the body exceeding `max_size`, so no more than `max_size + 1`
+	bytes are ever received.
+
+	:param response: The `httplib.HTTPResponse` to read from.
+	:param f: A file object to write the body to.
+	:param max_size: The maximum size of the body in bytes.
+	:param file_hash: A hash object to feed every chunk to, or `None`.
+	:param chunk_size: The size of the first read.
+	:param expected_size: The number of bytes the server said it would send
+			(its `Content-Length`), or `None` if it did not say.
+	:param control: A `TransferControl` that is checked for cancellation
+			after every read, or `None`.
+	:param decoder: If the body has a `Content-Encoding`, the object
+			returned by `_decoder()` for it. The decoded body is what is
+			written to `f` and fed to `file_hash`, and it is the decoded
+			size that `max_size` limits (the encoded size is limited to
+			`_max_encoded_size(max_size)`).
+
+	:raises IOError: If the body exceeds `max_size`, it could not be
+			decoded, or the transfer is cancelled.
+	:raises httplib.IncompleteRead: If the connection ended before
+			`expected_size` bytes were received.
+
+	:returns: The number of bytes written to `f`.
+
+	"""
+
+	readinto = getattr(response, "readinto", None)
+	if readinto is not None:
+		buf = memoryview(bytearray(max(chunk_size, MAX_CHUNK_SIZE)))
+
+	read_limit = max_size if decoder is None else _max_encoded_size(max_size)
+	bytes_read = 0 # as received, before decoding
+	bytes_written = 0 # after decoding
+	while True:
+		# Asking for one byte more than is allowed is enough to notice the
+		# limit has been exceeded.
+		wanted = min(chunk_size, read_limit - bytes_read + 1)
+		if readinto is not None:
+			nbytes = readinto(buf[:wanted])
+			chunk = buf[:nbytes]
+		else:
+			chunk = response.read(wanted)
+			nbytes = len(chunk)
+		if control is not None:
+			control.check()
+		if nbytes == 0:
+			break
+
+		bytes_read += nbytes
+		if bytes_read > read_limit:
+			raise IOError("File exceeds max download size.")
+		if decoder is None:
+			f.write(chunk)
+			if file_hash is not None:
+				file_hash.update(chunk)
+		else:
+			try:
+				if isinstance(chunk, memoryview):
+					chunk = chunk.tobytes()
+				for piece in _decode(decoder, chunk):
+					bytes_written += len(piece)
+					if bytes_written > max_size:
+						raise IOError("File exceeds max download size.")
+					f.write(piece)
+					if file_hash is not None:
+						file_hash.update(piece)
+			except zlib.error as e:
+				raise IOError("Could not decode response: %s" % (e, ))
+
+		if nbytes == wanted and chunk_size < MAX_CHUNK_SIZE:
+			chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+	# httplib on Python 2 treats a connection that closes early as the end of
+	# the body rather than an error.
+	if expected_size is not None and bytes_read != expected_size:
+		raise httplib.IncompleteRead("", expected_size - bytes_read)
+
+	if decoder is None:
+		return bytes_read
+	try:
+		piece = decoder.flush()
+	except zlib.error as e:
+		raise IOError("Could not decode response: %s" % (e, ))
+	bytes_written += len(piece)
+	if bytes_written > max_size:
+		raise IOError("File exceeds max download size.")
+	f.write(piece)
+	if file_hash is not None:
+		file_hash.update(piece)
+	return bytes_written
+
+def _content_length(response):
+	"""
+	Returns the `Content-Length` of a response as an int, or `None` if it
+	has none.
+
+	:raises httplib.HTTPException: If the header isn't a non-negative
+			integer.
+
+	"""
+
+	content_length = response.getheader("content-length")
+	if content_length is None:
+		return None
+	try:
+		length = int(content_length)
+	except ValueError:
+		length = -1
+	if length < 0:
+		raise httplib.HTTPException(
+			"Invalid Content-Length %r." % (content_length, ))
+	return length
+
+def _start_get(con, path, max_size, response_headers = None,
+		request_headers = None, control = None, compressed = False):
+	"""
+	Sends a GET request for a file and checks that the response is one we
+	want to read the body of. The parameters are the same as
+	`_get_file_simple()`'s.
+
+	:returns: A tuple `(response, decoder, content_length)` with the last
+			two ready to pass on to `_receive()`, or `None` if the request
+			was conditional and the server responded with
+			`304 Not Modified`.
+
+	"""
+
+	# Only a conditional request can be answered with 304 Not Modified, any
+	# other is treated like an error response.
+	conditional = any(i.lower().startswith("if-")
+		for i in request_headers or {})
+	if compressed:
+		request_headers = dict(request_headers or {})
+		request_headers["Accept-Encoding"] = ACCEPT_ENCODING
+	response = connectionpool.send_request(con, "GET", path, request_headers)
+	if control is not None:
+		control._responded()
+	if response_headers is not None:
+		response_headers.update(response.getheaders())
+	if response.status == httplib.NOT_MODIFIED and conditional:
+		response.read()
+		return None
+	if response.status != httplib.OK:
+		con.close()
+		raise IOError("Server returned %d error code." % (response.status, ))
+
+	try:
+		decoder = _decoder(response.getheader("content-encoding"))
+	except IOError:
+		con.close()
+		raise
+
+	# Don't even start on a body we know is going to be too big.
+	try:
+		content_length = _content_length(response)
+	except httplib.HTTPException:
+		con.close()
+		raise
+	limit = max_size if decoder is None else _max_encoded_size(max_size)
+	if content_length is not None and content_length > limit:
+		con.close()
+		raise IOError("File exceeds max download size.")
+
+	return response, decoder, content_length
+
+def _get_file_simple(con, path, max_size, file_hash = None,
+		chunk_size = DEFAULT_CHUNK_SIZE, response_headers = None,
+		request_headers = None, control = None, compressed = False,
+		staged = None):
 	"""
 	Performs a simple HTTP GET request to retrieve a particular file and stores
 	it in a secure (inaccessible by other users), temporary file.
@@ -21,30 +376,72 @@ def _get_file_simple(con, path, max_size):
 	:param con: An HTTP connection that is not awaiting a response (so it is
 			safe to make a request on it).
 	:param path: A path to the file on the server. Should begin with a slash.
+	:param max_size: The maximum size of the file in bytes.
+	:param file_hash: A hash object (see `signatures.new_hash()`) that will be
+			fed every chunk of the file as it is received, so the file never
+			needs to be read back in order to verify it.
+	:param chunk_size: The size of the first read from the response. See
+			`_receive()`.
+	:param response_headers: A dictionary that, if given, is updated with the
+			response's headers (with lower-case names).
+	:param request_headers: A dictionary of extra headers to send, such as
+			`If-None-Match` or `If-Modified-Since` to make the request
+			conditional.
+	:param control: A `TransferControl` to notify when the server responds
+			and to check for cancellation, or `None`.
+	:param compressed: If `True`, the server is told it may compress the
+			response (with `gzip` or `deflate`). It is decompressed as it
+			arrives, so the file stored (and hashed) is always the original,
+			and `max_size` is the largest that file may be.
+	:param staged: An `atomicfile.AtomicFile` to receive the file into
+			instead of a new temporary file. It is left open for the caller
+			to commit or discard (its temporary path is returned), but is
+			discarded if anything goes wrong. If the response has a
+			`Content-Length`, that much space is preallocated for it first.
+
+	:returns: The path to the downloaded file, or `None` if the request was
+			conditional and the server responded with `304 Not Modified`.
+
+	If anything goes wrong the connection is closed, as the response may not
+	have been completely read. It can still be used for further requests
+	(it will simply reconnect).
 
 	"""
 
-	con.request("GET", path)
-	response = con.getresponse()
-	if response.status != httplib.OK:
-		raise IOError("Server returned %d error code." % (response.status, ))
+	try:
+		started = _start_get(con, path, max_size, response_headers,
+			request_headers, control, compressed)
+	except:
+		if staged is not None:
+			staged.discard()
+		raise
+	if started is None:
+		return None
+	response, decoder, content_length = started
+
+	if staged is not None:
+		try:
+			if content_length is not None and decoder is None:
+				# Fails now, rather than part way through, if the disk is
+				# too full for the file.
+				staged.preallocate(content_length)
+			_receive(response, staged, max_size, file_hash, chunk_size,
+				content_length, control, decoder)
+			staged.flush()
+		except:
+			con.close()
+			staged.discard()
+			raise
+		return staged.temp_path
 
 	os_handle, path = tempfile.mkstemp()
 	f = None
 	try:
 		f = os.fdopen(os_handle, "wb")
-		max_file_size = max_size
-		bytes_read = 0
-		CHUNK_SIZE = 1024
-		while True:
-			chunk = response.read(CHUNK_SIZE)
-			if len(chunk) == 0:
-				break
-			f.write(chunk)
-			bytes_read += len(chunk)
-			if bytes_read > max_file_size:
-				raise IOError("File exceeds max download size.")
+		_receive(response, f, max_size, file_hash, chunk_size, content_length,
+			control, decoder)
 	except:
+		con.close()
 		# f could be none if the call to fdopen raises an exception.
 		if f is None:
 			os.close(os_handle)
@@ -56,7 +453,312 @@ def _get_file_simple(con, path, max_size):
 	os.chmod(path, stat.S_IRUSR)
 	return path
 
-def get_file(server, path, pub_key, timeout, max_size):
+def default_staging_dir():
+	"""
+	:returns: The default directory for `_get_file_resumable()` to keep
+			partial downloads in. It is specific to the current user.
+
+	"""
+
+	return os.path.join(tempfile.gettempdir(),
+		"galah-updater-%d" % (os.geteuid(), ))
+
+def _get_validator(headers):
+	"""
+	Determines the value to send in an `If-Range` header when resuming a
+	response's body.
+
+	:param headers: A dictionary of the response's headers, with lower-case
+			names.
+
+	:returns: The response's `ETag` if it is a strong one, otherwise its
+			`Last-Modified` date, otherwise `None` (in which case the
+			response cannot safely be resumed).
+
+	"""
+
+	etag = headers.get("etag")
+	if etag is not None and not etag.startswith("W/"):
+		return etag
+	return headers.get("last-modified")
+
+def _range_start(response):
+	"""
+	:returns: The first byte offset given in a response's `Content-Range`
+			header, or `None` if it is missing or malformed.
+
+	"""
+
+	content_range = response.getheader("content-range", "")
+	try:
+		unit, spec = content_range.split(" ", 1)
+		if unit.strip() != "bytes":
+			return None
+		return int(spec.split("-", 1)[0])
+	except ValueError:
+		return None
+
+def _hash_prefix(path, nbytes, file_hash):
+	"Feeds the first `nbytes` of a file into a hash object."
+
+	with open(path, "rb") as f:
+		while nbytes > 0:
+			chunk = f.read(min(nbytes, MAX_CHUNK_SIZE))
+			if not chunk:
+				raise IOError("Partial download %s shrank." % (path, ))
+			file_hash.update(chunk)
+			nbytes -= len(chunk)
+
+def _remove_quietly(*paths):
+	for i in paths:
+		try:
+			os.remove(i)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				log.exception("Could not delete file %s.", i)
+
+def _copy_into_place(path, destination):
+	"""
+	Copies a file to `destination` atomically, through an
+	`atomicfile.AtomicFile`. Used rather than renaming files that may be
+	hard links to something else, such as a copy checked out of the cache.
+
+	"""
+
+	with open(path, "rb") as source:
+		with atomicfile.AtomicFile(destination,
+				expected_size = os.fstat(source.fileno()).st_size) as f:
+			shutil.copyfileobj(source, f, MAX_CHUNK_SIZE)
+
+def _get_file_resumable(con, path, max_size, file_hash = None,
+		staging_dir = None, chunk_size = DEFAULT_CHUNK_SIZE,
+		response_headers = None, control = None):
+	"""
+	Like `_get_file_simple()`, but if the transfer is interrupted the data
+	received so far is kept so that the next call for the same file can pick
+	up where this one left off.
+
+	Partial downloads live in a private per-user staging directory alongside
+	the validator (`ETag` or `Last-Modified`) the server gave for them. When
+	resuming, only the missing bytes are requested with a `Range` header and
+	`If-Range` makes sure they come from the same version of the file; if
+	the file has changed the server sends all of it and we start over.
+
+	`file_hash` is always fed the entire file, including any part of it that
+	was received by an earlier call.
+
+	:param staging_dir: The directory to keep partial downloads in. If `None`
+			`default_staging_dir()` is used. It is created if necessary.
+
+	:raises socket.error, httplib.HTTPException: If the transfer was
+			interrupted. The partial download is kept if it can be resumed.
+
+	:returns: The path to the downloaded file. It is in the staging
+			directory.
+
+	"""
+
+	if staging_dir is None:
+		staging_dir = default_staging_dir()
+	util.private_dir(staging_dir)
+
+	key = hashlib.sha1("%s:%s%s" % (con.host, con.port, path)).hexdigest()
+	part_path = os.path.join(staging_dir, key + ".part")
+	meta_path = os.path.join(staging_dir, key + ".json")
+
+	offset = 0
+	headers = {}
+	try:
+		with open(meta_path, "rb") as f:
+			validator = json.load(f)["validator"]
+		offset = os.path.getsize(part_path)
+	except (IOError, OSError, ValueError, KeyError):
+		_remove_quietly(part_path, meta_path)
+	else:
+		if 0 < offset <= max_size:
+			headers["Range"] = "bytes=%d-" % (offset, )
+			headers["If-Range"] = validator
+		else:
+			offset = 0
+
+	response = connectionpool.send_request(con, "GET", path, headers)
+	if control is not None:
+		control._responded()
+	if (response.status == httplib.PARTIAL_CONTENT and offset and
+			_range_start(response) == offset):
+		log.info("Resuming '%s' from byte %d.", path, offset)
+	elif response.status == httplib.OK:
+		offset = 0
+	else:
+		con.close()
+		_remove_quietly(part_path, meta_path)
+		raise IOError("Server returned %d error code." % (response.status, ))
+
+	encoding = response.getheader("content-encoding", "identity")
+	if encoding.strip().lower() != "identity":
+		# We never ask for an encoding here, as byte ranges of an encoded
+		# response can't be resumed reliably.
+		con.close()
+		_remove_quietly(part_path, meta_path)
+		raise IOError("Server sent an encoded response to a resumable "
+			"request.")
+
+	try:
+		content_length = _content_length(response)
+	except httplib.HTTPException:
+		con.close()
+		raise
+	if content_length is not None and offset + content_length > max_size:
+		con.close()
+		_remove_quietly(part_path, meta_path)
+		raise IOError("File exceeds max download size.")
+
+	if response_headers is not None:
+		response_headers.update(response.getheaders())
+
+	validator = _get_validator(dict(response.getheaders()))
+	f = None
+	try:
+		# Record how to resume before any data arrives.
+		if validator is None:
+			_remove_quietly(meta_path)
+		else:
+			with open(meta_path, "wb") as meta_file:
+				json.dump({"path": path, "validator": validator}, meta_file)
+
+		flags = os.O_WRONLY | os.O_CREAT
+		flags |= os.O_APPEND if offset else os.O_TRUNC
+		f = os.fdopen(os.open(part_path, flags, 0600), "ab" if offset else "wb")
+		if offset and file_hash is not None:
+			_hash_prefix(part_path, offset, file_hash)
+		_receive(response, f, max_size - offset, file_hash, chunk_size,
+			content_length, control)
+		f.close()
+	except (socket.error, httplib.HTTPException):
+		con.close()
+		if f is not None:
+			f.close()
+		if validator is None:
+			_remove_quietly(part_path, meta_path)
+		raise
+	except:
+		con.close()
+		if f is not None:
+			f.close()
+		_remove_quietly(part_path, meta_path)
+		raise
+
+	# Move the finished file out of the way so the next download of the same
+	# path doesn't try to resume it.
+	os_handle, final_path = tempfile.mkstemp(dir = staging_dir)
+	os.close(os_handle)
+	os.rename(part_path, final_path)
+	_remove_quietly(meta_path)
+	os.chmod(final_path, stat.S_IRUSR)
+	return final_path
+
+def _get_signature(con, server, path, pub_key):
+	"""
+	Retrieves the signature for a file and checks that it is sane.
+
+	:param con: An HTTP connection that is not awaiting a response.
+	:param server: The server `con` is connected to (used in errors).
+	:param path: The path of the file (not of the signature) on the server.
+	:param pub_key: The public key the signature will be checked against.
+
+	:raises errors.VerificationError: If the signature could not be
+			retrieved or is not the right size to have been made by the key
+			that signed the file.
+
+	:returns: The path to the downloaded signature.
+
+	"""
+
+	log.info("Getting signature for file '%s'", path)
+	expected_size = signatures.signature_size(pub_key)
+	try:
+		sig_path = _get_file_simple(con, path + ".sig", expected_size)
+	except IOError:
+		# If server returns bad response (ex: 404) we want to consider it
+		# a verification error.
+		raise errors.VerificationError("%s/%s" % (server, path))
+
+	if os.path.getsize(sig_path) != expected_size:
+		os.remove(sig_path)
+		raise errors.VerificationError("%s/%s" % (server, path))
+	return sig_path
+
+def _get_signature_data(con, server, path, pub_key):
+	"""
+	Like `_get_signature()` but the signature is kept in memory.
+
+	:returns: The signature as a string.
+
+	"""
+
+	log.info("Getting signature for document '%s'", path)
+	expected_size = signatures.signature_size(pub_key)
+	sig_file = io.BytesIO()
+	try:
+		response, decoder, content_length = _start_get(con, path + ".sig",
+			expected_size)
+		_receive(response, sig_file, expected_size, None,
+			expected_size = content_length, decoder = decoder)
+	except (IOError, httplib.HTTPException):
+		con.close()
+		raise errors.VerificationError("%s/%s" % (server, path))
+
+	if sig_file.tell() != expected_size:
+		raise errors.VerificationError("%s/%s" % (server, path))
+	return sig_file.getvalue()
+
+def _get_merkle_tree(con, server, path, pub_key, max_size):
+	"""
+	Retrieves a file's Merkle sidecar and checks it against the signature of
+	its head (see `merkle`).
+
+	:param max_size: The maximum size of the file (not of the sidecar).
+
+	:raises errors.VerificationError: If the sidecar or its signature could
+			not be retrieved, or the sidecar could not be verified.
+
+	:returns: The verified `merkle.MerkleTree`.
+
+	"""
+
+	log.info("Getting Merkle tree for file '%s'", path)
+	sidecar_size = merkle.max_sidecar_size(max_size)
+	sidecar = io.BytesIO()
+	try:
+		response, decoder, content_length = _start_get(con,
+			path + ".merkle", sidecar_size, compressed = True)
+		_receive(response, sidecar, sidecar_size,
+			expected_size = content_length, decoder = decoder)
+	except (IOError, httplib.HTTPException):
+		con.close()
+		raise errors.VerificationError("%s/%s" % (server, path))
+
+	signature = _get_signature_data(con, server, path + ".merkle", pub_key)
+	try:
+		tree = merkle.MerkleTree.parse(sidecar.getvalue())
+	except merkle.MerkleError:
+		log.warning("Merkle tree for '%s' is not valid.", path,
+			exc_info = True)
+		raise errors.VerificationError("%s/%s" % (server, path))
+	if not signatures.verify_file(None, io.BytesIO(signature), pub_key,
+			file_hash = signatures.new_hash().new(tree.head())):
+		raise errors.VerificationError("%s/%s" % (server, path))
+	return tree
+
+# The pool used by get_file() when one is not explicitly provided.
+default_pool = connectionpool.ConnectionPool()
+
+def get_file(server, path, pub_key, timeout, max_size, pool = None,
+		signature_first = False, resume = False, retries = 0,
+		staging_dir = None, cache = None, request_headers = None,
+		response_headers = None, control = None, compressed = False,
+		metrics_sink = None, cache_url = None, manifest = None,
+		use_merkle = False, destination = None):
 	"""
 	Securely retrieves a file from the given server.
 
@@ -74,37 +776,272 @@ def get_file(server, path, pub_key, timeout, max_size):
 			operation (such as connection or waiting for the next chunk of
 			data).
 	:param max_size: The maximum size of the file in bytes.
+	:param pool: The `connectionpool.ConnectionPool` to take a connection to
+			`server` from. If `None`, `default_pool` is used.
+	:param signature_first: If `True`, the (small) signature is retrieved and
+			sanity checked before the file itself, so a missing or malformed
+			signature is caught before any of the file is transferred.
+	:param resume: If `True`, an interrupted transfer is kept in
+			`staging_dir` and resumed by the next attempt (see
+			`_get_file_resumable()`) rather than started again from scratch.
+	:param retries: The number of times to retry the file's transfer if the
+			connection fails part way through.
+	:param staging_dir: Where to keep partial downloads when `resume` is
+			`True`. Defaults to `default_staging_dir()`.
+	:param cache: An `artifactcache.ArtifactCache`. If the file is in it, it
+			is returned without touching the network (or verifying it again)
+			and otherwise it is added once it has been verified.
+	:param request_headers: Extra headers to send when requesting the file
+			(but not its signature). Typically used to make a conditional
+			request. Cannot be combined with `resume`.
+	:param response_headers: A dictionary that, if given, is updated with the
+			headers of the file's response (with lower-case names).
+	:param control: A `TransferControl` through which another thread can
+			watch and cancel this transfer.
+	:param compressed: Whether the server may compress the file in transit
+			(ex: `Content-Encoding: gzip`). The signature always covers the
+			file's original bytes, which is what is stored and verified no
+			matter how it was transferred. Ignored when resuming, and the
+			signature itself is never compressed. Off by default, as it is
+			only worthwhile for text such as listings (which
+			`get_document()` compresses by default) and servers often label
+			archives that are already compressed (ex: `.tar.gz`) with a
+			`Content-Encoding` they don't actually have.
+	:param metrics_sink: A `metrics.Metrics` object to report how long each
+			stage of the transfer took to (see `metrics.TransferRecord`).
+	:param cache_url: The URL to look the file up in `cache` by, and to store
+			it under. Defaults to the URL it is retrieved from, but can be
+			set to another URL the same file is known by (ex: when getting a
+			copy of it from somewhere other than its origin).
+	:param manifest: A verified `manifests.Manifest` (see `get_manifest()`).
+			If it lists the file, the file is checked against its entry and
+			no signature is retrieved for it. Files it does not list are
+			verified against their own signature as usual.
+	:param use_merkle: If `True`, the file's Merkle sidecar (see the `merkle`
+			module) is retrieved and verified first, and then each chunk of
+			the file is verified as it arrives. A bad chunk aborts the
+			transfer straight away, and `control.verified_size` says how
+			much of the file can already be trusted. No signature is
+			retrieved for the file itself. Ignored for files verified
+			against `manifest`, and cannot be combined with `resume`.
+	:param destination: Where to put the file. If given, the file is
+			received straight into a temporary file next to `destination`
+			(so on the same filesystem) and, once verified, renamed over it
+			(see `atomicfile.AtomicFile`), so nothing is copied and nothing
+			appears at `destination` unless it verified. Space for the file
+			is preallocated once its size is known (from the manifest, the
+			Merkle tree or the `Content-Length`), so a full disk fails the
+			transfer before it starts. The file keeps the permissions of a
+			new `AtomicFile` (readable and writable by the current user
+			only). The file never shares its data with `cache`: a copy is
+			stored before it is renamed into place, and a cached copy is
+			copied to `destination`. Cannot be combined with `resume`.
 
 	:raises errors.VerificationError: When the file could not be verified as
 			authentic for whatever reason.
 
 	:returns: A path to the downloaded files as a tuple (file, signature).
 			Both file's permissions are set to 600 and owned by the current
-			user.
+			user. The file is `destination` if it was given. The signature is
+			`None` if the file was verified against `manifest` or a Merkle
+			tree instead. If the request was made conditional with
+			`request_headers` and the server responded `304 Not Modified`,
+			`None` is returned instead.
+
+	"""
+
+	if resume and request_headers:
+		raise ValueError("resume cannot be combined with request_headers.")
+	if resume and use_merkle:
+		raise ValueError("resume cannot be combined with use_merkle.")
+	if resume and destination is not None:
+		raise ValueError("resume cannot be combined with destination.")
+
+	args = (server, path, pub_key, timeout, max_size, pool, signature_first,
+		resume, retries, staging_dir, cache, request_headers,
+		response_headers, control, compressed, cache_url, manifest,
+		use_merkle, destination)
+	if metrics_sink is None:
+		return _get_file(None, *args)
+
+	record = metrics_sink.start("http://%s%s" % (server, path))
+	try:
+		result = _get_file(record, *args)
+	except Exception as e:
+		record.outcome = "error"
+		record.error = "%s: %s" % (type(e).__name__, e)
+		raise
+	else:
+		if record.outcome is None:
+			record.outcome = "ok" if result is not None else "not-modified"
+		return result
+	finally:
+		record.total = time.time() - record.started
+		metrics_sink.record(record)
+
+def _get_file(record, server, path, pub_key, timeout, max_size, pool,
+		signature_first, resume, retries, staging_dir, cache,
+		request_headers, response_headers, control, compressed, cache_url,
+		manifest, use_merkle, destination):
+	"""
+	Does the work of `get_file()`, filling in `record` (a
+	`metrics.TransferRecord`) as it goes if it is not `None`.
 
 	"""
 
-	con = httplib.HTTPConnection(host = server, timeout = timeout)
+	url = cache_url or "http://%s%s" % (server, path)
+	if cache is not None:
+		cached = cache.checkout(url)
+		if cached is not None:
+			log.info("Using cached copy of '%s'", path)
+			if record is not None:
+				record.outcome = "cached"
+			if destination is not None:
+				try:
+					_copy_into_place(cached[0], destination)
+				except:
+					_remove_quietly(*[i for i in cached if i is not None])
+					raise
+				_remove_quietly(cached[0])
+				return destination, cached[1]
+			return cached
+
+	entry = None
+	if manifest is not None:
+		entry = manifest.lookup(path)
+	if entry is not None:
+		# Anything larger than the manifest says can be rejected straight
+		# away, and there is no signature to get first.
+		max_size = min(max_size, entry["size"])
+		signature_first = False
+
+	if pool is None:
+		pool = default_pool
+
+	con = pool.acquire(server, timeout)
+	if record is not None:
+		# Only connections made during this transfer should be counted.
+		con.dns_time = con.connect_time = None
+		if control is None:
+			control = TransferControl()
+	if control is not None:
+		control._attach(con)
 	file_path = None
 	sig_path = None
+	staged = None
+	tree = None
+	headers = {} if response_headers is None else response_headers
 	try:
+		if use_merkle and entry is None:
+			tree = _get_merkle_tree(con, server, path, pub_key, max_size)
+			if tree.size > max_size:
+				raise IOError("File exceeds max download size.")
+			max_size = tree.size
+		elif signature_first:
+			sig_path = _get_signature(con, server, path, pub_key)
+
 		log.info("Getting file '%s'", path)
-		file_path = _get_file_simple(con, path, max_size)
-		log.info("Getting signature for file '%s'", path)
-		try:
-			sig_path = _get_file_simple(con, path + ".sig", max_size)
-		except IOError:
-			# If server returns bad response (ex: 404) we want to consider it
-			# a verification error.
-			raise errors.VerificationError("%s/%s" % (server, path))
+		for attempt in xrange(retries + 1):
+			file_hash = signatures.new_hash()
+			if record is not None:
+				record.retries = attempt
+				file_hash = metrics.TimedHash(file_hash)
+				attempt_start = time.time()
+			verifier = None
+			if tree is not None:
+				if control is not None:
+					control._verified(0)
+				verifier = merkle.ChunkVerifier(tree, file_hash,
+					None if control is None else control._verified)
+			if destination is not None:
+				expected_size = None
+				if entry is not None:
+					expected_size = entry["size"]
+				elif tree is not None:
+					expected_size = tree.size
+				staged = atomicfile.AtomicFile(destination,
+					expected_size = expected_size)
+			try:
+				if resume:
+					file_path = _get_file_resumable(con, path, max_size,
+						file_hash, staging_dir, response_headers = headers,
+						control = control)
+				else:
+					file_path = _get_file_simple(con, path, max_size,
+						verifier or file_hash, response_headers = headers,
+						request_headers = request_headers, control = control,
+						compressed = compressed, staged = staged)
+				break
+			except merkle.ChunkMismatch:
+				log.warning("Bad chunk in '%s', abandoning transfer.", path,
+					exc_info = True)
+				raise errors.VerificationError("%s/%s" % (server, path))
+			except (socket.error, httplib.HTTPException):
+				if control is not None:
+					control.check()
+				if attempt == retries:
+					raise
+				log.warning("Transfer of '%s' interrupted, retrying.", path,
+					exc_info = True)
+		if file_path is None:
+			log.info("File '%s' not modified.", path)
+			if staged is not None:
+				staged.discard()
+			if sig_path is not None:
+				os.remove(sig_path)
+			return None
+
+		if record is not None:
+			received_at = time.time()
+			record.ttfb = control.first_byte_at - attempt_start
+			record.transfer = received_at - control.first_byte_at
+			record.bytes = os.path.getsize(file_path)
+			if record.transfer > 0:
+				record.throughput = record.bytes / record.transfer
+			record.hash = file_hash.elapsed
+
+		if entry is None and tree is None and not signature_first:
+			sig_path = _get_signature(con, server, path, pub_key)
 
-		log.info("Verifying file+signature.")
-		verified = signatures.verify_file(
-				open(file_path, "rb"), open(sig_path, "rb"), pub_key)
+		verify_start = time.time()
+		if entry is not None:
+			log.info("Verifying file against manifest.")
+			verified = (file_hash.hexdigest() == entry["sha512"] and
+				os.path.getsize(file_path) == entry["size"])
+		elif tree is not None:
+			log.info("Verifying last chunk of file.")
+			try:
+				verifier.finish()
+				verified = True
+			except merkle.ChunkMismatch:
+				verified = False
+		else:
+			log.info("Verifying file+signature.")
+			with open(sig_path, "rb") as sig_file:
+				verified = signatures.verify_file(None, sig_file, pub_key,
+					file_hash = file_hash)
+		if record is not None:
+			record.verify = time.time() - verify_start
 		if not verified:
 			raise errors.VerificationError("%s/%s" % (server, path))
+
+		if staged is not None:
+			if cache is not None:
+				# The cache gets its own copy, as the installed file may be
+				# changed in place.
+				_store_in_cache(cache, url, staged.temp_path, sig_path,
+					file_hash, headers, link = False)
+			log.info("Moving file '%s' into place.", path)
+			staged.close()
+			file_path = destination
 	except:
-		if file_path is not None:
+		if staged is not None:
+			if staged.closed:
+				# Not necessarily renamed into place.
+				_remove_quietly(staged.temp_path)
+			else:
+				staged.discard()
+		elif file_path is not None:
 			try:
 				os.remove(file_path)
 			except:
@@ -116,6 +1053,294 @@ def get_file(server, path, pub_key, timeout, max_size):
 				log.exception("Could not delete signature file %s.", sig_path)
 		raise
 	finally:
-		con.close()
+		if record is not None:
+			record.dns = getattr(con, "dns_time", None)
+			record.connect = getattr(con, "connect_time", None)
+		if control is not None:
+			control._attach(None)
+		pool.release(con)
+
+	if cache is not None and staged is None:
+		_store_in_cache(cache, url, file_path, sig_path, file_hash, headers)
 
 	return file_path, sig_path
+
+def _store_in_cache(cache, url, file_path, sig_path, file_hash, headers,
+		link = True):
+	"Adds a verified file to an `ArtifactCache`, logging any failure."
+
+	try:
+		cache.store(url, file_path, sig_path, file_hash.hexdigest(),
+			_get_validator(headers), link = link)
+	except EnvironmentError:
+		log.exception("Could not add '%s' to the cache.", url)
+
+# Documents up to this size are kept entirely in memory by get_document().
+DEFAULT_MEMORY_LIMIT = 1024 * 1024
+
+def get_signed_document(server, path, pub_key, timeout, max_size,
+		pool = None, memory_limit = DEFAULT_MEMORY_LIMIT, retries = 0,
+		request_headers = None, response_headers = None, control = None,
+		compressed = True):
+	"""
+	Retrieves a small file exactly like `get_document()`, but also returns
+	its signature, and can make a conditional request (ex: to revalidate a
+	cached copy of the file).
+
+	The parameters have the same meaning as for `get_document()` and
+	`get_file()`.
+
+	:raises errors.VerificationError: When the file could not be verified as
+			authentic for whatever reason.
+
+	:returns: A tuple `(document, signature)` of strings, or `None` if the
+			server responded `304 Not Modified`.
+
+	"""
+
+	if pool is None:
+		pool = default_pool
+
+	con = pool.acquire(server, timeout)
+	if control is not None:
+		control._attach(con)
+	try:
+		log.info("Getting document '%s'", path)
+		for attempt in xrange(retries + 1):
+			file_hash = signatures.new_hash()
+			# Stays in memory unless it grows past memory_limit, at which
+			# point it moves to an anonymous temporary file.
+			body = tempfile.SpooledTemporaryFile(max_size = memory_limit)
+			try:
+				started = _start_get(con, path, max_size, response_headers,
+					request_headers, control, compressed)
+				if started is not None:
+					response, decoder, content_length = started
+					_receive(response, body, max_size, file_hash,
+						expected_size = content_length, control = control,
+						decoder = decoder)
+			except (socket.error, httplib.HTTPException):
+				con.close()
+				body.close()
+				if control is not None:
+					control.check()
+				if attempt == retries:
+					raise
+				log.warning("Transfer of '%s' interrupted, retrying.", path,
+					exc_info = True)
+			except:
+				con.close()
+				body.close()
+				raise
+			else:
+				break
+
+		if started is None:
+			body.close()
+			log.info("Document '%s' not modified.", path)
+			return None
+
+		try:
+			signature = _get_signature_data(con, server, path, pub_key)
+
+			log.info("Verifying document+signature.")
+			if not signatures.verify_file(None, io.BytesIO(signature),
+					pub_key, file_hash = file_hash):
+				raise errors.VerificationError("%s/%s" % (server, path))
+
+			body.seek(0)
+			return body.read(), signature
+		finally:
+			body.close()
+	finally:
+		if control is not None:
+			control._attach(None)
+		pool.release(con)
+
+def get_document(server, path, pub_key, timeout, max_size, pool = None,
+		memory_limit = DEFAULT_MEMORY_LIMIT, retries = 0, control = None,
+		compressed = True):
+	"""
+	Securely retrieves a small file (such as a version listing) and returns
+	its contents rather than a path to it.
+
+	Both the file and its signature are received into memory and verified
+	from there, so nothing is written to disk unless the file turns out to
+	be larger than `memory_limit`, in which case the rest of it is received
+	into an anonymous temporary file (readable only by the current user)
+	instead.
+
+	The other parameters have the same meaning as for `get_file()`.
+
+	:param memory_limit: The largest file, in bytes, to keep entirely in
+			memory while it is received and verified.
+
+	:raises errors.VerificationError: When the file could not be verified as
+			authentic for whatever reason.
+
+	:returns: The verified contents of the file as a string.
+
+	"""
+
+	return get_signed_document(server, path, pub_key, timeout, max_size,
+		pool = pool, memory_limit = memory_limit, retries = retries,
+		control = control, compressed = compressed)[0]
+
+def get_manifest(server, path, pub_key, timeout, max_size, pool = None,
+		retries = 0, control = None):
+	"""
+	Securely retrieves a release's manifest (see `manifests`). It is
+	verified against its signature once, after which the files it lists can
+	be retrieved by passing it to `get_file()`.
+
+	The parameters have the same meaning as for `get_document()`.
+
+	:raises errors.VerificationError: When the manifest could not be
+			verified as authentic, or is not laid out correctly.
+
+	:returns: A `manifests.Manifest` whose files are looked up relative to
+			the directory `path` is in.
+
+	"""
+
+	data = get_document(server, path, pub_key, timeout, max_size,
+		pool = pool, retries = retries, control = control)
+	try:
+		return manifests.Manifest.parse(data, base = posixpath.dirname(path))
+	except manifests.ManifestError:
+		log.warning("Manifest '%s' is not valid.", path, exc_info = True)
+		raise errors.VerificationError("%s/%s" % (server, path))
+
+class FileRequest(object):
+	"""
+	A single file to retrieve with `get_files()`. The attributes have the same
+	meaning as the corresponding arguments to `get_file()`.
+
+	:ivar options: A dictionary of any other keyword arguments to pass to
+			`get_file()` (ex: `{"resume": True}`).
+
+	"""
+
+	def __init__(self, server, path, pub_key, timeout, max_size, **options):
+		self.server = server
+		self.path = path
+		self.pub_key = pub_key
+		self.timeout = timeout
+		self.max_size = max_size
+		self.options = options
+
+	def __repr__(self):
+		return "FileRequest(server = %s, path = %s)" % (self.server, self.path)
+
+class FileResult(object):
+	"""
+	The outcome of a single `FileRequest`.
+
+	:ivar request: The `FileRequest` this is the result of.
+	:ivar file_path: The path to the downloaded file, or `None` if the
+			transfer failed or the file was not modified.
+	:ivar sig_path: The path to the downloaded signature, or `None` if the
+			transfer failed or the file was not modified.
+	:ivar not_modified: `True` if the request was made conditional (with
+			`request_headers` in its `options`) and the server responded
+			`304 Not Modified`.
+	:ivar error: The exception that `get_file()` raised (ex:
+			`errors.VerificationError` or `IOError`), or `None` if the
+			transfer succeeded. Any files created along the way have already
+			been deleted.
+
+	"""
+
+	def __init__(self, request, file_path = None, sig_path = None,
+			error = None, not_modified = False):
+		self.request = request
+		self.file_path = file_path
+		self.sig_path = sig_path
+		self.error = error
+		self.not_modified = not_modified
+
+	def __repr__(self):
+		return "FileResult(request = %r, error = %r)" % (
+			self.request, self.error)
+
+def _get_file_result(request, pool):
+	try:
+		result = get_file(
+			server = request.server,
+			path = request.path,
+			pub_key = request.pub_key,
+			timeout = request.timeout,
+			max_size = request.max_size,
+			pool = pool,
+			**request.options
+		)
+	except Exception as e:
+		return FileResult(request, error = e)
+	if result is None:
+		return FileResult(request, not_modified = True)
+	return FileResult(request, *result)
+
+def get_files(requests, max_workers = 4, per_host_limit = 2, pool = None):
+	"""
+	Securely retrieves many files concurrently.
+
+	Each file is retrieved and verified exactly as `get_file()` would, but up
+	to `max_workers` transfers run at once (and no more than `per_host_limit`
+	against any one server). A transfer is only started once a worker and its
+	server are both free, so a large file never holds up a small one queued
+	behind it for a different server.
+
+	:param requests: An iterable of `FileRequest` objects.
+	:param max_workers: The maximum number of concurrent transfers.
+	:param per_host_limit: The maximum number of concurrent transfers to any
+			single server.
+	:param pool: The `connectionpool.ConnectionPool` to take connections
+			from. If `None`, `default_pool` is used.
+
+	:returns: An iterator over `FileResult` objects, yielded in the order the
+			transfers complete. Failures do not stop the remaining transfers.
+			If the iterator is closed early, transfers still in progress are
+			allowed to finish and their files are deleted.
+
+	"""
+
+	pending = list(requests)
+	if max_workers < 1 or per_host_limit < 1:
+		raise ValueError("max_workers and per_host_limit must be positive.")
+	if not pending:
+		return
+
+	running = {} # server -> number of transfers in progress
+	finished = Queue.Queue()
+	workers = multiprocessing.pool.ThreadPool(min(max_workers, len(pending)))
+	try:
+		while pending or running:
+			# Start everything we have capacity for, in request order.
+			for request in list(pending):
+				if sum(running.values()) >= max_workers:
+					break
+				if running.get(request.server, 0) >= per_host_limit:
+					continue
+				pending.remove(request)
+				running[request.server] = running.get(request.server, 0) + 1
+				workers.apply_async(_get_file_result, (request, pool),
+					callback = finished.put)
+
+			result = finished.get()
+			running[result.request.server] -= 1
+			if running[result.request.server] == 0:
+				del running[result.request.server]
+			yield result
+	finally:
+		workers.close()
+		workers.join()
+
+		# Anything left in the queue was never seen by the caller.
+		while not finished.empty():
+			result = finished.get()
+			for i in (result.file_path, result.sig_path):
+				if i is not None:
+					try:
+						os.remove(i)
+					except OSError:
+						log.exception("Could not delete file %s.", i)
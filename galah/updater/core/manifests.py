@@ -0,0 +1,146 @@
+"""
+Signed release manifests.
+
+Rather than every file in a release having its own signature (costing an
+extra request and a 16384-bit RSA verification per file), a release can be
+described by a single *manifest* listing the SHA-512 digest and size of each
+of its files. The manifest itself is signed like any other file (with a
+`.sig` alongside it), so once it has been verified each file only needs to be
+hashed and compared against its entry.
+
+A manifest is a JSON document laid out as follows.
+
+.. code-block:: json
+
+	{
+		"version": 1,
+		"files": {
+			"archives/galah-1.0.3.tar.gz": {
+				"sha512": "0d8f...",
+				"size": 1048576
+			}
+		}
+	}
+
+File names are relative to the directory the manifest is in and always use
+forward slashes. See `signatures.sign_manifest()` to create one and
+`filetransfer.get_manifest()` to retrieve one.
+
+"""
+
+# stdlib
+import json
+import posixpath
+import re
+
+# The only version of the format there is so far.
+MANIFEST_VERSION = 1
+
+# The name a release's manifest is conventionally given.
+MANIFEST_NAME = "manifest.json"
+
+_DIGEST_RE = re.compile("^[0-9a-f]{128}$")
+
+class ManifestError(ValueError):
+	"Raised when a manifest is not laid out correctly."
+
+def _check_name(name):
+	"""
+	:raises ManifestError: If `name` is not a plain relative path that stays
+			within the manifest's directory.
+
+	"""
+
+	parts = name.split("/")
+	if not name or name.startswith("/") or "\\" in name or \
+			any(i in ("", ".", "..") for i in parts):
+		raise ManifestError("Bad file name %r in manifest." % (name, ))
+
+class Manifest(object):
+	"""
+	The digests and sizes of the files in a release.
+
+	:ivar files: A dictionary mapping each file's name (relative to the
+			manifest) to a dictionary with the keys `sha512` (a hex string)
+			and `size`.
+	:ivar base: The path of the directory the manifest was retrieved from on
+			the server (ex: `/releases/1.0.3`), or `None` if it is not
+			known. Used by `lookup()`.
+
+	"""
+
+	def __init__(self, files = None, base = None):
+		self.files = {} if files is None else files
+		self.base = base
+
+	def add(self, name, sha512, size):
+		"Adds (or replaces) a file's entry."
+
+		_check_name(name)
+		self.files[name] = {"sha512": sha512.lower(), "size": size}
+
+	@staticmethod
+	def parse(data, base = None):
+		"""
+		Parses a manifest.
+
+		:param data: The manifest as a string. It should already have been
+				verified.
+		:param base: See `Manifest.base`.
+
+		:raises ManifestError: If the manifest is not laid out correctly.
+
+		:returns: A `Manifest`.
+
+		"""
+
+		try:
+			document = json.loads(data)
+		except ValueError as e:
+			raise ManifestError("Manifest is not valid JSON: %s" % (e, ))
+		if not isinstance(document, dict) or \
+				document.get("version") != MANIFEST_VERSION or \
+				not isinstance(document.get("files"), dict):
+			raise ManifestError("Unsupported manifest.")
+
+		manifest = Manifest(base = base)
+		for name, entry in document["files"].items():
+			if not isinstance(entry, dict) or \
+					not _DIGEST_RE.match(unicode(entry.get("sha512"))) or \
+					type(entry.get("size")) not in (int, long) or \
+					entry["size"] < 0:
+				raise ManifestError("Bad entry for %r in manifest." % (name, ))
+			# Paths on the server are byte strings, and only ASCII ones can
+			# be compared with them unambiguously.
+			try:
+				name = name.encode("ascii")
+			except UnicodeError:
+				raise ManifestError("Non-ASCII name %r in manifest." % (name, ))
+			manifest.add(name, str(entry["sha512"]), entry["size"])
+		return manifest
+
+	def dumps(self):
+		":returns: The manifest as a string (which is what gets signed)."
+
+		return json.dumps({"version": MANIFEST_VERSION, "files": self.files},
+			sort_keys = True, indent = 1)
+
+	def lookup(self, path):
+		"""
+		Finds the entry for a file on the server the manifest came from.
+
+		:param path: The path of the file on the server (ex:
+				`/releases/1.0.3/archives/galah-1.0.3.tar.gz`).
+
+		:returns: The file's entry (see `files`), or `None` if the manifest
+				does not list it.
+
+		"""
+
+		if self.base is None:
+			return None
+		base = self.base.rstrip("/") + "/"
+		path = posixpath.normpath(path)
+		if not path.startswith(base):
+			return None
+		return self.files.get(path[len(base):])
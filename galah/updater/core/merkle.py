@@ -0,0 +1,246 @@
+"""
+Merkle trees over fixed-size chunks of a file, so that a file can be verified
+piece by piece while it is still being received.
+
+A file's ordinary signature can only be checked once every byte of it has
+arrived. A file may additionally be published with a *Merkle sidecar*
+(`<file>.merkle`) listing the SHA-512 digest of each `chunk_size` bytes of
+the file (the *leaves*), and a signature (`<file>.merkle.sig`) of the tree's
+*head*: its chunk size, the file's size and the root of the tree built over
+the leaves. Once the head's signature has been checked and the leaves have
+been found to hash up to its root, every chunk of the file can be checked
+against its leaf as soon as it arrives, so a corrupted or forged transfer is
+abandoned at the first bad chunk and everything before it can be trusted.
+
+The sidecar is a JSON document laid out as follows.
+
+.. code-block:: json
+
+	{
+		"version": 1,
+		"chunk_size": 1048576,
+		"size": 3145728,
+		"leaves": ["0d8f...", "77a2...", "c3b0..."]
+	}
+
+A leaf is the SHA-512 digest of `"\\x00"` followed by the chunk, and an
+inner node is the digest of `"\\x01"` followed by its two children's
+digests. A level with an odd number of nodes has its last node carried up
+to the next level as is. An empty file has a single, empty, chunk.
+
+See `signatures.sign_merkle_tree()` to create a sidecar and `get_file()`'s
+`use_merkle` parameter in `filetransfer` to use one.
+
+"""
+
+# stdlib
+import hashlib
+import json
+import re
+
+# The only version of the sidecar format there is so far.
+MERKLE_VERSION = 1
+
+# The chunk size sidecars are made with unless told otherwise.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Smaller chunks are refused, as they would make for enormous sidecars.
+MIN_CHUNK_SIZE = 4 * 1024
+
+# An upper bound on the size of a leaf in a sidecar, quotes and all.
+_LEAF_SIZE = 132
+
+_DIGEST_RE = re.compile("^[0-9a-f]{128}$")
+
+class MerkleError(ValueError):
+	"Raised when a sidecar is not laid out correctly."
+
+class ChunkMismatch(MerkleError):
+	"Raised when a chunk of a file does not match its leaf."
+
+def leaf_hash(chunk):
+	":returns: A hash object that has been fed the leaf prefix and `chunk`."
+
+	leaf = hashlib.sha512("\x00")
+	leaf.update(chunk)
+	return leaf
+
+def max_sidecar_size(max_size):
+	":returns: The largest a sidecar for a file of up to `max_size` can be."
+
+	return 1024 + _LEAF_SIZE * (max_size // MIN_CHUNK_SIZE + 1)
+
+class MerkleTree(object):
+	"""
+	The leaves of a file's Merkle tree.
+
+	:ivar chunk_size: The size of every chunk but the last.
+	:ivar size: The size of the file.
+	:ivar leaves: The hex digest of each chunk's leaf, in order.
+
+	"""
+
+	def __init__(self, chunk_size, size, leaves):
+		self.chunk_size = chunk_size
+		self.size = size
+		self.leaves = leaves
+
+	@staticmethod
+	def chunk_count(chunk_size, size):
+		":returns: How many chunks a file of `size` bytes is split into."
+
+		return max(1, -(-size // chunk_size))
+
+	@staticmethod
+	def build(the_file, chunk_size = DEFAULT_CHUNK_SIZE):
+		"""
+		Builds the tree for a file.
+
+		:param the_file: A file object open for reading. It is read from its
+				current position to the end.
+
+		:returns: A `MerkleTree`.
+
+		"""
+
+		leaves = []
+		size = 0
+		while True:
+			chunk = the_file.read(chunk_size)
+			if not chunk and leaves:
+				break
+			leaves.append(leaf_hash(chunk).hexdigest())
+			size += len(chunk)
+			if len(chunk) < chunk_size:
+				break
+		return MerkleTree(chunk_size, size, leaves)
+
+	@staticmethod
+	def parse(data):
+		"""
+		Parses a sidecar. Its leaves are checked to be well formed and to be
+		the right number for the file, but not against the signed head.
+
+		:raises MerkleError: If the sidecar is not laid out correctly.
+
+		:returns: A `MerkleTree`.
+
+		"""
+
+		try:
+			document = json.loads(data)
+		except ValueError as e:
+			raise MerkleError("Sidecar is not valid JSON: %s" % (e, ))
+		if not isinstance(document, dict) or \
+				document.get("version") != MERKLE_VERSION:
+			raise MerkleError("Unsupported sidecar.")
+
+		chunk_size = document.get("chunk_size")
+		size = document.get("size")
+		leaves = document.get("leaves")
+		if type(chunk_size) not in (int, long) or \
+				chunk_size < MIN_CHUNK_SIZE or \
+				type(size) not in (int, long) or size < 0 or \
+				not isinstance(leaves, list) or \
+				len(leaves) != MerkleTree.chunk_count(chunk_size, size) or \
+				not all(_DIGEST_RE.match(unicode(i)) for i in leaves):
+			raise MerkleError("Bad sidecar.")
+		return MerkleTree(chunk_size, size, [str(i) for i in leaves])
+
+	def dumps(self):
+		":returns: The sidecar as a string."
+
+		return json.dumps({"version": MERKLE_VERSION,
+			"chunk_size": self.chunk_size, "size": self.size,
+			"leaves": self.leaves})
+
+	def root(self):
+		":returns: The root of the tree as a hex string."
+
+		level = [i.decode("hex") for i in self.leaves]
+		while len(level) > 1:
+			parents = [hashlib.sha512("\x01" + level[i] + level[i + 1]).digest()
+				for i in xrange(0, len(level) - 1, 2)]
+			if len(level) % 2:
+				parents.append(level[-1])
+			level = parents
+		return level[0].encode("hex")
+
+	def head(self):
+		":returns: The string that is signed to vouch for the tree."
+
+		return "galah-merkle:%d:%d:%d:%s" % (MERKLE_VERSION, self.chunk_size,
+			self.size, self.root())
+
+class ChunkVerifier(object):
+	"""
+	Wraps a hash object (see `signatures.new_hash()`) and checks everything
+	it is fed against a `MerkleTree`, one chunk at a time. Everything other
+	than `update()` is passed straight through to the wrapped hash.
+
+	:ivar tree: The `MerkleTree` to check against. It must already have been
+			verified.
+	:ivar verified_size: The number of bytes from the start of the file
+			that have been checked so far.
+	:ivar on_verified: If not `None`, called with `verified_size` every time
+			it grows.
+
+	"""
+
+	def __init__(self, tree, wrapped, on_verified = None):
+		self.tree = tree
+		self.verified_size = 0
+		self.on_verified = on_verified
+		self._wrapped = wrapped
+		self._chunk = 0
+		self._leaf = leaf_hash("")
+		self._leaf_size = 0
+
+	def _check_leaf(self):
+		if self._leaf.hexdigest() != self.tree.leaves[self._chunk]:
+			raise ChunkMismatch("Chunk %d does not match its leaf." %
+				(self._chunk, ))
+		self.verified_size += self._leaf_size
+		self._chunk += 1
+		self._leaf = leaf_hash("")
+		self._leaf_size = 0
+		if self.on_verified is not None:
+			self.on_verified(self.verified_size)
+
+	def update(self, data):
+		"""
+		:raises ChunkMismatch: If a chunk completed by `data` does not match
+				its leaf, or the file is longer than the tree says.
+
+		"""
+
+		if self.verified_size + self._leaf_size + len(data) > self.tree.size:
+			raise ChunkMismatch("File is longer than its tree says.")
+		self._wrapped.update(data)
+
+		offset = 0
+		while offset < len(data):
+			wanted = self.tree.chunk_size - self._leaf_size
+			piece = data[offset:offset + wanted]
+			self._leaf.update(piece)
+			self._leaf_size += len(piece)
+			offset += len(piece)
+			if self._leaf_size == self.tree.chunk_size:
+				self._check_leaf()
+
+	def finish(self):
+		"""
+		Checks the last chunk once the whole file has been fed in.
+
+		:raises ChunkMismatch: If the file is shorter than the tree says or
+				its last chunk does not match.
+
+		"""
+
+		if self.verified_size + self._leaf_size != self.tree.size:
+			raise ChunkMismatch("File is shorter than its tree says.")
+		if self._chunk < len(self.tree.leaves):
+			self._check_leaf()
+
+	def __getattr__(self, name):
+		return getattr(self._wrapped, name)
@@ -0,0 +1,273 @@
+"""
+Timing instrumentation for file transfers.
+
+When an upgrade is slow it is not obvious whether the time went on resolving
+and connecting to the server, waiting for it to respond, moving bytes,
+hashing them or checking the signature. Passing a `Metrics` object to
+`filetransfer.get_file()` as its `metrics_sink` (directly, or through a
+`FileRequest`'s options) makes it fill in a `TransferRecord` with all of
+those and hand it to every *sink* attached to the `Metrics` object.
+
+A sink is any object with a `record(transfer_record)` method. Three are
+provided: `CallbackSink` calls a function, `JSONLinesSink` appends one JSON
+object per transfer to a file, and `HistogramSink` aggregates every numeric
+field into a `Histogram` so a whole run can be summarised cheaply.
+
+"""
+
+import logging
+log = logging.getLogger("gi.metrics")
+
+# stdlib
+import json
+import math
+import threading
+import time
+
+class TransferRecord(object):
+	"""
+	What happened during a single call to `filetransfer.get_file()`.
+
+	Durations are in seconds and are `None` if they do not apply (ex:
+	`connect` when an already open connection was reused).
+
+	:ivar url: The URL of the file.
+	:ivar started: When the transfer started (as returned by `time.time()`).
+	:ivar outcome: One of `"ok"`, `"cached"` (served from an artifact
+			cache), `"not-modified"` (a conditional request answered with
+			`304`) or `"error"`.
+	:ivar error: A description of the error if `outcome` is `"error"`.
+	:ivar dns: Time spent resolving the server's name.
+	:ivar connect: Time spent establishing the TCP connection.
+	:ivar ttfb: Time from sending the request for the file until the server
+			started responding.
+	:ivar transfer: Time from the server starting to respond until the whole
+			file was received.
+	:ivar bytes: The size of the file received.
+	:ivar throughput: `bytes` divided by `transfer`, in bytes per second.
+	:ivar hash: Time spent hashing the file while it was received.
+	:ivar verify: Time spent checking the signature.
+	:ivar retries: The number of times the transfer was retried.
+	:ivar total: Time the whole call took.
+
+	"""
+
+	# The fields that hold numbers, in the order they are reported.
+	NUMERIC_FIELDS = ("dns", "connect", "ttfb", "transfer", "bytes",
+		"throughput", "hash", "verify", "retries", "total")
+
+	def __init__(self, url):
+		self.url = url
+		self.started = time.time()
+		self.outcome = None
+		self.error = None
+		for i in TransferRecord.NUMERIC_FIELDS:
+			setattr(self, i, None)
+		self.retries = 0
+
+	def to_dict(self):
+		"Returns the record as a dictionary suitable for serializing."
+
+		result = dict((i, getattr(self, i)) for i in
+			("url", "started", "outcome", "error"))
+		for i in TransferRecord.NUMERIC_FIELDS:
+			result[i] = getattr(self, i)
+		return result
+
+class TimedHash(object):
+	"""
+	Wraps a hash object (see `signatures.new_hash()`) and keeps track of the
+	time spent feeding it data. Everything other than `update()` is passed
+	straight through to the wrapped hash.
+
+	:ivar elapsed: The total number of seconds spent in `update()`.
+
+	"""
+
+	def __init__(self, wrapped):
+		self._wrapped = wrapped
+		self.elapsed = 0.0
+
+	def update(self, data):
+		start = time.time()
+		self._wrapped.update(data)
+		self.elapsed += time.time() - start
+
+	def __getattr__(self, name):
+		return getattr(self._wrapped, name)
+
+class Metrics(object):
+	"""
+	Hands transfer records to any number of sinks.
+
+	A sink that raises an exception is logged and otherwise ignored, as a
+	broken exporter should never make a transfer fail.
+
+	:ivar sinks: The list of sinks.
+
+	"""
+
+	def __init__(self, *sinks):
+		self.sinks = list(sinks)
+
+	def add_sink(self, sink):
+		self.sinks.append(sink)
+
+	def start(self, url):
+		"Returns a new `TransferRecord` for a transfer that is starting."
+
+		return TransferRecord(url)
+
+	def record(self, transfer_record):
+		for sink in self.sinks:
+			try:
+				sink.record(transfer_record)
+			except Exception:
+				log.exception("Metrics sink %r failed.", sink)
+
+class CallbackSink(object):
+	"Calls a function with every `TransferRecord`."
+
+	def __init__(self, callback):
+		self.callback = callback
+
+	def record(self, transfer_record):
+		self.callback(transfer_record)
+
+class JSONLinesSink(object):
+	"""
+	Appends each `TransferRecord` to a file as a single line of JSON.
+
+	:ivar path: The path to the file, or `None` if a file object was given.
+
+	"""
+
+	def __init__(self, path_or_file):
+		if isinstance(path_or_file, basestring):
+			self.path = path_or_file
+			self._file = open(path_or_file, "ab")
+		else:
+			self.path = None
+			self._file = path_or_file
+		self._lock = threading.Lock()
+
+	def record(self, transfer_record):
+		line = json.dumps(transfer_record.to_dict(), sort_keys = True)
+		with self._lock:
+			self._file.write(line + "\n")
+			self._file.flush()
+
+	def close(self):
+		"Closes the file if this sink opened it."
+
+		if self.path is not None:
+			self._file.close()
+
+class Histogram(object):
+	"""
+	A histogram with exponentially sized buckets (each twice as wide as the
+	one before it), so that adding a value is cheap and the memory used does
+	not depend on how many values are added.
+
+	Percentiles are estimated from the buckets and are accurate to within a
+	factor of two. `count`, `total`, `min` and `max` are exact.
+
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = None
+		self.zeros = 0
+		# Maps n to the number of values in [2 ** n, 2 ** (n + 1)).
+		self.buckets = {}
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+		if value <= 0:
+			self.zeros += 1
+		else:
+			bucket = int(math.floor(math.log(value, 2)))
+			self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+	def mean(self):
+		return self.total / float(self.count) if self.count else None
+
+	def percentile(self, percentile):
+		"""
+		:param percentile: A number between 0 and 100.
+
+		:returns: An estimate of the given percentile (the upper bound of the
+				bucket it falls in, clamped to `max`), or `None` if no values
+				have been added.
+
+		"""
+
+		if not self.count:
+			return None
+		rank = max(int(math.ceil(percentile / 100.0 * self.count)), 1)
+		seen = self.zeros
+		if seen >= rank:
+			return 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank:
+				return min(2.0 ** (bucket + 1), self.max)
+		return self.max
+
+	def summary(self):
+		"""
+		:returns: A dictionary with the keys `count`, `mean`, `min`, `max`,
+				`p50`, `p95` and `p99`.
+
+		"""
+
+		return {
+			"count": self.count,
+			"mean": self.mean(),
+			"min": self.min,
+			"max": self.max,
+			"p50": self.percentile(50),
+			"p95": self.percentile(95),
+			"p99": self.percentile(99)
+		}
+
+class HistogramSink(object):
+	"""
+	Aggregates the numeric fields of every `TransferRecord` into histograms.
+
+	:ivar histograms: A dictionary mapping each of
+			`TransferRecord.NUMERIC_FIELDS` to a `Histogram`.
+	:ivar outcomes: A dictionary counting the records by `outcome`.
+
+	"""
+
+	def __init__(self):
+		self.histograms = dict((i, Histogram())
+			for i in TransferRecord.NUMERIC_FIELDS)
+		self.outcomes = {}
+		self._lock = threading.Lock()
+
+	def record(self, transfer_record):
+		with self._lock:
+			self.outcomes[transfer_record.outcome] = \
+				self.outcomes.get(transfer_record.outcome, 0) + 1
+			for name, histogram in self.histograms.items():
+				value = getattr(transfer_record, name)
+				if value is not None:
+					histogram.add(value)
+
+	def summary(self):
+		"""
+		:returns: A dictionary mapping the name of each field that has had
+				any values recorded to its histogram's `summary()`.
+
+		"""
+
+		with self._lock:
+			return dict((name, histogram.summary()) for name, histogram in
+				self.histograms.items() if histogram.count)
@@ -0,0 +1,353 @@
+"""
+Retrieval of files that are available from several mirrors.
+
+The version info for a package lists `installer-mirrors`, `archive-mirrors`
+and `migration-mirrors` (see *Requirements*). The mirrors are tried in order
+until one of them gives us a file that verifies, but rather than always
+starting with the first one listed, the order is adjusted to favour mirrors
+that have been fast and reliable so far.
+
+Requests can also be *hedged*: if the first mirror takes unusually long to
+start responding (longer than a given percentile of the time to first byte
+seen across all mirrors), the same file is requested from the next mirror as
+well. Whichever transfer produces a verified file first wins and the other is
+cancelled.
+
+"""
+
+import logging
+log = logging.getLogger("gi.mirrors")
+
+# gicore
+import errors
+import filetransfer
+import util
+
+# stdlib
+import collections
+import math
+import os
+import Queue
+import threading
+import time
+
+class _MirrorRecord(object):
+	def __init__(self, window):
+		self.attempts = 0
+		self.failures = 0
+		self.ttfbs = collections.deque(maxlen = window)
+		self.throughputs = collections.deque(maxlen = window)
+
+def _median(values):
+	values = sorted(values)
+	return values[len(values) // 2] if values else None
+
+class MirrorStats(object):
+	"""
+	Observed performance of mirrors, keyed by server (ex: `localhost:8080`).
+
+	The object is thread-safe and meant to be long lived (there's a module
+	level `default_stats`), so that what is learned about a mirror while
+	fetching one file informs the choice of mirror for the next.
+
+	:ivar window: How many of the most recent latency and throughput samples
+			to keep for each mirror.
+	:ivar min_samples: How many time to first byte samples must have been
+			collected (across all mirrors) before `ttfb_percentile()` will
+			return anything.
+
+	"""
+
+	# The size of the transfer mirrors are compared on, so that both latency
+	# and throughput count.
+	NOMINAL_SIZE = 1024 * 1024
+
+	def __init__(self, window = 50, min_samples = 5):
+		self.window = window
+		self.min_samples = min_samples
+		self._mirrors = {}
+		self._lock = threading.Lock()
+
+	def _record(self, server):
+		record = self._mirrors.get(server)
+		if record is None:
+			record = self._mirrors[server] = _MirrorRecord(self.window)
+		return record
+
+	def record_success(self, server, ttfb, nbytes, duration):
+		"""
+		Records a successful transfer.
+
+		:param server: The mirror's server.
+		:param ttfb: The number of seconds until the server started
+				responding.
+		:param nbytes: The number of bytes transferred.
+		:param duration: The number of seconds the whole transfer took.
+
+		"""
+
+		with self._lock:
+			record = self._record(server)
+			record.attempts += 1
+			record.ttfbs.append(ttfb)
+			if duration > ttfb:
+				record.throughputs.append(nbytes / (duration - ttfb))
+
+	def record_failure(self, server):
+		"Records a failed transfer (including one that failed verification)."
+
+		with self._lock:
+			record = self._record(server)
+			record.attempts += 1
+			record.failures += 1
+
+	def failure_rate(self, server):
+		"""
+		:returns: The fraction of transfers from a mirror that failed, or
+				`0.0` if none have been attempted.
+
+		"""
+
+		with self._lock:
+			record = self._mirrors.get(server)
+			if record is None or record.attempts == 0:
+				return 0.0
+			return record.failures / float(record.attempts)
+
+	def latency(self, server):
+		"""
+		:returns: The median time to first byte of a mirror, or `None` if it
+				is not known.
+
+		"""
+
+		with self._lock:
+			record = self._mirrors.get(server)
+			return _median(record.ttfbs) if record is not None else None
+
+	def throughput(self, server):
+		"""
+		:returns: The median throughput (bytes per second) of a mirror, or
+				`None` if it is not known.
+
+		"""
+
+		with self._lock:
+			record = self._mirrors.get(server)
+			return _median(record.throughputs) if record is not None else None
+
+	def ttfb_percentile(self, percentile):
+		"""
+		:param percentile: A number between 0 and 100.
+
+		:returns: The given percentile of the time to first byte across every
+				mirror (using the nearest-rank method), or `None` if fewer
+				than `min_samples` samples have been collected.
+
+		"""
+
+		with self._lock:
+			samples = sorted(i for record in self._mirrors.values()
+				for i in record.ttfbs)
+		if len(samples) < self.min_samples:
+			return None
+		rank = int(math.ceil(percentile / 100.0 * len(samples)))
+		return samples[min(max(rank, 1), len(samples)) - 1]
+
+	def _estimate(self, server):
+		"""
+		:returns: The score of a mirror with at least one successful
+				transfer, `inf` for one that has only failed, or `None` for
+				one that hasn't been tried.
+
+		"""
+
+		latency = self.latency(server)
+		if latency is None:
+			return None if self.failure_rate(server) == 0.0 else float("inf")
+
+		throughput = self.throughput(server)
+		estimate = latency
+		if throughput:
+			estimate += MirrorStats.NOMINAL_SIZE / throughput
+		return estimate / max(1.0 - self.failure_rate(server), 0.01)
+
+	def score(self, server):
+		"""
+		Estimates how long a mirror would take to transfer `NOMINAL_SIZE`
+		bytes, inflated by how often it fails. Lower is better.
+
+		:returns: The estimate in seconds. A mirror that hasn't been tried yet
+				gets the median score of the mirrors that have succeeded (or
+				`0.0` if there are none), so it is tried before mirrors that
+				have proven slower than usual but after the faster ones.
+
+		"""
+
+		estimate = self._estimate(server)
+		if estimate is not None:
+			return estimate
+
+		with self._lock:
+			servers = list(self._mirrors)
+		known = [i for i in (self._estimate(j) for j in servers)
+			if i is not None and i != float("inf")]
+		return _median(known) if known else 0.0
+
+	def order(self, urls):
+		"""
+		Sorts URLs so that the mirrors expected to perform best come first.
+		Mirrors that score equally (including a mirror that hasn't been tried
+		yet and the one whose score is the median) keep their original order.
+
+		"""
+
+		return sorted(urls,
+			key = lambda url: self.score(util.split_url(url)[0]))
+
+# The stats used by get_file() when none are explicitly provided.
+default_stats = MirrorStats()
+
+class _Attempt(threading.Thread):
+	"""
+	Retrieves a file from one mirror in the background.
+
+	:ivar result: What `get_file()` returned: a `(file, signature)` tuple,
+			or `None` if the file was not modified.
+	:ivar error: The exception `get_file()` raised.
+
+	"""
+
+	def __init__(self, url, finished, stats, args, options):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.url = url
+		self.server, self.path = util.split_url(url)
+		self.control = filetransfer.TransferControl()
+		self.result = None
+		self.error = None
+		self._finished = finished
+		self._stats = stats
+		self._args = args
+		self._options = options
+
+	def run(self):
+		start = time.time()
+		try:
+			self.result = filetransfer.get_file(self.server, self.path,
+				*self._args, control = self.control, **self._options)
+			if self.control.first_byte_at is not None:
+				ttfb = self.control.first_byte_at - start
+				if self.result is None:
+					# Not modified, so there's no throughput to measure.
+					self._stats.record_success(self.server, ttfb = ttfb,
+						nbytes = 0, duration = ttfb)
+				else:
+					self._stats.record_success(self.server, ttfb = ttfb,
+						nbytes = os.path.getsize(self.result[0]),
+						duration = time.time() - start)
+		except Exception as e:
+			self.error = e
+			if not self.control.cancelled.is_set():
+				log.warning("Could not get %s.", self.url, exc_info = True)
+				self._stats.record_failure(self.server)
+		finally:
+			# Wakes up anyone waiting to decide whether to hedge.
+			self.control.first_byte.set()
+			self._finished.put(self)
+
+	def discard(self):
+		"Deletes the files of an attempt that succeeded but lost."
+
+		if self.result is not None:
+			for i in self.result:
+				if i is None:
+					continue
+				try:
+					os.remove(i)
+				except OSError:
+					log.exception("Could not delete file %s.", i)
+
+def get_file(urls, pub_key, timeout, max_size, stats = None,
+		hedge_percentile = None, **options):
+	"""
+	Securely retrieves a file from the first mirror able to provide it.
+
+	:param urls: A list of `http` URLs of the same file on different mirrors,
+			in the order given by the version info.
+	:param pub_key: See `filetransfer.get_file()`.
+	:param timeout: See `filetransfer.get_file()`.
+	:param max_size: See `filetransfer.get_file()`.
+	:param stats: The `MirrorStats` to order the mirrors by, and to record
+			how each transfer went in. If `None`, `default_stats` is used.
+	:param hedge_percentile: If not `None`, a second mirror is tried at the
+			same time as the first one if the first one hasn't started
+			responding within this percentile (ex: `95`) of the time to
+			first byte seen so far. Cannot be combined with a `destination`
+			option, as both transfers would be put in place there.
+	:param options: Any other keyword arguments to pass to
+			`filetransfer.get_file()` (ex: `pool` or `cache`), other than
+			`control` as each mirror's transfer has its own.
+
+	:raises errors.VerificationError: If no mirror could provide a file that
+			verified and at least one of them provided a file that did not.
+	:raises: Otherwise the error raised by the last mirror tried if none of
+			them could provide the file.
+
+	:returns: A tuple `(file, signature)` as `filetransfer.get_file()` does,
+			or `None` if `request_headers` made the request conditional and
+			the mirror responded `304 Not Modified`.
+
+	"""
+
+	if not urls:
+		raise ValueError("No mirrors given.")
+	if "control" in options:
+		raise ValueError("control cannot be passed to mirrors.get_file().")
+	if hedge_percentile is not None and \
+			options.get("destination") is not None:
+		raise ValueError("hedge_percentile cannot be combined with "
+			"destination.")
+	if stats is None:
+		stats = default_stats
+
+	remaining = stats.order(urls)
+	finished = Queue.Queue()
+	args = (pub_key, timeout, max_size)
+	last_error = None
+	while remaining:
+		attempts = [_Attempt(remaining.pop(0), finished, stats, args, options)]
+		attempts[0].start()
+
+		threshold = None
+		if hedge_percentile is not None and remaining:
+			threshold = stats.ttfb_percentile(hedge_percentile)
+		if threshold is not None and \
+				not attempts[0].control.first_byte.wait(threshold):
+			log.info("No response from %s after %.3fs, hedging with %s.",
+				attempts[0].url, threshold, remaining[0])
+			attempts.append(
+				_Attempt(remaining.pop(0), finished, stats, args, options))
+			attempts[1].start()
+
+		winner = None
+		for i in xrange(len(attempts)):
+			attempt = finished.get()
+			if attempt.error is None:
+				winner = attempt
+				break
+			if not isinstance(last_error, errors.VerificationError):
+				last_error = attempt.error
+
+		if winner is not None:
+			for attempt in attempts:
+				# Only a transfer still in progress holds a connection.
+				if attempt is not winner and attempt.is_alive():
+					attempt.control.cancel()
+			for attempt in attempts:
+				attempt.join()
+				if attempt is not winner:
+					attempt.discard()
+			return winner.result
+
+	raise last_error
@@ -0,0 +1,320 @@
+"""
+Distribution of verified files between the nodes of a cluster.
+
+When every node of a cluster runs the updater, each of them would otherwise
+download the same archives from the upstream server. Instead each node runs a
+`Node`, which serves the files in its `artifactcache.ArtifactCache` to the
+other nodes over the LAN. When a node needs a file it gets it, in order of
+preference, from:
+
+#. its own cache,
+#. any other node that already has it,
+#. the *leader*, which downloads it from upstream on the other nodes' behalf
+   (once, no matter how many of them ask for it at the same time),
+#. the upstream server itself, if none of the above worked out.
+
+The leader is simply the live node with the lowest address, so every node
+agrees on it without any coordination beyond checking which nodes are up.
+
+Nodes are not trusted: everything received from one is verified against its
+signature and the trusted public key just as if it had come from upstream
+(it is retrieved with `filetransfer.get_file()`). A node that serves a bad
+file is skipped and the next source is tried.
+
+"""
+
+import logging
+log = logging.getLogger("gi.peers")
+
+# gicore
+import filetransfer
+import util
+
+# stdlib
+import base64
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import socket
+import SocketServer
+import threading
+
+def _address_key(address):
+	"Sorts addresses (`host:port`) by host and then numerically by port."
+
+	host, _, port = address.rpartition(":")
+	return host, int(port)
+
+def _artifact_path(url, max_size):
+	"""
+	:returns: The path a node serves a file under. Its signature is served
+			under the same path with `.sig` appended, as usual.
+
+	"""
+
+	return "/artifact/%d/%s" % (max_size, base64.urlsafe_b64encode(url))
+
+def _parse_artifact_path(path):
+	"""
+	:returns: A tuple `(url, max_size, is_signature)`, or `None` if `path` is
+			not a path returned by `_artifact_path()` (or its signature's).
+
+	"""
+
+	is_signature = path.endswith(".sig")
+	if is_signature:
+		path = path[:-len(".sig")]
+	parts = path.split("/")
+	if len(parts) != 4 or parts[:2] != ["", "artifact"] or \
+			not parts[2].isdigit():
+		return None
+	try:
+		url = base64.urlsafe_b64decode(parts[3])
+	except TypeError:
+		return None
+	return url, int(parts[2]), is_signature
+
+class _PeerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	server_version = "GalahPeer/1.0"
+
+	def do_GET(self):
+		self._respond(send_body = True)
+
+	def do_HEAD(self):
+		self._respond(send_body = False)
+
+	def _respond(self, send_body):
+		if self.path == "/ping":
+			self._send_headers(httplib.OK, 0)
+			return
+
+		parsed = _parse_artifact_path(self.path)
+		if parsed is None:
+			self.send_error(httplib.NOT_FOUND)
+			return
+		url, max_size, is_signature = parsed
+
+		# Only a GET for the file itself (which comes before the one for the
+		# signature) may make the node download it.
+		paths = self.server.node._locate(url, max_size,
+			fetch = send_body and not is_signature)
+		try:
+			if paths is None or paths[1 if is_signature else 0] is None:
+				raise IOError("Not available.")
+			f = open(paths[1 if is_signature else 0], "rb")
+		except IOError:
+			self.send_error(httplib.NOT_FOUND)
+			return
+		with f:
+			self._send_headers(httplib.OK, os.fstat(f.fileno()).st_size)
+			if send_body:
+				shutil.copyfileobj(f, self.wfile, filetransfer.MAX_CHUNK_SIZE)
+
+	def _send_headers(self, status, content_length):
+		self.send_response(status)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(content_length))
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		log.debug("%s - %s", self.address_string(), format % args)
+
+class _PeerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self, listen_on, node):
+		BaseHTTPServer.HTTPServer.__init__(self, listen_on,
+			_PeerRequestHandler)
+		self.node = node
+
+class Node(object):
+	"""
+	One node of a cluster, both serving files to the other nodes and getting
+	files from them.
+
+	:ivar address: This node's address (`host:port`) as the other nodes know
+			it.
+	:ivar peers: The addresses of the other nodes.
+	:ivar cache: The `artifactcache.ArtifactCache` files are kept in and
+			served from. It should be large enough to hold the files being
+			distributed, as files that do not fit can't be shared.
+	:ivar pub_key: The trusted public key every file is verified with.
+	:ivar timeout: The timeout for network operations, as for
+			`filetransfer.get_file()`.
+	:ivar upstreams: The upstream servers (ex: `gi.galahgroup.com`) this
+			node will download files from on behalf of other nodes when it
+			is the leader. Requests for files anywhere else are refused.
+	:ivar ping_timeout: How many seconds to wait for a node to answer when
+			checking whether it is up.
+	:ivar pool: The `connectionpool.ConnectionPool` used for every transfer.
+
+	"""
+
+	def __init__(self, listen_on, peers, cache, pub_key, timeout, upstreams,
+			ping_timeout = 1, pool = None):
+		self.listen_on = listen_on
+		self.address = "%s:%d" % listen_on
+		self.peers = [i for i in peers if i != self.address]
+		self.cache = cache
+		self.pub_key = pub_key
+		self.timeout = timeout
+		self.upstreams = frozenset(upstreams)
+		self.ping_timeout = ping_timeout
+		self.pool = filetransfer.default_pool if pool is None else pool
+
+		self._server = None
+		self._thread = None
+		self._fetch_locks = {}
+		self._fetch_locks_lock = threading.Lock()
+
+	def start(self):
+		"Starts serving files to the other nodes (from a background thread)."
+
+		if self._server is not None:
+			raise RuntimeError("Node already started.")
+		self._server = _PeerServer(self.listen_on, self)
+		self._thread = threading.Thread(target = self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"Stops serving files."
+
+		if self._server is None:
+			raise RuntimeError("Node is not started.")
+		self._server.shutdown()
+		self._server.server_close()
+		self._thread.join()
+		self._server = self._thread = None
+
+	def _ask(self, peer, method, path, timeout):
+		"""
+		Sends a request to another node.
+
+		:returns: `True` if it responded `200 OK`, `False` if it responded
+				with anything else or could not be reached.
+
+		"""
+
+		con = httplib.HTTPConnection(peer, timeout = timeout)
+		try:
+			con.request(method, path)
+			response = con.getresponse()
+			response.read()
+			return response.status == httplib.OK
+		except (socket.error, httplib.HTTPException):
+			return False
+		finally:
+			con.close()
+
+	def live_peers(self):
+		":returns: The addresses of the other nodes that are up."
+
+		return [i for i in self.peers
+			if self._ask(i, "GET", "/ping", self.ping_timeout)]
+
+	def leader(self, live_peers = None):
+		"""
+		:param live_peers: The result of `live_peers()`, if already known.
+
+		:returns: The address of the node that downloads files from upstream
+				for the others.
+
+		"""
+
+		if live_peers is None:
+			live_peers = self.live_peers()
+		return min(live_peers + [self.address], key = _address_key)
+
+	def _fetch_lock(self, url):
+		with self._fetch_locks_lock:
+			return self._fetch_locks.setdefault(url, threading.Lock())
+
+	def _fetch_upstream(self, url, max_size):
+		"""
+		Gets a file from upstream into the cache. Concurrent calls for the
+		same URL wait for a single download rather than making their own.
+
+		:returns: A tuple `(file, signature)` as `get_file()` does.
+
+		"""
+
+		server, path = util.split_url(url)
+		with self._fetch_lock(url):
+			return filetransfer.get_file(server, path, self.pub_key,
+				self.timeout, max_size, pool = self.pool, cache = self.cache)
+
+	def _locate(self, url, max_size, fetch):
+		"""
+		Called by the server to find a file another node asked for.
+
+		:param fetch: Whether the file may be downloaded from upstream if it
+				is not already in the cache.
+
+		:returns: A tuple `(file, signature)` of paths in the cache, or
+				`None` if the file is not available.
+
+		"""
+
+		paths = self.cache.object_paths(url)
+		if paths is not None or not fetch:
+			return paths
+
+		try:
+			server, _ = util.split_url(url)
+		except ValueError:
+			return None
+		if server not in self.upstreams:
+			log.warning("Refusing to download %s for another node.", url)
+			return None
+
+		try:
+			for i in self._fetch_upstream(url, max_size):
+				if i is not None:
+					os.remove(i)
+		except Exception:
+			log.warning("Could not get %s for another node.", url,
+				exc_info = True)
+			return None
+		return self.cache.object_paths(url)
+
+	def get_file(self, url, max_size):
+		"""
+		Securely retrieves a file, from the cluster if possible and from
+		upstream otherwise. The file is added to the cache so that it can be
+		served to the other nodes.
+
+		:param url: The file's upstream `http` URL.
+		:param max_size: The maximum size of the file in bytes.
+
+		:raises errors.VerificationError: When the file could not be verified
+				as authentic for whatever reason.
+
+		:returns: A tuple `(file, signature)` of paths, as
+				`filetransfer.get_file()` returns. The caller owns them.
+
+		"""
+
+		cached = self.cache.checkout(url)
+		if cached is not None:
+			return cached
+
+		live_peers = self.live_peers()
+		leader = self.leader(live_peers)
+		if leader != self.address:
+			path = _artifact_path(url, max_size)
+			holders = [i for i in live_peers if i != leader and
+				self._ask(i, "HEAD", path, self.timeout)]
+			for peer in holders + [leader]:
+				try:
+					log.info("Getting %s from node %s.", url, peer)
+					return filetransfer.get_file(peer, path, self.pub_key,
+						self.timeout, max_size, pool = self.pool,
+						cache = self.cache, cache_url = url)
+				except Exception:
+					log.warning("Could not get %s from node %s.", url, peer,
+						exc_info = True)
+
+		return self._fetch_upstream(url, max_size)
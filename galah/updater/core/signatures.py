@@ -11,22 +11,141 @@ public key (distributed with the installer). The hash algorithm used is
 
 """
 
+import logging
+log = logging.getLogger("gi.signatures")
+
+# gicore
+import atomicfile
+import manifests
+import merkle
+import verificationcache
+
 # pycrypto
 import Crypto.Hash.SHA512
 import Crypto.PublicKey.RSA
+import Crypto.Random
 import Crypto.Signature.PKCS1_PSS
 
-def _hash_file_sha512(the_file):
-	CHUNK_SIZE = 1024
-	file_hash = Crypto.Hash.SHA512.new()
+# stdlib
+import errno
+import json
+import mmap
+import multiprocessing
+import os
+import stat
+import time
+
+def new_hash():
+	"""
+	Creates an empty hash object of the kind used for signing files. Data can
+	be fed into it incrementally (with its `update()` method) and it may then
+	be passed to `verify_file()` in place of the file itself.
+
+	"""
+
+	return Crypto.Hash.SHA512.new()
+
+def signature_size(key):
+	"""
+	Determines the exact size of any signature made with a key.
+
+	An RSASSA-PSS signature is always exactly as long as the key's modulus, so
+	anything of a different size can be rejected without further checks.
+
+	:param key: An RSA key object as returned by
+			`Crypto.PublicKey.RSA.importKey`.
+
+	:returns: The size of a signature in bytes.
+
+	"""
+
+	# size() is the number of bits in the modulus minus one.
+	return (key.size() + 8) // 8
+
+# The amount of data fed to the hash at once. Big enough that the per-call
+# overhead is negligible, and a multiple of any page size. The SHA-512
+# implementation (OpenSSL's, through hashlib) releases the GIL while hashing
+# a block this size, so other threads can run.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def _hash_mmap(the_file, file_hash):
+	"""
+	Hashes the rest of a regular file (from its current position) by memory
+	mapping it, which avoids copying its contents into Python strings.
+
+	:returns: `False` if the file can't be mapped (ex: it is a pipe or a
+			`StringIO`), in which case nothing has been hashed.
+
+	"""
+
+	try:
+		fd = the_file.fileno()
+		st = os.fstat(fd)
+		offset = the_file.tell()
+	except (AttributeError, IOError, OSError):
+		return False
+	if not stat.S_ISREG(st.st_mode) or st.st_size <= offset:
+		return False
+
+	try:
+		mapped = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+	except (EnvironmentError, ValueError):
+		return False
+	try:
+		size = len(mapped)
+		for i in xrange(offset, size, HASH_BLOCK_SIZE):
+			file_hash.update(buffer(mapped, i, HASH_BLOCK_SIZE))
+	finally:
+		mapped.close()
+
+	# Leave the file where reading it to the end would have.
+	the_file.seek(size)
+	return True
+
+def _hash_stream(the_file, file_hash):
+	"Hashes the rest of a file object by reading it in large blocks."
+
+	readinto = getattr(the_file, "readinto", None)
+	if readinto is None:
+		while True:
+			chunk = the_file.read(HASH_BLOCK_SIZE)
+			if len(chunk) == 0:
+				break
+			file_hash.update(chunk)
+		return
+
+	buf = bytearray(HASH_BLOCK_SIZE)
+	view = memoryview(buf)
 	while True:
-		chunk = the_file.read(1024)
-		if len(chunk) == 0:
+		nbytes = readinto(buf)
+		if not nbytes:
 			break
-		file_hash.update(chunk)
+		file_hash.update(view[:nbytes])
+
+def _hash_file_sha512(the_file, use_mmap = False):
+	"""
+	Hashes a file from its current position to its end.
+
+	The file is read in blocks of `HASH_BLOCK_SIZE` bytes, or memory mapped
+	if `use_mmap` is given and it is a regular file.
+
+	:param the_file: A file object.
+	:param use_mmap: Whether memory mapping may be used. Only pass `True` if
+			nobody else can truncate the file while it is being hashed,
+			which would crash the process with `SIGBUS` rather than
+			raise an exception.
+
+	:returns: The hash object (see `new_hash()`).
+
+	"""
+
+	file_hash = new_hash()
+	if not (use_mmap and _hash_mmap(the_file, file_hash)):
+		_hash_stream(the_file, file_hash)
 	return file_hash
 
-def verify_file(the_file, signature_file, key):
+def verify_file(the_file, signature_file, key, file_hash = None,
+		cache = None):
 	"""
 	Verifies that a file and signature file pair are valid and signed with the
 	appropriate public key.
@@ -40,15 +159,32 @@ def verify_file(the_file, signature_file, key):
 	:param signature_file: A file object containing the signature file.
 	:param key: An RSA key object as returned by
 			`Crypto.PublicKey.RSA.importKey`.
+	:param file_hash: A hash object (as returned by `new_hash()`) that has
+			already been fed the file's entire contents. If given, `the_file`
+			is not read at all and may be `None`.
+	:param cache: A `verificationcache.VerificationCache`. If this file,
+			signature and key have verified before (and the file has not
+			changed since) `True` is returned straight away, and otherwise a
+			successful verification is added to it.
 
 	:returns: `True` if the verification was succesful, `False` otherwise.
 
 	"""
 
-	verifier = Crypto.Signature.PKCS1_PSS.new(key)
-	file_hash = _hash_file_sha512(the_file)
 	signature = signature_file.read()
-	return verifier.verify(file_hash, signature)
+	identity = None
+	if cache is not None:
+		identity = cache.identify(the_file, file_hash)
+		if identity is not None and cache.lookup(identity, signature, key):
+			return True
+
+	verifier = Crypto.Signature.PKCS1_PSS.new(key)
+	if file_hash is None:
+		file_hash = _hash_file_sha512(the_file)
+	verified = verifier.verify(file_hash, signature)
+	if verified and identity is not None:
+		cache.add(identity, signature, key, the_file)
+	return verified
 
 def sign_file(the_file, key):
 	"""
@@ -65,3 +201,390 @@ def sign_file(the_file, key):
 	signer = Crypto.Signature.PKCS1_PSS.new(key)
 	file_hash = _hash_file_sha512(the_file)
 	return signer.sign(file_hash)
+
+def sign_merkle_tree(the_file, key, chunk_size = merkle.DEFAULT_CHUNK_SIZE):
+	"""
+	Creates a Merkle sidecar for a file (see `merkle`) and signs its head.
+
+	:param the_file: A file object with data that needs signing.
+	:param key: The private key to sign with.
+	:param chunk_size: The size of the chunks the file can be verified in.
+
+	:returns: A tuple `(sidecar, signature)` of strings, to be published as
+			`<file>.merkle` and `<file>.merkle.sig` respectively.
+
+	"""
+
+	tree = merkle.MerkleTree.build(the_file, chunk_size)
+	signer = Crypto.Signature.PKCS1_PSS.new(key)
+	return tree.dumps(), signer.sign(new_hash().new(tree.head()))
+
+def _release_files(root):
+	"""
+	:returns: The paths of every file under `root` that is part of a release,
+			which is all of them but signatures, Merkle sidecars and
+			manifests.
+
+	"""
+
+	paths = []
+	for dir_path, dir_names, file_names in os.walk(root):
+		dir_names.sort()
+		for i in sorted(file_names):
+			if not i.endswith((".sig", ".merkle")) and \
+					i != manifests.MANIFEST_NAME:
+				paths.append(os.path.join(dir_path, i))
+	return paths
+
+def make_manifest(root, paths = None):
+	"""
+	Creates a manifest (see `manifests`) describing the files of a release.
+
+	:param root: The directory the manifest will be placed in. Every file
+			must be inside it.
+	:param paths: The paths of the files to list. If `None`, every regular
+			file under `root` is listed, except for signatures, Merkle
+			sidecars and manifests.
+
+	:returns: A `manifests.Manifest`.
+
+	"""
+
+	if paths is None:
+		paths = _release_files(root)
+
+	manifest = manifests.Manifest()
+	for path in paths:
+		name = os.path.relpath(path, root)
+		if name.startswith(os.pardir):
+			raise ValueError("%s is not inside %s." % (path, root))
+		with open(path, "rb") as f:
+			file_hash = _hash_file_sha512(f)
+			size = f.tell()
+		manifest.add(name.replace(os.sep, "/"), file_hash.hexdigest(), size)
+	return manifest
+
+def sign_manifest(root, key, paths = None, name = manifests.MANIFEST_NAME):
+	"""
+	Creates a manifest of a release's files (see `make_manifest()`) and
+	signs it, writing both into `root`.
+
+	:param key: The private key to sign with.
+	:param name: The name to give the manifest. Its signature is named the
+			same with `.sig` appended.
+
+	:returns: The path to the manifest.
+
+	"""
+
+	manifest_path = os.path.join(root, name)
+	data = make_manifest(root, paths).dumps()
+	signer = Crypto.Signature.PKCS1_PSS.new(key)
+	signature = signer.sign(new_hash().new(data))
+
+	# Write the signature first so the manifest never appears without one.
+	with atomicfile.AtomicFile(manifest_path + ".sig") as f:
+		f.write(signature)
+	with atomicfile.AtomicFile(manifest_path) as f:
+		f.write(data)
+	return manifest_path
+
+class VerifyResult(object):
+	"""
+	The outcome of verifying one file with `verify_many()`.
+
+	:ivar file_path: The path of the file.
+	:ivar sig_path: The path of its signature.
+	:ivar verified: Whether the file verified.
+	:ivar error: If the file or signature could not be read, a description of
+			the error (`verified` is then `False`).
+	:ivar size: The size of the file in bytes.
+	:ivar hash_time: The number of seconds spent hashing the file.
+	:ivar verify_time: The number of seconds spent checking the signature.
+
+	"""
+
+	def __init__(self, file_path, sig_path, verified = False, error = None,
+			size = 0, hash_time = 0.0, verify_time = 0.0):
+		self.file_path = file_path
+		self.sig_path = sig_path
+		self.verified = verified
+		self.error = error
+		self.size = size
+		self.hash_time = hash_time
+		self.verify_time = verify_time
+
+# The key used by a verify_many() or sign_tree() worker process.
+_worker_key = None
+
+def _init_worker(exported_key):
+	global _worker_key
+	# The random number generator refuses to be used in a forked process
+	# until it has been told about the fork.
+	Crypto.Random.atfork()
+	_worker_key = Crypto.PublicKey.RSA.importKey(exported_key)
+
+def _verify_pair(pair):
+	"Runs in a worker process. Verifies a single `(file, signature)` pair."
+
+	file_path, sig_path = pair
+	result = VerifyResult(file_path, sig_path)
+	try:
+		start = time.time()
+		with open(file_path, "rb") as f:
+			file_hash = _hash_file_sha512(f)
+			result.size = f.tell()
+		result.hash_time = time.time() - start
+
+		start = time.time()
+		with open(sig_path, "rb") as sig_file:
+			result.verified = verify_file(None, sig_file, _worker_key,
+				file_hash = file_hash)
+		result.verify_time = time.time() - start
+	except EnvironmentError as e:
+		result.error = str(e)
+	return result
+
+def verify_many(pairs, key, workers = None, fail_fast = False):
+	"""
+	Verifies many files in parallel, using a pool of worker processes so
+	that hashing and RSA verification can use every core.
+
+	:param pairs: An iterable of `(file, signature)` tuples of paths.
+	:param key: The public key to verify with (see `verify_file()`).
+	:param workers: The number of worker processes. Defaults to the number of
+			CPUs.
+	:param fail_fast: If `True`, stop as soon as any file fails to verify.
+			The failure is the last result produced and the remaining files
+			are left unchecked.
+
+	:returns: An iterator over `VerifyResult` objects, produced as each file
+			is finished with (not necessarily in the order given). Closing
+			it early stops the workers.
+
+	"""
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	pool = multiprocessing.Pool(workers, _init_worker,
+		(key.publickey().exportKey(), ))
+	try:
+		for result in pool.imap_unordered(_verify_pair, pairs):
+			yield result
+			if fail_fast and not result.verified:
+				break
+	finally:
+		pool.terminate()
+		pool.join()
+
+class SignResult(object):
+	"""
+	The outcome of signing one file with `sign_tree()`.
+
+	:ivar file_path: The path of the file.
+	:ivar digest: The file's SHA-512 digest as a hex string, or `None` if it
+			could not be read.
+	:ivar signed: Whether a new signature was written.
+	:ivar skipped: Whether the file was left alone because its signature
+			was already up to date.
+	:ivar error: If the file could not be read or its signature written, a
+			description of the error.
+	:ivar size: The size of the file in bytes.
+	:ivar hash_time: The number of seconds spent hashing the file.
+	:ivar sign_time: The number of seconds spent signing it.
+
+	"""
+
+	def __init__(self, file_path, digest = None, signed = False,
+			skipped = False, error = None, size = 0, hash_time = 0.0,
+			sign_time = 0.0):
+		self.file_path = file_path
+		self.digest = digest
+		self.signed = signed
+		self.skipped = skipped
+		self.error = error
+		self.size = size
+		self.hash_time = hash_time
+		self.sign_time = sign_time
+
+def _sign_task(task):
+	"""
+	Runs in a worker process. Signs a single file unless the digest it was
+	last signed with (the second item of `task`, or `None`) still matches.
+
+	:returns: A tuple of the `SignResult` and the new signature (or `None`),
+			which `sign_tree()` writes.
+
+	"""
+
+	file_path, signed_digest = task
+	result = SignResult(file_path)
+	signature = None
+	try:
+		start = time.time()
+		with open(file_path, "rb") as f:
+			file_hash = _hash_file_sha512(f)
+			result.size = f.tell()
+		result.digest = file_hash.hexdigest()
+		result.hash_time = time.time() - start
+
+		if result.digest == signed_digest and \
+				os.path.exists(file_path + ".sig"):
+			result.skipped = True
+			return result, None
+
+		start = time.time()
+		signature = Crypto.Signature.PKCS1_PSS.new(_worker_key).sign(
+			file_hash)
+		result.sign_time = time.time() - start
+	except EnvironmentError as e:
+		result.error = str(e)
+	return result, signature
+
+def _stage_signature(group, result, signature):
+	"Writes a signature made by `_sign_task()` into a `CommitGroup`."
+
+	try:
+		f = group.open(result.file_path + ".sig")
+		try:
+			f.write(signature)
+			f.close()
+		except:
+			f.discard()
+			raise
+	except EnvironmentError as e:
+		result.error = str(e)
+	else:
+		result.signed = True
+
+# The version of the digest index written by sign_tree().
+SIGN_INDEX_VERSION = 1
+
+def _load_sign_index(index_path, fingerprint):
+	"""
+	:returns: The `files` of a digest index written by `sign_tree()`, or an
+			empty dictionary if there is none or it was made with another
+			key.
+
+	"""
+
+	try:
+		with open(index_path, "rb") as f:
+			index = json.load(f)
+	except IOError as e:
+		if e.errno != errno.ENOENT:
+			raise
+		return {}
+	except ValueError:
+		log.warning("Digest index %s is corrupt, signing everything.",
+			index_path)
+		return {}
+
+	if not isinstance(index, dict) or \
+			index.get("version") != SIGN_INDEX_VERSION or \
+			index.get("key") != fingerprint or \
+			not isinstance(index.get("files"), dict):
+		log.info("Digest index %s does not apply, signing everything.",
+			index_path)
+		return {}
+	return index["files"]
+
+def sign_tree(root, key, index_path = None, paths = None, workers = None):
+	"""
+	Signs every file of a release in parallel, writing each signature next
+	to its file (as `<file>.sig`). The signatures are committed together
+	with an `atomicfile.CommitGroup`, so a release with many files isn't
+	synced to disk one signature at a time.
+
+	If `index_path` is given, the SHA-512 digest of every file signed is
+	recorded there, and the next run only signs files whose contents have
+	changed since (or whose signature has gone missing). Every file is
+	still hashed, but hashing is cheap next to signing with a large key.
+
+	:param root: The directory the release is in.
+	:param key: The private key to sign with.
+	:param index_path: Where to keep the digest index. It should not be
+			inside `root`, as it is not part of the release. If `None`,
+			every file is signed.
+	:param paths: The paths of the files to sign. If `None`, every file
+			under `root` is signed, except for signatures, Merkle sidecars
+			and manifests.
+	:param workers: The number of worker processes. Defaults to the number of
+			CPUs.
+
+	:returns: A list of `SignResult` objects, one per file.
+
+	"""
+
+	# Files that are no longer in the release are dropped from the index,
+	# but only if the whole release was looked at.
+	partial = paths is not None
+	if paths is None:
+		paths = _release_files(root)
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+
+	fingerprint = verificationcache.key_fingerprint(key)
+	index = {}
+	if index_path is not None:
+		index = _load_sign_index(index_path, fingerprint)
+
+	names = dict((i, os.path.relpath(i, root).replace(os.sep, "/"))
+		for i in paths)
+	tasks = [(i, index.get(names[i])) for i in paths]
+
+	results = []
+	group = atomicfile.CommitGroup()
+	pool = multiprocessing.Pool(workers, _init_worker, (key.exportKey(), ))
+	try:
+		for result, signature in pool.imap_unordered(_sign_task, tasks):
+			if signature is not None:
+				_stage_signature(group, result, signature)
+			results.append(result)
+	finally:
+		pool.terminate()
+		pool.join()
+
+		# Whatever was signed is committed and recorded, even if something
+		# went wrong.
+		group.commit()
+		if index_path is not None:
+			files = {}
+			for i in results:
+				if i.error is None:
+					files[names[i.file_path]] = i.digest
+			if partial:
+				for name, digest in index.items():
+					files.setdefault(name, digest)
+			with atomicfile.AtomicFile(index_path) as f:
+				json.dump({"version": SIGN_INDEX_VERSION, "key": fingerprint,
+					"files": files}, f, indent = 1, sort_keys = True)
+
+	return results
+
+def format_report(results):
+	"""
+	Lays out the timings of `verify_many()` results as a table, slowest
+	first, with totals.
+
+	:param results: A list of `VerifyResult` objects.
+
+	:returns: The table as a string.
+
+	"""
+
+	MIB = 1024.0 * 1024.0
+	lines = ["%-8s %10s %9s %9s %10s  %s" % (
+		"status", "MiB", "hash s", "verify s", "MiB/s", "file")]
+	for i in sorted(results, key = lambda i: i.hash_time + i.verify_time,
+			reverse = True):
+		elapsed = i.hash_time + i.verify_time
+		status = "ok" if i.verified else ("error" if i.error else "BAD")
+		lines.append("%-8s %10.2f %9.3f %9.3f %10.1f  %s" % (status,
+			i.size / MIB, i.hash_time, i.verify_time,
+			i.size / MIB / elapsed if elapsed else 0.0, i.file_path))
+	lines.append("%-8s %10.2f %9.3f %9.3f %10s  %d files" % ("total",
+		sum(i.size for i in results) / MIB,
+		sum(i.hash_time for i in results),
+		sum(i.verify_time for i in results), "", len(results)))
+	return "\n".join(lines)
@@ -0,0 +1,56 @@
+"""
+Small helpers shared by several of the other modules.
+
+"""
+
+# gicore
+import errors
+
+# stdlib
+import errno
+import os
+import stat
+import urlparse
+
+def private_dir(path):
+	"""
+	Creates a directory that only the current user can access, or checks that
+	an existing one is such a directory.
+
+	:raises errors.CriticalError: If the directory exists but is not owned by
+			the current user, is accessible by anyone else, or is not a
+			directory at all (ex: a symbolic link planted by someone else).
+
+	:returns: `path`
+
+	"""
+
+	try:
+		os.mkdir(path, 0700)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+	st = os.lstat(path)
+	if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or
+			stat.S_IMODE(st.st_mode) & 0077):
+		raise errors.CriticalError(
+			"Directory %s is not private to this user." % (path, ))
+	return path
+
+def split_url(url):
+	"""
+	:raises ValueError: If the URL isn't an `http` one.
+
+	:returns: A tuple `(server, path)` for an `http` URL, as
+			`filetransfer.get_file()` and friends take them.
+
+	"""
+
+	parsed = urlparse.urlsplit(url)
+	if parsed.scheme != "http" or not parsed.netloc:
+		raise ValueError("Unsupported URL %r." % (url, ))
+	path = parsed.path or "/"
+	if parsed.query:
+		path += "?" + parsed.query
+	return parsed.netloc, path
@@ -0,0 +1,203 @@
+"""
+A persistent record of files that have already been verified.
+
+Verifying a file means hashing all of it and then checking an RSA signature
+with a very large key, which is wasted effort for a file that was verified a
+few minutes ago and has not changed since. `VerificationCache` remembers
+which (file, signature, public key) combinations verified successfully, so
+`signatures.verify_file()` can skip straight to the answer.
+
+A file is identified either by its SHA-512 digest (when the caller has
+already hashed it) or by its device, inode, size, modification time and
+change time. Any write to a file changes its change time (which, unlike the
+modification time, can't be set back by anyone), so an entry is invalidated
+by any change to the file. As in git's handling of "racily clean" files, a
+file that changed less than `racy_window` seconds before it was verified is
+not cached, so that a change made within the resolution of the filesystem's
+timestamps is never missed.
+
+Only successful verifications are cached, and the cache file is ignored
+unless it is owned by the current user and not writable by anyone else.
+
+"""
+
+import logging
+log = logging.getLogger("gi.verificationcache")
+
+# gicore
+import atomicfile
+
+# stdlib
+import errno
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+
+def key_fingerprint(key):
+	"""
+	:param key: An RSA key object as returned by
+			`Crypto.PublicKey.RSA.importKey`.
+
+	:returns: A string identifying the public half of the key.
+
+	"""
+
+	return hashlib.sha256("%x:%x" % (key.n, key.e)).hexdigest()
+
+def _stat_identity(st):
+	return "stat:%d:%d:%d:%r:%r" % (st.st_dev, st.st_ino, st.st_size,
+		st.st_mtime, st.st_ctime)
+
+class VerificationCache(object):
+	"""
+	A thread-safe, persistent cache of successful verifications.
+
+	:ivar path: The file the cache is kept in.
+	:ivar max_entries: The number of entries to keep. The least recently used
+			ones are dropped beyond this.
+	:ivar racy_window: Files changed less than this many seconds before being
+			verified are not cached.
+	:ivar autosave: Whether to save the cache every time an entry is added.
+			If `False`, call `save()`.
+	:ivar stats: A dictionary of counters: `hits`, `misses` and `stores`.
+
+	"""
+
+	def __init__(self, path, max_entries = 10000, racy_window = 1.0,
+			autosave = True):
+		self.path = path
+		self.max_entries = max_entries
+		self.racy_window = racy_window
+		self.autosave = autosave
+		self.stats = {"hits": 0, "misses": 0, "stores": 0}
+		self._lock = threading.Lock()
+		self._entries = self._load()
+
+	def _load(self):
+		"""
+		:returns: The saved entries (a dictionary mapping each entry's key to
+				when it was last used), or an empty dictionary if there are
+				none or they can't be trusted.
+
+		"""
+
+		try:
+			with open(self.path, "rb") as f:
+				st = os.fstat(f.fileno())
+				if st.st_uid != os.geteuid() or \
+						st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+					log.warning("Ignoring verification cache %s as it could "
+						"have been written by another user.", self.path)
+					return {}
+				entries = json.load(f)
+			if not isinstance(entries, dict):
+				raise ValueError("Not a dictionary.")
+			return entries
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		except ValueError:
+			log.warning("Verification cache %s is corrupt, starting afresh.",
+				self.path)
+		return {}
+
+	def save(self):
+		"Writes the cache to disk."
+
+		with self._lock:
+			entries = dict(self._entries)
+		# The temporary file AtomicFile writes to is only readable and
+		# writable by the current user. A cache lost in a crash is simply
+		# rebuilt, so it isn't synced.
+		with atomicfile.AtomicFile(self.path,
+				durability = atomicfile.DURABILITY_NONE) as f:
+			json.dump(entries, f)
+
+	def hit_rate(self):
+		"""
+		:returns: The fraction of lookups that were hits, or `0.0` if there
+				have been none.
+
+		"""
+
+		total = self.stats["hits"] + self.stats["misses"]
+		return self.stats["hits"] / float(total) if total else 0.0
+
+	def identify(self, the_file, file_hash = None):
+		"""
+		Works out what a file should be looked up by.
+
+		:param the_file: An open file object, or `None` if `file_hash` is
+				given.
+		:param file_hash: A hash object that has been fed the entire file.
+
+		:returns: A string identifying the file's current contents, or
+				`None` if it can't be identified (ex: it is a `StringIO`).
+
+		"""
+
+		if file_hash is not None:
+			return "sha512:" + file_hash.hexdigest()
+
+		try:
+			st = os.fstat(the_file.fileno())
+		except (AttributeError, IOError, OSError):
+			return None
+		return _stat_identity(st) if stat.S_ISREG(st.st_mode) else None
+
+	def _key(self, identity, signature, key):
+		return hashlib.sha256("\0".join((identity,
+			hashlib.sha512(signature).hexdigest(),
+			key_fingerprint(key)))).hexdigest()
+
+	def lookup(self, identity, signature, key):
+		"""
+		:param identity: As returned by `identify()`.
+		:param signature: The signature as a string.
+		:param key: The public key.
+
+		:returns: `True` if this combination has verified before.
+
+		"""
+
+		entry_key = self._key(identity, signature, key)
+		with self._lock:
+			hit = entry_key in self._entries
+			self.stats["hits" if hit else "misses"] += 1
+			if hit:
+				self._entries[entry_key] = time.time()
+		return hit
+
+	def add(self, identity, signature, key, the_file = None):
+		"""
+		Records a successful verification.
+
+		:param the_file: The file that was verified if `identity` came from
+				it (rather than from a hash). It is checked again to make
+				sure it did not change while being verified.
+
+		"""
+
+		if identity.startswith("stat:"):
+			st = os.fstat(the_file.fileno())
+			if _stat_identity(st) != identity:
+				return
+			if time.time() - max(st.st_mtime, st.st_ctime) < self.racy_window:
+				return
+
+		with self._lock:
+			self._entries[self._key(identity, signature, key)] = time.time()
+			self.stats["stores"] += 1
+			if len(self._entries) > self.max_entries:
+				by_age = sorted(self._entries, key = self._entries.get)
+				for i in by_age[:len(self._entries) - self.max_entries]:
+					del self._entries[i]
+		if self.autosave:
+			try:
+				self.save()
+			except EnvironmentError:
+				log.exception("Could not save verification cache %s.",
+					self.path)